@@ -11,24 +11,126 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
 import os
-from celery import Celery
 
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# Redis connection pools. Each process keeps one pool per Redis URL, shared by
+# all its clients (imageupload/redis_client.py); a client waits up to
+# REDIS_POOL_TIMEOUT seconds when all REDIS_MAX_CONNECTIONS are in use. Idle
+# connections are checked every REDIS_HEALTH_CHECK_INTERVAL seconds before reuse.
+REDIS_MAX_CONNECTIONS = int(os.environ.get("REDIS_MAX_CONNECTIONS", "20"))
+REDIS_POOL_TIMEOUT = 5
+REDIS_HEALTH_CHECK_INTERVAL = 30
+
 # Celery settings
 CELERY_BROKER_URL = "redis://redis:6379/0"
 CELERY_RESULT_BACKEND = "redis://redis:6379/0"
+CELERY_BROKER_POOL_LIMIT = 10
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    "max_connections": REDIS_MAX_CONNECTIONS,
+    "health_check_interval": REDIS_HEALTH_CHECK_INTERVAL,
+}
+CELERY_REDIS_MAX_CONNECTIONS = REDIS_MAX_CONNECTIONS
 
-CELERY_ACCEPT_CONTENT = ["json"]
+# The image tasks are sent in the binary upload envelope (imageupload/envelope.py).
+CELERY_ACCEPT_CONTENT = ["json", "application/x-upload-envelope"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = "UTC"
-
-# Celery instance creation
-celery_app = Celery("django_server", broker=CELERY_BROKER_URL)
-celery_app.config_from_object("django.conf:settings", namespace="CELERY")
-celery_app.autodiscover_tasks()
+CELERY_BEAT_SCHEDULE = {
+    "sweep-stuck-uploads": {
+        "task": "imageupload.tasks.sweep_stuck_uploads",
+        "schedule": 60.0,
+    },
+}
+# Used by "celery worker --autoscale=<max>,<min>" (see imageupload/scaling.py).
+CELERY_WORKER_AUTOSCALER = "imageupload.scaling:LatencyAutoscaler"
+# Prefork children whose resident memory exceeds this many KiB are replaced
+# after their current task; batch tasks hand their remaining images to a new
+# task once over it (see imageupload/memory.py).
+CELERY_WORKER_MAX_MEMORY_PER_CHILD = 1024 * 1024
+
+# Images with more pixels than this are rejected before they are decoded.
+IMAGE_MAX_PIXELS = 64 * 1024 * 1024
+
+# Worker processes on a host only decode images while the estimated memory of
+# all images being processed on the host stays under WORKER_MEMORY_BUDGET
+# bytes, waiting up to WORKER_MEMORY_WAIT seconds for room. Images that get
+# none, or whose host budget cannot be read from Redis, are retried after
+# WORKER_MEMORY_RETRY_DELAY seconds, up to WORKER_MEMORY_RETRIES times.
+WORKER_MEMORY_BUDGET = int(os.environ.get("WORKER_MEMORY_BUDGET", str(2 * 1024 ** 3)))
+WORKER_MEMORY_WAIT = 120
+WORKER_MEMORY_RETRY_DELAY = 30
+WORKER_MEMORY_RETRIES = 5
+
+# Batch uploads are split into tasks of at most this many bytes of image
+# data, since a task's message stays in memory until the task finishes.
+BATCH_TASK_MAX_BYTES = 64 * 1024 * 1024
+
+# Images whose worker has made no progress for UPLOAD_STUCK_AFTER seconds, or
+# still queued UPLOAD_QUEUED_STUCK_AFTER seconds after upload, are marked as
+# errored by the sweep_stuck_uploads task, UPLOAD_SWEEP_BATCH per run. Batch
+# tasks refresh the progress of their remaining images every
+# UPLOAD_HEARTBEAT_INTERVAL seconds.
+UPLOAD_STUCK_AFTER = 30 * 60
+UPLOAD_QUEUED_STUCK_AFTER = 24 * 60 * 60
+UPLOAD_HEARTBEAT_INTERVAL = 60
+UPLOAD_SWEEP_BATCH = 1000
+
+# Retention applied by "manage.py apply_retention": images older than the given
+# number of days are purged with their files, except for the statuses in
+# UPLOAD_ARCHIVE_STATUSES, which are moved to the images_archive table.
+UPLOAD_RETENTION_DAYS = {
+    "error": 7,
+    "aborted": 7,
+    "completed": 90,
+}
+UPLOAD_ARCHIVE_STATUSES = ("completed",)
+
+# The autoscaler sizes the worker pool so the images pending or processing
+# finish within SCALING_TARGET_LATENCY seconds, from the queue depth and age of
+# SCALING_QUEUES and the average time of the last SCALING_SAMPLE_SIZE images,
+# split across the workers that sent a heartbeat within SCALING_WORKER_TTL
+# seconds (Celery checks the pool size at least every 30 seconds).
+SCALING_QUEUES = ("celery",)
+SCALING_TARGET_LATENCY = 30.0
+SCALING_SAMPLE_SIZE = 200
+SCALING_REFRESH_INTERVAL = 5.0
+SCALING_WORKER_TTL = 90.0
+
+# Metadata of processed images: "strip" keeps only the ICC colour profile,
+# "keep" also carries over the EXIF data (with the orientation already applied).
+IMAGE_METADATA_POLICY = "strip"
+
+# Closest matches returned per near-duplicate lookup.
+SIMILAR_MAX_RESULTS = 1000
+
+# Renditions served by /api/images/<id>/render (imageupload/renditions.py).
+# Requested widths and qualities are snapped up to these values; the first
+# format is the default.
+RENDER_WIDTHS = [64, 160, 320, 640, 1024, 1500]
+RENDER_FORMATS = {"webp": "WebP", "jpeg": "JPEG", "jpg": "JPEG", "png": "PNG"}
+RENDER_QUALITIES = [50, 75, 90]
+RENDER_DEFAULT_QUALITY = 75
+RENDER_CACHE_DIR = os.path.join(BASE_DIR, "render_cache")
+RENDER_CACHE_MAX_BYTES = 512 * 1024 * 1024
+RENDER_CACHE_SWEEP_INTERVAL = 60
+RENDER_LOCK_TIMEOUT = 30
+# Lock files renditions are hashed to; renditions sharing one wait on each other.
+RENDER_LOCK_STRIPES = 256
+
+# Rows inserted per query by the streaming batch upload endpoint. Parts are
+# held in memory until their rows are inserted and their tasks enqueued.
+STREAMING_UPLOAD_COMMIT_EVERY = 4
+
+# Files accepted per multipart request by the batch upload endpoints (Django
+# defaults to 100). The streaming endpoint counts every part, images or not;
+# past this the rest of the request is rejected.
+DATA_UPLOAD_MAX_NUMBER_FILES = int(os.environ.get("DATA_UPLOAD_MAX_NUMBER_FILES", "1000"))
+
+# Redis used directly by the app (upload event log)
+REDIS_URL = "redis://redis:6379/0"
 
 
 # Quick-start development settings - unsuitable for production
@@ -64,6 +166,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so the latency and status of every request are recorded, including
+    # responses produced by the middleware below it.
+    "imageupload.middleware.RequestMetricsMiddleware",
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -71,19 +176,35 @@ MIDDLEWARE = [
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
-    "django.contrib.messages.middleware.MessageMiddleware"
+    "django.contrib.messages.middleware.MessageMiddleware",
+    "imageupload.middleware.RequestProfilingMiddleware",
 ]
 
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
-            "hosts": [("redis", 6379)],
+            "hosts": [
+            {"address": "redis://redis:6379/0", "health_check_interval": REDIS_HEALTH_CHECK_INTERVAL},
+        ],
              "capacity": 1500, 
         },
     },
 }
 
+# Compact WebSocket clients receive events coalesced over this window (seconds),
+# with at most WEBSOCKET_SEND_BUFFER jobs pending per connection.
+WEBSOCKET_COALESCE_WINDOW = 0.05
+WEBSOCKET_SEND_BUFFER = 256
+
+# Each upload job keeps its newest UPLOAD_EVENT_LOG_MAXLEN notifications for
+# UPLOAD_EVENT_LOG_TTL seconds so reconnecting clients can resume.
+UPLOAD_EVENT_LOG_MAXLEN = 1000
+UPLOAD_EVENT_LOG_TTL = 24 * 60 * 60
+
+# A cancelled job's flag, checked by its tasks between images, is kept this long.
+UPLOAD_CANCEL_FLAG_TTL = 24 * 60 * 60
+
 ROOT_URLCONF = "django_server.urls"
 
 TEMPLATES = [
@@ -141,11 +262,45 @@ DATABASES = {
         "NAME": "image-db",
         "USER": "admin",
         "PASSWORD": "admin",
-        "HOST": "db",
-        "PORT": "5432",
+        "HOST": os.environ.get("DATABASE_HOST", "db"),
+        "PORT": os.environ.get("DATABASE_PORT", "5432"),
+        # Kept open for this many seconds and checked before reuse. Under ASGI
+        # every request runs its queries in a new thread, so the web process
+        # keeps the default of 0 and relies on PgBouncer for pooling.
+        "CONN_MAX_AGE": int(os.environ.get("DATABASE_CONN_MAX_AGE", "0")),
+        "CONN_HEALTH_CHECKS": True,
+        # Server-side cursors do not survive PgBouncer's transaction pooling.
+        "DISABLE_SERVER_SIDE_CURSORS": True,
     }
 }
 
+# Read PgBouncer's SHOW POOLS on /metrics when the database is reached through it.
+DATABASE_POOL_STATS = bool(os.environ.get("DATABASE_POOL_STATS"))
+
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://redis:6379/1",
+        "OPTIONS": {
+            "pool_class": "redis.BlockingConnectionPool",
+            "max_connections": REDIS_MAX_CONNECTIONS,
+            "timeout": REDIS_POOL_TIMEOUT,
+            "health_check_interval": REDIS_HEALTH_CHECK_INTERVAL,
+        },
+    }
+}
+
+# Serialized ListView pages are cached per process, up to LIST_CACHE_MAX_BYTES
+# in total; pages over LIST_CACHE_MAX_ENTRY_BYTES are not cached. The generation
+# counter used for invalidation lives in the shared cache below.
+LIST_CACHE_ALIAS = "default"
+LIST_CACHE_MAX_BYTES = 32 * 1024 * 1024
+LIST_CACHE_MAX_ENTRY_BYTES = 4 * 1024 * 1024
+LIST_MAX_PAGE_SIZE = 500
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -191,3 +346,66 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
+
+# Media goes to MEDIA_ROOT unless MEDIA_S3_BUCKET names a bucket on an
+# S3-compatible service (e.g. the "s3" MinIO profile in docker-compose).
+STORAGES = {
+    "default": {
+        "BACKEND": "imageupload.storage.ShardedFileSystemStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage",
+    },
+}
+if os.environ.get("MEDIA_S3_BUCKET"):
+    STORAGES["default"] = {
+        "BACKEND": "storages.backends.s3.S3Storage",
+        "OPTIONS": {
+            "bucket_name": os.environ["MEDIA_S3_BUCKET"],
+            "endpoint_url": os.environ.get("MEDIA_S3_ENDPOINT_URL"),
+            "access_key": os.environ.get("MEDIA_S3_ACCESS_KEY"),
+            "secret_key": os.environ.get("MEDIA_S3_SECRET_KEY"),
+            "custom_domain": os.environ.get("MEDIA_S3_CUSTOM_DOMAIN"),
+            "url_protocol": os.environ.get("MEDIA_S3_URL_PROTOCOL", "https:"),
+            # Image names are unique per row; skip the HEAD probe for a free name.
+            "file_overwrite": True,
+        },
+    }
+
+# Batch tasks write processed images through a background pool of
+# MEDIA_WRITE_WORKERS threads, blocking once MEDIA_WRITE_MAX_PENDING writes are
+# queued; single-image uploads write directly.
+MEDIA_WRITE_WORKERS = 4
+MEDIA_WRITE_MAX_PENDING = 16
+
+# /metrics requires "Authorization: Bearer <METRICS_TOKEN>" when METRICS_TOKEN is
+# set; without one it is only served with DEBUG on.
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+# Profiling
+# Requests sending "X-Profile: 1" are profiled when PROFILE_ALLOW_HEADER is set,
+# along with the tasks they enqueue. PROFILE_TASK_SAMPLE_RATE is the fraction of
+# other image task runs that are profiled.
+
+PROFILE_DIR = os.path.join(BASE_DIR, "profiles")
+PROFILE_ALLOW_HEADER = DEBUG
+PROFILE_TASK_SAMPLE_RATE = float(os.environ.get("PROFILE_TASK_SAMPLE_RATE", "0"))
+PROFILE_TRACEMALLOC = True
+PROFILE_TOP_ALLOCATIONS = 25
+
+# Tracing
+# A TRACE_SAMPLE_RATE fraction of upload requests (none by default) is traced
+# through the broker, the workers and the WebSocket consumers. Each process
+# writes its spans from a background thread as OTLP/JSON lines to TRACE_DIR,
+# tagged with TRACE_SERVICE_NAME, flushing every TRACE_FLUSH_INTERVAL seconds
+# and dropping spans while TRACE_QUEUE_SIZE are waiting. Files are rotated at
+# TRACE_FILE_MAX_BYTES; the oldest are deleted beyond TRACE_MAX_BYTES in total.
+
+TRACE_ENABLED = os.environ.get("TRACE_ENABLED", "1") != "0"
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0"))
+TRACE_DIR = os.environ.get("TRACE_DIR", os.path.join(BASE_DIR, "traces"))
+TRACE_SERVICE_NAME = os.environ.get("OTEL_SERVICE_NAME", "imageupload")
+TRACE_FLUSH_INTERVAL = 1.0
+TRACE_QUEUE_SIZE = 10000
+TRACE_FILE_MAX_BYTES = 16 * 1024 * 1024
+TRACE_MAX_BYTES = 256 * 1024 * 1024
@@ -19,14 +19,31 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.urls import path
 from django.contrib import admin
-from imageupload.views import BatchAsyncUploadImageView, AsyncUploadImageView, UploadImageView, ListView
+from imageupload.metrics import metrics_view
+from imageupload.views import (
+    BatchAsyncUploadImageView,
+    AsyncUploadImageView,
+    CancelJobView,
+    JobStatusView,
+    SimilarImagesView,
+    StreamingBatchUploadImageView,
+    UploadImageView,
+    ListView,
+    RenderImageView,
+)
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/upload", UploadImageView.as_view(), name="upload-image"),
     path("api/async/upload", AsyncUploadImageView.as_view(), name="async-upload-image"),
     path("api/async/batch/upload", BatchAsyncUploadImageView.as_view(), name="async-batch-upload-image"),
+    path("api/stream/batch/upload", StreamingBatchUploadImageView.as_view(), name="stream-batch-upload-image"),
     path("api/list", ListView.as_view(), name="list-images"),
+    path("api/images/<uuid:image_id>/similar", SimilarImagesView.as_view(), name="similar-images"),
+    path("api/images/<uuid:image_id>/render", RenderImageView.as_view(), name="render-image"),
+    path("api/jobs/<str:job_id>/status", JobStatusView.as_view(), name="job-status"),
+    path("api/jobs/<str:job_id>/cancel", CancelJobView.as_view(), name="cancel-job"),
+    path("metrics", metrics_view, name="metrics"),
 ]
 
 # Serve media files during development
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ImageuploadConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "imageupload"
+
+    def ready(self):
+        # Connect the Celery signal handlers recording image task durations and trace spans.
+        from . import scaling, tracing  # noqa: F401
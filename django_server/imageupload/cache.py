@@ -0,0 +1,110 @@
+# cache.py
+"""
+Cache of serialized ListView pages.
+
+Rendered pages are kept in a process-local LRU bounded by their total size
+in bytes, so the hot "newest uploads" page is served straight from memory. Every entry is tagged
+with a generation number held in the shared Django cache (Redis). Code that
+creates ImageUpload rows or changes their status calls
+``invalidate_list_cache`` which bumps the generation, so stale pages in every
+web process stop matching at once without any cross-process messaging.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = "imageupload:list:generation"
+
+
+class ListPageCache:
+    """
+    Thread-safe LRU cache bounded by the total size of its values.
+
+    Attributes:
+        max_bytes (int): Total size of the pages kept before the least
+            recently used ones are evicted.
+        max_entry_bytes (int): Pages larger than this, such as a large
+            unpaginated list, are not cached, so one of them cannot evict
+            every other page.
+    """
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: bytes) -> None:
+        if len(value) > self.max_entry_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+            self._entries[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+list_page_cache = ListPageCache(settings.LIST_CACHE_MAX_BYTES, settings.LIST_CACHE_MAX_ENTRY_BYTES)
+
+
+def current_generation() -> Optional[int]:
+    """
+    Return the current list generation from the shared cache.
+
+    The counter is seeded with a timestamp rather than zero so that pages
+    cached before a Redis restart can never match a freshly seeded value.
+
+    Returns:
+        Optional[int]: The generation, or None if the shared cache is unreachable,
+        in which case callers should bypass the page cache.
+    """
+    cache = caches[settings.LIST_CACHE_ALIAS]
+    try:
+        generation = cache.get(GENERATION_KEY)
+        if generation is None:
+            cache.add(GENERATION_KEY, time.time_ns(), timeout=None)
+            generation = cache.get(GENERATION_KEY)
+        return generation
+    except Exception as e:
+        logger.warning(f"List cache generation unavailable: {e}")
+        return None
+
+
+def invalidate_list_cache() -> None:
+    """
+    Invalidate all cached list pages in every process.
+
+    Must be called whenever ImageUpload rows are created or change status.
+    """
+    cache = caches[settings.LIST_CACHE_ALIAS]
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        # Key missing: seeding a fresh generation invalidates just the same.
+        cache.add(GENERATION_KEY, time.time_ns(), timeout=None)
+    except Exception as e:
+        logger.warning(f"List cache invalidation failed: {e}")
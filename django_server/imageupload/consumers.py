@@ -1,5 +1,16 @@
+import asyncio
 import json
+from collections import OrderedDict
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from .events import events_since
+from .jobs import cancel_job, job_status
+from .metrics import WEBSOCKET_CONNECTIONS
+from .notifications import UPLOAD_GROUP
+from .protocol import SUBPROTOCOL_MSGPACK, TERMINAL_STATUSES, encode_frame, negotiate_subprotocol
+from .tracing import record_delivery
 
 class UploadConsumer(AsyncWebsocketConsumer):
     """
@@ -8,8 +19,16 @@ class UploadConsumer(AsyncWebsocketConsumer):
     This consumer manages WebSocket connections for the image upload process,
     allowing real-time communication between the server and clients.
 
+    Clients that negotiate one of the compact subprotocols (see protocol.py)
+    receive coalesced frames: events arriving within WEBSOCKET_COALESCE_WINDOW
+    seconds are merged per job and sent as a single frame. The pending buffer
+    holds at most WEBSOCKET_SEND_BUFFER jobs; when a slow client lets it fill
+    up, intermediate 'processing' events are dropped before any terminal one.
+
     Attributes:
         group_name (str): The name of the channel group for broadcast messages.
+        subprotocol (Optional[str]): The negotiated compact subprotocol, or None
+            for the verbose JSON protocol.
     """
 
     async def connect(self):
@@ -19,18 +38,23 @@ class UploadConsumer(AsyncWebsocketConsumer):
         This method is called when a new WebSocket connection is established.
         It adds the connection to the 'upload_group' and sends a connection confirmation.
         """
-        self.group_name = 'upload_group'
+        self.group_name = UPLOAD_GROUP
+        self.subprotocol = negotiate_subprotocol(self.scope.get('subprotocols', []))
+        self.pending_events = OrderedDict()
+        self.flush_task = None
         # Join upload group
         await self.channel_layer.group_add(
             self.group_name,
             self.channel_name
         )
 
-        await self.accept()
-        await self.send(text_data=json.dumps({
-            'message': 'You are connected!',
-            'status': 'ok'
-        }))
+        await self.accept(subprotocol=self.subprotocol)
+        WEBSOCKET_CONNECTIONS.inc()
+        if self.subprotocol is None:
+            await self.send(text_data=json.dumps({
+                'message': 'You are connected!',
+                'status': 'ok'
+            }))
 
     async def disconnect(self, close_code):
         """
@@ -42,48 +66,178 @@ class UploadConsumer(AsyncWebsocketConsumer):
         Args:
             close_code (int): The code indicating why the connection was closed.
         """
+        if self.flush_task is not None:
+            self.flush_task.cancel()
         # Leave upload group
         await self.channel_layer.group_discard(
             self.group_name,
             self.channel_name
         )
+        WEBSOCKET_CONNECTIONS.dec()
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """
         Handle incoming WebSocket messages.
 
-        This method processes messages received from the client and echoes them back.
+        Messages with an ``action`` are requests from the client:
+            - ``{"action": "resume", "job_id": ..., "since": N}`` replays the
+              job's logged events with a sequence number above N.
+            - ``{"action": "status", "job_id": ...}`` returns the job's status
+              counts and newest sequence number.
+            - ``{"action": "cancel", "job_id": ...}`` cancels the job's
+              unfinished images and returns how many were aborted.
+        Any other message is echoed back.
 
         Args:
             text_data (str): The JSON-encoded message from the client.
+            bytes_data (bytes): The JSON-encoded message, if sent as a binary frame.
         """
-        text_data_json = json.loads(text_data)
+        text_data_json = json.loads(text_data if text_data is not None else bytes_data)
+        action = text_data_json.get('action')
+        if action == 'resume':
+            await self.resume(text_data_json)
+            return
+        if action == 'status':
+            status = await database_sync_to_async(job_status)(str(text_data_json.get('job_id', '')))
+            await self.send(text_data=json.dumps({'action': 'status', **status}))
+            return
+        if action == 'cancel':
+            job_id = str(text_data_json.get('job_id', ''))
+            result = await database_sync_to_async(cancel_job)(job_id)
+            if result is None:
+                await self.send(text_data=json.dumps({'action': 'cancel', 'job_id': job_id, 'error': 'Job not found'}))
+                return
+            await self.send(text_data=json.dumps({'action': 'cancel', **result}))
+            return
+
         message = text_data_json['message']
         await self.send(text_data=json.dumps({
             'message': message
         }))
-        
+
+    async def resume(self, request):
+        """
+        Replay the events a reconnecting client missed for one job.
+
+        Args:
+            request (dict): The client message with ``job_id`` and ``since``.
+        """
+        job_id = str(request.get('job_id', ''))
+        try:
+            since = int(request.get('since', 0))
+        except (TypeError, ValueError):
+            await self.send(text_data=json.dumps({'error': 'since must be an integer'}))
+            return
+
+        try:
+            events = await sync_to_async(events_since)(job_id, since)
+        except Exception as e:
+            await self.send(text_data=json.dumps({'error': f'Event log unavailable: {e}'}))
+            return
+        if self.subprotocol is not None:
+            if events:
+                await self.send_frame(encode_frame(events, self.subprotocol))
+            return
+        for event in events:
+            await self.send(text_data=json.dumps(self.verbose_event(event)))
+
     async def send_upload_notification(self, event):
         """
         Send upload notifications to the client.
 
         This method is called to send status updates about image uploads to the client.
+        The delivery of traced events is recorded once they are sent.
 
         Args:
             event (dict): A dictionary containing notification details.
         """
+        if self.subprotocol is not None:
+            await self.buffer_event(event)
+            return
+
+        await self.send(text_data=json.dumps(self.verbose_event(event)))
+        record_delivery(event)
+
+    @staticmethod
+    def verbose_event(event):
+        """
+        Build the verbose JSON notification sent to clients without a subprotocol.
+
+        Args:
+            event (dict): A live or replayed notification event.
+        """
         data = {
             'name': event['name'],
             'size': event['size'],
             'job_id': event['job_id'],
             'status': event['status'],
             'message': event['message'],
-            'type': event['type'],
+            'type': 'send_upload_notification',
         }
-        
+
         if 'image' in event and event['image']:
             data['image'] = event['image']
+        if 'image_url' in event and event['image_url']:
+            data['image_url'] = event['image_url']
         if 'upload_time' in event and event['upload_time']:
             data['upload_time'] = event['upload_time']
-       
-        await self.send(text_data=json.dumps(data))
+        if 'seq' in event:
+            data['seq'] = event['seq']
+
+        return data
+
+    async def buffer_event(self, event):
+        """
+        Queue an event for the next coalesced frame.
+
+        A newer event for a job replaces the pending one, since its status
+        supersedes it. If the buffer is full, the oldest non-terminal event is
+        dropped; if every pending event is terminal the buffer is flushed now.
+
+        Args:
+            event (dict): A dictionary containing notification details.
+        """
+        self.pending_events.pop(event['job_id'], None)
+        self.pending_events[event['job_id']] = event
+
+        if len(self.pending_events) > settings.WEBSOCKET_SEND_BUFFER:
+            droppable = next(
+                (job_id for job_id, pending in self.pending_events.items()
+                 if pending['status'] not in TERMINAL_STATUSES),
+                None
+            )
+            if droppable is not None:
+                del self.pending_events[droppable]
+            else:
+                await self.flush_events()
+                return
+
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush_after_window())
+
+    async def flush_after_window(self):
+        await asyncio.sleep(settings.WEBSOCKET_COALESCE_WINDOW)
+        self.flush_task = None
+        await self.flush_events()
+
+    async def flush_events(self):
+        """
+        Send every pending event as a single compact frame.
+        """
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        if not self.pending_events:
+            return
+        events = list(self.pending_events.values())
+        self.pending_events.clear()
+
+        await self.send_frame(encode_frame(events, self.subprotocol))
+        for event in events:
+            record_delivery(event, coalesced=len(events), subprotocol=self.subprotocol)
+
+    async def send_frame(self, frame):
+        if self.subprotocol == SUBPROTOCOL_MSGPACK:
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
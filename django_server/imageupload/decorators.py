@@ -1,4 +1,5 @@
 # decorators.py
+import asyncio
 import mimetypes
 from rest_framework.response import Response
 from rest_framework import status
@@ -6,6 +7,7 @@ from functools import wraps
 from typing import Callable, Awaitable
 from django.http import HttpRequest
 from rest_framework.request import Request
+from .tracing import start_trace
 
 def validate_image_in_request(func: Callable[..., Response]) -> Callable[..., Response]:
     """
@@ -101,3 +103,38 @@ def validate_image_file_type(func: Callable[..., Response]) -> Callable[..., Res
         return func(self, request, *args, **kwargs)
     return wrapper
 
+def trace_upload_request(func: Callable[..., Response]) -> Callable[..., Response]:
+    """
+    Decorator starting an upload's trace around a sync or async view.
+
+    The tasks published by the view carry the trace to the workers. Traced
+    responses name their trace in the ``X-Trace-Id`` header, and the root
+    span is tagged with the ``job_id`` of the response.
+
+    Args:
+        func (Callable[..., Response]): The view function to be decorated.
+
+    Returns:
+        Callable[..., Response]: The wrapped function, async if ``func`` is.
+    """
+    def annotate(root, request, response: Response) -> Response:
+        if root is not None:
+            root.set_attribute("http.route", request.path)
+            root.set_attribute("http.status_code", response.status_code)
+            if isinstance(getattr(response, "data", None), dict):
+                root.set_attribute("job_id", response.data.get("job_id"))
+            response["X-Trace-Id"] = root.context.trace_id
+        return response
+
+    if asyncio.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(self, request: Request, *args, **kwargs) -> Response:
+            with start_trace("upload.request") as root:
+                return annotate(root, request, await func(self, request, *args, **kwargs))
+        return async_wrapper
+
+    @wraps(func)
+    def wrapper(self, request: HttpRequest, *args, **kwargs) -> Response:
+        with start_trace("upload.request") as root:
+            return annotate(root, request, func(self, request, *args, **kwargs))
+    return wrapper
@@ -0,0 +1,136 @@
+# envelope.py
+"""
+Binary task envelope for the image processing tasks.
+
+Celery's JSON serializer has to encode raw image bytes as text, which
+inflates every upload and costs CPU in the web process and the worker.
+The image tasks are published with the ``upload-envelope`` serializer
+instead. A message body is laid out as::
+
+    MAGIC | header length (uint32, big endian) | msgpack header | blobs
+
+The header is the task body (args, kwargs, embed) with every ImagePayload
+replaced by a typed reference (id, name, size, mime, crc32, offset,
+length) and any other ``bytes`` by a bare (offset, length) reference into
+the blob section that follows it. Decoding slices the received message
+with memoryview: each decoded ImagePayload.content is a view into the
+message, which processing.open_image reads in place rather than copying
+it into an ``io.BytesIO`` first.
+"""
+import struct
+import zlib
+from typing import List, NamedTuple, Union
+
+import msgpack
+from kombu.serialization import register
+
+SERIALIZER = "upload-envelope"
+CONTENT_TYPE = "application/x-upload-envelope"
+
+MAGIC = b"UE\x01"
+HEADER_LENGTH = struct.Struct(">I")
+PREFIX_SIZE = len(MAGIC) + HEADER_LENGTH.size
+
+# msgpack extension type codes of the header references.
+IMAGE_EXT = 1
+BLOB_EXT = 2
+
+
+class ImagePayload(NamedTuple):
+    """
+    One image handed to a processing task.
+
+    Attributes:
+        id (str): The id of the ImageUpload row.
+        name (str): The original filename.
+        size (int): Size of the uploaded file in bytes.
+        mime (str): The MIME type of the upload.
+        content (Union[bytes, memoryview]): The raw image data; a view into
+            the task message once decoded by a worker.
+        checksum (int): CRC-32 of ``content``, verified when decoding.
+    """
+    id: str
+    name: str
+    size: int
+    mime: str
+    content: Union[bytes, memoryview]
+    checksum: int = 0
+
+    @classmethod
+    def build(cls, image_instance_id, name: str, size: int, mime: str, content: bytes) -> "ImagePayload":
+        """
+        Create a payload for ``content``, computing its checksum.
+        """
+        return cls(str(image_instance_id), name, size, mime, content, zlib.crc32(content))
+
+
+def dumps(body) -> bytes:
+    """
+    Encode a task body as an upload envelope.
+    """
+    blobs: List[Union[bytes, memoryview]] = []
+    offset = 0
+
+    def add_blob(content) -> tuple:
+        nonlocal offset
+        start = offset
+        blobs.append(content)
+        offset += len(content)
+        return start, len(content)
+
+    def reference(value):
+        if isinstance(value, ImagePayload):
+            start, length = add_blob(value.content)
+            fields = [value.id, value.name, value.size, value.mime, value.checksum, start, length]
+            return msgpack.ExtType(IMAGE_EXT, msgpack.packb(fields, use_bin_type=True))
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return msgpack.ExtType(BLOB_EXT, msgpack.packb(add_blob(value)))
+        if isinstance(value, (list, tuple)):
+            return [reference(item) for item in value]
+        if isinstance(value, dict):
+            return {key: reference(item) for key, item in value.items()}
+        return value
+
+    header = msgpack.packb(reference(body), use_bin_type=True)
+    return b"".join([MAGIC, HEADER_LENGTH.pack(len(header)), header, *blobs])
+
+
+def loads(data):
+    """
+    Decode an upload envelope, returning views into ``data`` for its blobs.
+
+    Raises:
+        ValueError: If the envelope is malformed or an image fails its checksum.
+    """
+    view = memoryview(data)
+    if bytes(view[:len(MAGIC)]) != MAGIC:
+        raise ValueError("Not an upload envelope")
+    (header_length,) = HEADER_LENGTH.unpack_from(view, len(MAGIC))
+    blobs = view[PREFIX_SIZE + header_length:]
+
+    def blob(start: int, length: int) -> memoryview:
+        if start + length > len(blobs):
+            raise ValueError("Upload envelope blob out of range")
+        return blobs[start:start + length]
+
+    def ext_hook(code: int, payload: bytes):
+        fields = msgpack.unpackb(payload, raw=False)
+        if code == IMAGE_EXT:
+            image_id, name, size, mime, checksum, start, length = fields
+            content = blob(start, length)
+            if zlib.crc32(content) != checksum:
+                raise ValueError(f"Checksum mismatch for image {image_id}")
+            return ImagePayload(image_id, name, size, mime, content, checksum)
+        if code == BLOB_EXT:
+            return blob(*fields)
+        return msgpack.ExtType(code, payload)
+
+    return msgpack.unpackb(
+        view[PREFIX_SIZE:PREFIX_SIZE + header_length],
+        ext_hook=ext_hook,
+        raw=False,
+        strict_map_key=False,
+    )
+
+
+register(SERIALIZER, dumps, loads, content_type=CONTENT_TYPE, content_encoding="binary")
@@ -0,0 +1,96 @@
+# events.py
+"""
+Bounded, replayable log of upload notifications per job.
+
+Every notification is appended to a Redis sorted set keyed by its job and
+scored by a per-job sequence number, so a reconnecting WebSocket client can
+fetch exactly the events it missed. The log keeps the newest
+UPLOAD_EVENT_LOG_MAXLEN events per job and expires UPLOAD_EVENT_LOG_TTL
+seconds after the last event. Processed image payloads are not logged;
+replayed 'completed' events carry ``image_url`` instead.
+"""
+import json
+from typing import Dict, List, Optional
+
+from django.conf import settings
+
+from .redis_client import get_redis
+
+EVENT_LOG_KEY = "upload:events:{job_id}"
+EVENT_SEQ_KEY = "upload:events:{job_id}:seq"
+UUID_LENGTH = 36
+
+# Allocates the next sequence number and appends the event in one round trip.
+# Members are prefixed with their sequence number to keep them unique.
+APPEND_SCRIPT = """
+local seq = redis.call('INCR', KEYS[2])
+redis.call('ZADD', KEYS[1], seq, seq .. '|' .. ARGV[1])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[2]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return seq
+"""
+
+
+def parent_job_id(job_id: str) -> str:
+    """
+    Return the upload request a per-image job id belongs to.
+
+    Images uploaded together share a uuid4 job id suffixed with their index,
+    e.g. ``<uuid>-3``.
+    """
+    return job_id[:UUID_LENGTH]
+
+
+def append_event(event: Dict) -> int:
+    """
+    Append a notification to its job's event log.
+
+    Args:
+        event (dict): The notification; the ``image`` payload and ``trace`` context are left out.
+
+    Returns:
+        int: The sequence number assigned to the event within its job.
+    """
+    job_id = parent_job_id(event['job_id'])
+    logged = {key: value for key, value in event.items() if key not in ('image', 'trace')}
+    client = get_redis()
+    return client.eval(
+        APPEND_SCRIPT,
+        2,
+        EVENT_LOG_KEY.format(job_id=job_id),
+        EVENT_SEQ_KEY.format(job_id=job_id),
+        json.dumps(logged),
+        settings.UPLOAD_EVENT_LOG_MAXLEN,
+        settings.UPLOAD_EVENT_LOG_TTL,
+    )
+
+
+def events_since(job_id: str, since: int) -> List[Dict]:
+    """
+    Return the logged events of a job with a sequence number above ``since``.
+
+    Args:
+        job_id (str): The upload job id.
+        since (int): The last sequence number the client has seen.
+
+    Returns:
+        List[dict]: Events in sequence order, each including its ``seq``.
+    """
+    client = get_redis()
+    members = client.zrangebyscore(EVENT_LOG_KEY.format(job_id=job_id), f"({since}", "+inf")
+    events = []
+    for member in members:
+        seq, _, payload = member.decode().partition('|')
+        event = json.loads(payload)
+        event['seq'] = int(seq)
+        events.append(event)
+    return events
+
+
+def last_sequence(job_id: str) -> Optional[int]:
+    """
+    Return the sequence number of the newest event logged for a job.
+    """
+    value = get_redis().get(EVENT_SEQ_KEY.format(job_id=job_id))
+    return int(value) if value is not None else None
@@ -0,0 +1,126 @@
+# jobs.py
+import logging
+import uuid
+from typing import Dict, Optional
+
+from celery import current_app
+from django.conf import settings
+from django.db.models import Count
+from django.utils import timezone
+
+from .cache import invalidate_list_cache
+from .events import last_sequence
+from .models import ImageUpload, UploadJob
+from .notifications import send_upload_notification
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+CANCEL_FLAG_KEY = "upload:cancelled:{job_id}"
+
+
+def job_status(job_id: str) -> Dict:
+    """
+    Summarise the processing state of every image in an upload job.
+
+    Args:
+        job_id (str): The job id returned when the upload was initiated.
+
+    Returns:
+        dict: The job id, the number of images per status, the total and the
+        newest event sequence number (``seq``) to resume notifications from.
+    """
+    try:
+        upload_job = uuid.UUID(job_id)
+    except ValueError:
+        return {'job_id': job_id, 'total': 0, 'counts': {}, 'seq': None}
+
+    # Answered from images_job_status_idx without touching the table.
+    rows = (
+        ImageUpload.objects
+        .filter(upload_job=upload_job)
+        .values('status')
+        .annotate(count=Count('status'))
+    )
+    counts = {row['status']: row['count'] for row in rows}
+    try:
+        seq = last_sequence(job_id)
+    except Exception as e:
+        logger.warning(f"Event log unavailable for job {job_id}: {e}")
+        seq = None
+    return {
+        'job_id': job_id,
+        'total': sum(counts.values()),
+        'counts': counts,
+        'seq': seq,
+    }
+
+
+def cancel_job(job_id: str) -> Optional[Dict]:
+    """
+    Cancel the images of an upload job that have not finished processing.
+
+    The job's cancellation flag is set first, so that running tasks stop
+    before their next image. The job's pending and processing images are
+    then marked 'aborted' and their clients notified, and the Celery tasks
+    holding them are revoked: workers discard revoked tasks still in the
+    queue instead of running them.
+
+    Args:
+        job_id (str): The job id returned when the upload was initiated.
+
+    Returns:
+        Optional[dict]: The job id, the number of images aborted and of tasks
+        revoked, or None if there is no such job.
+    """
+    try:
+        upload_job = uuid.UUID(job_id)
+    except ValueError:
+        return None
+    if not UploadJob.objects.filter(id=upload_job).exists():
+        return None
+
+    try:
+        get_redis().set(CANCEL_FLAG_KEY.format(job_id=job_id), 1, ex=settings.UPLOAD_CANCEL_FLAG_TTL)
+    except Exception as e:
+        # Tasks still find the rows aborted, only one image later.
+        logger.warning(f"Could not flag job {job_id} as cancelled: {e}")
+
+    active = ImageUpload.objects.filter(upload_job=upload_job, status__in=ImageUpload.ACTIVE_STATUSES)
+    active_ids = list(active.values_list('id', flat=True))
+    now = timezone.now()
+    # Re-checked in the update, so an image that finished meanwhile is kept.
+    aborted = active.filter(id__in=active_ids).update(status='aborted', finished_at=now)
+    invalidate_list_cache()
+
+    rows = list(
+        ImageUpload.objects.filter(id__in=active_ids, status='aborted', finished_at=now)
+        .values('name', 'size', 'job_id', 'task_id')
+    )
+    task_ids = sorted({row['task_id'] for row in rows if row['task_id']})
+    if task_ids:
+        try:
+            current_app.control.revoke(task_ids)
+        except Exception as e:
+            logger.warning(f"Could not revoke the tasks of job {job_id}: {e}")
+
+    for row in rows:
+        send_upload_notification(
+            name=row['name'],
+            size=row['size'],
+            job_id=str(row['job_id']),
+            status='aborted',
+            message=f"Image {row['name']} cancelled."
+        )
+    return {'job_id': job_id, 'aborted': aborted, 'revoked': len(task_ids)}
+
+
+def is_cancelled(job_id: str) -> bool:
+    """
+    Check the cancellation flag of an upload job; one Redis round trip.
+    """
+    try:
+        return bool(get_redis().exists(CANCEL_FLAG_KEY.format(job_id=job_id)))
+    except Exception as e:
+        logger.warning(f"Could not read the cancellation flag of job {job_id}: {e}")
+        return False
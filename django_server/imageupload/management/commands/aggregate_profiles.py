@@ -0,0 +1,60 @@
+import glob
+import io
+import json
+import os
+import pstats
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    """
+    Merge the profiles captured under PROFILE_DIR into a single report.
+
+    Prints the hottest functions across all matching ``.prof`` files and a
+    summary of the tracemalloc peaks recorded in their ``.json`` sidecars.
+    """
+    help = "Aggregate cProfile/tracemalloc captures written to PROFILE_DIR."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--kind", help="Only aggregate one kind, e.g. process_and_save_image or requests.")
+        parser.add_argument("--sort", default="cumulative", help="pstats sort key (default: cumulative).")
+        parser.add_argument("--limit", type=int, default=30, help="Number of functions to print.")
+        parser.add_argument("--output", help="Write the merged stats to this file for snakeviz/pstats.")
+
+    def handle(self, *args, **options):
+        pattern = os.path.join(settings.PROFILE_DIR, options["kind"] or "*", "*.prof")
+        profile_files = sorted(glob.glob(pattern))
+        if not profile_files:
+            raise CommandError(f"No profiles match {pattern}")
+
+        stream = io.StringIO()
+        stats = pstats.Stats(*profile_files, stream=stream)
+        stats.strip_dirs().sort_stats(options["sort"]).print_stats(options["limit"])
+        if options["output"]:
+            stats.dump_stats(options["output"])
+
+        elapsed = []
+        peaks = []
+        for profile_file in profile_files:
+            try:
+                with open(f"{profile_file[:-len('.prof')]}.json") as report_file:
+                    report = json.load(report_file)
+            except (OSError, ValueError):
+                continue
+            elapsed.append(report["elapsed"])
+            if "tracemalloc_peak" in report:
+                peaks.append(report["tracemalloc_peak"])
+
+        self.stdout.write(f"Profiles: {len(profile_files)}")
+        if elapsed:
+            self.stdout.write(
+                f"Elapsed: mean {sum(elapsed) / len(elapsed):.3f}s, max {max(elapsed):.3f}s"
+            )
+        if peaks:
+            self.stdout.write(
+                f"Traced memory peak: mean {sum(peaks) / len(peaks) / 2**20:.1f} MiB, "
+                f"max {max(peaks) / 2**20:.1f} MiB"
+            )
+        self.stdout.write(stream.getvalue())
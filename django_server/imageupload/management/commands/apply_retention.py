@@ -0,0 +1,99 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from imageupload.cache import invalidate_list_cache
+from imageupload.models import ImageUpload, ImageUploadArchive, UploadJob
+
+ARCHIVED_FIELDS = (
+    'id', 'image', 'uploaded_at', 'finished_at', 'upload_time', 'size',
+    'type', 'name', 'job_id', 'upload_job_id', 'status',
+    'width', 'height', 'format', 'orientation',
+)
+
+
+class Command(BaseCommand):
+    """
+    Apply UPLOAD_RETENTION_DAYS to the images table.
+
+    Expired rows are handled in small batches, each in its own short
+    transaction, with a pause in between so the hot table is never locked
+    for long. Rows with a status in UPLOAD_ARCHIVE_STATUSES are copied to
+    images_archive, keeping their files; all other expired rows are deleted
+    together with their files. Upload jobs left without images are removed.
+    """
+    help = "Purge or archive expired image uploads in throttled batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="Rows handled per transaction.")
+        parser.add_argument("--sleep", type=float, default=0.5, help="Seconds to pause between batches.")
+        parser.add_argument("--max-batches", type=int, help="Stop after this many batches.")
+        parser.add_argument("--dry-run", action="store_true", help="Only count the expired rows.")
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        batches = 0
+        for status, days in settings.UPLOAD_RETENTION_DAYS.items():
+            if status not in dict(ImageUpload.STATUS_CHOICES):
+                raise CommandError(f"Unknown status in UPLOAD_RETENTION_DAYS: {status}")
+            cutoff = now - timedelta(days=days)
+            expired = ImageUpload.objects.filter(status=status, uploaded_at__lt=cutoff)
+            archive = status in settings.UPLOAD_ARCHIVE_STATUSES
+
+            if options["dry_run"]:
+                action = "archive" if archive else "purge"
+                self.stdout.write(f"{status}: would {action} {expired.count()} rows older than {cutoff}")
+                continue
+
+            handled = 0
+            while options["max_batches"] is None or batches < options["max_batches"]:
+                batch = list(expired.order_by("uploaded_at").values(*ARCHIVED_FIELDS)[:options["batch_size"]])
+                if not batch:
+                    break
+                if archive:
+                    self.archive(batch)
+                else:
+                    self.purge(batch)
+                invalidate_list_cache()
+                handled += len(batch)
+                batches += 1
+                if len(batch) < options["batch_size"]:
+                    # A short batch was the last one; nothing is left to wait for.
+                    break
+                time.sleep(options["sleep"])
+
+            verb = "Archived" if archive else "Purged"
+            self.stdout.write(f"{status}: {verb} {handled} rows older than {cutoff}")
+
+        if not options["dry_run"]:
+            oldest_cutoff = now - timedelta(days=max(settings.UPLOAD_RETENTION_DAYS.values()))
+            removed, _ = UploadJob.objects.filter(images__isnull=True, created_at__lt=oldest_cutoff).delete()
+            self.stdout.write(self.style.SUCCESS(f"Removed {removed} empty upload jobs."))
+
+    @staticmethod
+    def archive(batch):
+        """
+        Copy a batch of rows to images_archive and remove them from images.
+        """
+        with transaction.atomic():
+            ImageUploadArchive.objects.bulk_create(
+                [ImageUploadArchive(**row) for row in batch],
+                ignore_conflicts=True,
+            )
+            ImageUpload.objects.filter(id__in=[row["id"] for row in batch]).delete()
+
+    @staticmethod
+    def purge(batch):
+        """
+        Delete a batch of rows, then their files once the deletion has committed.
+        """
+        image_names = [row["image"] for row in batch if row["image"]]
+        with transaction.atomic():
+            ImageUpload.objects.filter(id__in=[row["id"] for row in batch]).delete()
+        for name in image_names:
+            default_storage.delete(name)
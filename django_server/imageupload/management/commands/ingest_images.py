@@ -0,0 +1,208 @@
+import mimetypes
+import multiprocessing
+import os
+import time
+import uuid
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+
+from imageupload.cache import invalidate_list_cache
+from imageupload.models import ImageUpload, UploadJob
+from imageupload.previews import PREVIEW_FIELDS, annotate_previews
+from imageupload.processing import process_image
+
+MANIFEST_NAME = ".ingest_manifest"
+
+
+class IngestResult(NamedTuple):
+    """
+    Outcome of ingesting one file in a worker process.
+
+    Attributes:
+        rel_path (str): The path relative to the ingested directory, as recorded in the manifest.
+        image_id (UUID): The id of the ImageUpload row to create.
+        image_name (str): The storage name the processed image was saved under.
+        size (int): Size of the source file in bytes.
+        file_type (str): MIME type guessed from the file name.
+        output_size (int): Size of the processed image in bytes.
+        elapsed (float): Seconds spent reading, processing and writing the file.
+        metadata (dict): The processed image's ImageUpload metadata and preview fields.
+        error (str): The failure message, or None on success.
+    """
+    rel_path: str
+    image_id: uuid.UUID
+    image_name: str = ""
+    size: int = 0
+    file_type: str = ""
+    output_size: int = 0
+    elapsed: float = 0.0
+    metadata: Optional[Dict] = None
+    error: Optional[str] = None
+
+
+def ingest_file(task: Tuple[str, str, uuid.UUID]) -> IngestResult:
+    """
+    Read, process and store one file. Runs in a pool worker process.
+
+    Args:
+        task (tuple): The absolute path, the path recorded in the manifest and the row id.
+
+    Returns:
+        IngestResult: The stored image's metadata, or the error that prevented it.
+    """
+    path, rel_path, image_id = task
+    started = time.perf_counter()
+    file_name = os.path.basename(path)
+    file_type = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+    try:
+        with open(path, 'rb') as source:
+            image_bytes = source.read()
+        processed = process_image(image_bytes, file_name, file_type, thumbnail=True)
+        image_instance = ImageUpload(id=image_id)
+        annotate_previews([(image_instance, processed.thumbnail)])
+        image_name = default_storage.save(
+            image_instance.image.field.generate_filename(image_instance, f"ingested.{processed.extension}"),
+            ContentFile(processed.content),
+        )
+    except Exception as e:
+        return IngestResult(rel_path, image_id, error=str(e))
+    metadata = {
+        **processed.metadata(),
+        **{field: getattr(image_instance, field) for field in PREVIEW_FIELDS},
+    }
+    return IngestResult(
+        rel_path, image_id, image_name, len(image_bytes), file_type,
+        len(processed.content), time.perf_counter() - started, metadata,
+    )
+
+
+class Command(BaseCommand):
+    """
+    Import a directory tree of images without going through the HTTP API.
+
+    Files are processed by a local process pool with the same pipeline the
+    upload tasks use and written straight to the default storage; only
+    their metadata travels back to this process, which inserts the rows in
+    chunks. Paths of committed chunks are appended to a manifest, so an
+    interrupted import can be re-run and skips what is already done. Row
+    ids are derived from the file path, so files re-processed after a crash
+    overwrite their earlier output instead of duplicating it.
+    """
+    help = "Process every image under a directory and insert the results in bulk."
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory", help="Directory to import recursively.")
+        parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Processes used for image processing.")
+        parser.add_argument("--chunk-size", type=int, default=200, help="Rows inserted per query.")
+        parser.add_argument("--manifest", help=f"Manifest of imported files. Defaults to <directory>/{MANIFEST_NAME}.")
+
+    def handle(self, *args, **options):
+        directory = os.path.abspath(options["directory"])
+        if not os.path.isdir(directory):
+            raise CommandError(f"Not a directory: {directory}")
+        manifest_path = options["manifest"] or os.path.join(directory, MANIFEST_NAME)
+
+        done = self.read_manifest(manifest_path)
+        tasks = [
+            (path, rel_path, uuid.uuid5(uuid.NAMESPACE_URL, f"file://{path}"))
+            for path, rel_path in self.find_images(directory)
+            if rel_path not in done
+        ]
+        if not tasks:
+            self.stdout.write(self.style.SUCCESS(f"Nothing to import ({len(done)} files already in the manifest)."))
+            return
+        self.stdout.write(f"Importing {len(tasks)} files ({len(done)} already in the manifest).")
+
+        upload_job = UploadJob.objects.create(total=len(tasks))
+        # Forked workers must not share the parent's database connections.
+        connections.close_all()
+
+        imported = failed = bytes_in = bytes_out = 0
+        chunk = []
+        started = time.perf_counter()
+        with multiprocessing.Pool(options["workers"]) as pool, open(manifest_path, "a") as manifest:
+            for index, result in enumerate(pool.imap_unordered(ingest_file, tasks, chunksize=4)):
+                if result.error:
+                    failed += 1
+                    self.stderr.write(f"Failed to import {result.rel_path}: {result.error}")
+                    continue
+                chunk.append((result.rel_path, self.build_row(result, upload_job, index)))
+                bytes_in += result.size
+                bytes_out += result.output_size
+                if len(chunk) >= options["chunk_size"]:
+                    imported += self.insert_chunk(chunk, manifest)
+                    chunk = []
+                    self.report(imported, failed, len(tasks), bytes_in, bytes_out, started)
+            if chunk:
+                imported += self.insert_chunk(chunk, manifest)
+
+        self.report(imported, failed, len(tasks), bytes_in, bytes_out, started)
+        self.stdout.write(self.style.SUCCESS(f"Imported {imported} files into job {upload_job.id} ({failed} failed)."))
+
+    @staticmethod
+    def read_manifest(manifest_path: str) -> set:
+        """
+        Return the relative paths recorded in the manifest.
+        """
+        if not os.path.exists(manifest_path):
+            return set()
+        with open(manifest_path) as manifest:
+            return {line.rstrip("\n") for line in manifest if line.strip()}
+
+    @staticmethod
+    def find_images(directory: str):
+        """
+        Yield the absolute and relative paths of image files under ``directory``, in a stable order.
+        """
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for file_name in sorted(files):
+                if file_name.startswith("."):
+                    continue
+                file_type = mimetypes.guess_type(file_name)[0]
+                if file_type and file_type.startswith("image/"):
+                    path = os.path.join(root, file_name)
+                    yield path, os.path.relpath(path, directory)
+
+    @staticmethod
+    def build_row(result: IngestResult, upload_job: UploadJob, index: int) -> ImageUpload:
+        return ImageUpload(
+            id=result.image_id,
+            image=result.image_name,
+            finished_at=timezone.now(),
+            upload_time=f"{result.elapsed:.1f} seconds",
+            size=result.size,
+            type=result.file_type,
+            name=os.path.basename(result.rel_path),
+            job_id=f"{upload_job.id}-{index}",
+            upload_job=upload_job,
+            status='completed',
+            **result.metadata,
+        )
+
+    @staticmethod
+    def insert_chunk(chunk, manifest) -> int:
+        """
+        Insert a chunk of (relative path, row) pairs, then record the paths in the manifest.
+        """
+        with transaction.atomic():
+            ImageUpload.objects.bulk_create([row for _, row in chunk], ignore_conflicts=True)
+        invalidate_list_cache()
+        manifest.writelines(f"{rel_path}\n" for rel_path, _ in chunk)
+        manifest.flush()
+        os.fsync(manifest.fileno())
+        return len(chunk)
+
+    def report(self, imported, failed, total, bytes_in, bytes_out, started):
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"{imported + failed}/{total} files in {elapsed:.1f}s: "
+            f"{imported / elapsed:.1f} files/s, "
+            f"{bytes_in / elapsed / 2**20:.1f} MB/s read, "
+            f"{bytes_out / elapsed / 2**20:.1f} MB/s written"
+        )
@@ -0,0 +1,76 @@
+import os
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from imageupload.cache import invalidate_list_cache
+from imageupload.models import ImageUpload
+from imageupload.storage import sharded_upload_to
+
+
+class Command(BaseCommand):
+    """
+    Move existing image files to the sharded, id-based layout.
+
+    Rows whose image is already stored under the name sharded_upload_to
+    produces are skipped, so the command can be interrupted and re-run.
+    """
+    help = "Move stored images to images/<xx>/<yy>/<id>.<ext> and update their rows."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="Rows updated per query.")
+        parser.add_argument("--dry-run", action="store_true", help="Report moves without performing them.")
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        moved = missing = 0
+        batch = []
+
+        rows = ImageUpload.objects.exclude(image="").only("id", "image").iterator(chunk_size=batch_size)
+        for image_instance in rows:
+            old_name = image_instance.image.name
+            new_name = sharded_upload_to(image_instance, old_name)
+            if old_name == new_name:
+                continue
+            if not default_storage.exists(old_name):
+                # A previous run may have moved the file but not updated the row.
+                if not default_storage.exists(new_name):
+                    missing += 1
+                    self.stderr.write(f"Missing file for {image_instance.id}: {old_name}")
+                    continue
+            elif not options["dry_run"]:
+                self.move(old_name, new_name)
+
+            if options["dry_run"]:
+                self.stdout.write(f"{old_name} -> {new_name}")
+            else:
+                image_instance.image.name = new_name
+                batch.append(image_instance)
+                if len(batch) >= batch_size:
+                    ImageUpload.objects.bulk_update(batch, ["image"])
+                    batch = []
+            moved += 1
+
+        if batch:
+            ImageUpload.objects.bulk_update(batch, ["image"])
+        if moved and not options["dry_run"]:
+            invalidate_list_cache()
+
+        verb = "Would move" if options["dry_run"] else "Moved"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {moved} files ({missing} missing)."))
+
+    @staticmethod
+    def move(old_name: str, new_name: str) -> None:
+        """
+        Move a file within the default storage, renaming in place when it is local.
+        """
+        try:
+            old_path = default_storage.path(old_name)
+        except NotImplementedError:
+            with default_storage.open(old_name) as old_file:
+                default_storage.save(new_name, old_file)
+            default_storage.delete(old_name)
+            return
+        new_path = default_storage.path(new_name)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        os.replace(old_path, new_path)
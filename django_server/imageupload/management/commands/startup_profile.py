@@ -0,0 +1,84 @@
+import re
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Code run in a fresh interpreter to reproduce what each process imports before it can serve.
+TARGETS = {
+    "web": (
+        "import importlib, django; django.setup(); "
+        "importlib.import_module({asgi!r}); importlib.import_module({urlconf!r})"
+    ),
+    "worker": (
+        "from django_server.celery import app; app.loader.import_default_modules()"
+    ),
+}
+
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|\s+(\S+)$")
+
+
+class Command(BaseCommand):
+    """
+    Report how long the web or worker process spends importing each module.
+
+    The target's startup imports are run in a new interpreter with
+    ``python -X importtime``, so nothing already imported by this command
+    hides their cost. Modules are listed by their own (self) or cumulative
+    import time, in milliseconds, followed by the total import time and the
+    wall time of the whole interpreter run.
+    """
+    help = "Profile the import time of the web or worker process per module."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--target", choices=sorted(TARGETS), default="web", help="Process to profile.")
+        parser.add_argument("--sort", choices=["self", "cumulative"], default="cumulative",
+                            help="Order modules by their own or cumulative import time (default: cumulative).")
+        parser.add_argument("--limit", type=int, default=30, help="Number of modules to print.")
+        parser.add_argument("--packages", action="store_true",
+                            help="Sum the self time of every module per top-level package.")
+
+    def handle(self, *args, **options):
+        code = TARGETS[options["target"]].format(
+            asgi=settings.ASGI_APPLICATION.rsplit(".", 1)[0],
+            urlconf=settings.ROOT_URLCONF,
+        )
+        started = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            cwd=settings.BASE_DIR, capture_output=True, text=True,
+        )
+        wall = time.perf_counter() - started
+
+        modules = []
+        for line in result.stderr.splitlines():
+            match = IMPORT_TIME_LINE.match(line)
+            if match:
+                self_us, cumulative_us, name = match.groups()
+                modules.append((name, int(self_us), int(cumulative_us)))
+        if result.returncode != 0 or not modules:
+            raise CommandError(f"Profiling {options['target']} failed:\n{result.stderr[-2000:]}")
+
+        total_ms = sum(self_us for _, self_us, _ in modules) / 1000
+        if options["packages"]:
+            package_ms = defaultdict(float)
+            for name, self_us, _ in modules:
+                package_ms[name.split(".", 1)[0]] += self_us / 1000
+            rows = sorted(package_ms.items(), key=lambda item: item[1], reverse=True)[:options["limit"]]
+            self.stdout.write(f"{'self ms':>10}  package")
+            for name, ms in rows:
+                self.stdout.write(f"{ms:10.1f}  {name}")
+        else:
+            key = 1 if options["sort"] == "self" else 2
+            rows = sorted(modules, key=lambda module: module[key], reverse=True)[:options["limit"]]
+            self.stdout.write(f"{'self ms':>10} {'cumul. ms':>10}  module")
+            for name, self_us, cumulative_us in rows:
+                self.stdout.write(f"{self_us / 1000:10.1f} {cumulative_us / 1000:10.1f}  {name}")
+
+        self.stdout.write(
+            f"Target {options['target']}: {len(modules)} modules imported in {total_ms:.0f} ms, "
+            f"{wall:.2f}s wall time including interpreter startup"
+        )
@@ -0,0 +1,139 @@
+import glob
+import json
+import os
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Span names summed into each column of the per-trace breakdown.
+BREAKDOWN = {
+    "queue": ("broker.wait",),
+    "process": ("task process_and_save_image", "task process_image_batch"),
+    "notify": ("notify",),
+    "deliver": ("websocket.deliver",),
+}
+
+
+def read_spans(pattern: str):
+    """
+    Read the spans of every OTLP/JSON trace file matching ``pattern``.
+
+    Yields:
+        dict: Spans with their ``service.name`` as ``service``, ``start`` and
+        ``duration`` in milliseconds and ``attributes`` as a plain dict.
+    """
+    for path in sorted(glob.glob(pattern)):
+        with open(path) as trace_file:
+            for line in trace_file:
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    continue
+                for resource_spans in request.get("resourceSpans", []):
+                    resource = plain_attributes(resource_spans.get("resource", {}).get("attributes", []))
+                    for scope_spans in resource_spans.get("scopeSpans", []):
+                        for span in scope_spans.get("spans", []):
+                            start = int(span["startTimeUnixNano"])
+                            yield {
+                                **span,
+                                "service": resource.get("service.name", "?"),
+                                "start": start / 1e6,
+                                "duration": (int(span["endTimeUnixNano"]) - start) / 1e6,
+                                "attributes": plain_attributes(span.get("attributes", [])),
+                            }
+
+
+def plain_attributes(attributes):
+    return {item["key"]: next(iter(item["value"].values()), None) for item in attributes}
+
+
+def percentile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Command(BaseCommand):
+    """
+    Summarize the upload traces written to TRACE_DIR.
+
+    Prints the duration of each span name across traces, then, for the most
+    recent traces, how long their images waited in the broker, were
+    processed, were notified and took to reach the WebSocket clients. With
+    ``--trace`` or ``--job``, prints the span tree of the matching traces
+    instead, with each span's offset from the start of its trace.
+    """
+    help = "Summarize the OTLP/JSON upload traces written to TRACE_DIR."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--trace", help="Print the span tree of this trace id.")
+        parser.add_argument("--job", help="Print the span tree of the traces of this upload job id.")
+        parser.add_argument("--limit", type=int, default=20, help="Number of recent traces to break down.")
+
+    def handle(self, *args, **options):
+        pattern = os.path.join(settings.TRACE_DIR, "*.jsonl")
+        traces = defaultdict(list)
+        for span in read_spans(pattern):
+            traces[span["traceId"]].append(span)
+        if not traces:
+            raise CommandError(f"No spans found in {pattern}")
+
+        if options["trace"] or options["job"]:
+            selected = [
+                trace_id for trace_id, spans in traces.items()
+                if trace_id == options["trace"] or options["job"] and any(
+                    str(span["attributes"].get("job_id", "")).startswith(options["job"]) for span in spans
+                )
+            ]
+            if not selected:
+                raise CommandError("No matching trace")
+            for trace_id in selected:
+                self.print_tree(trace_id, traces[trace_id])
+            return
+
+        durations = defaultdict(list)
+        for spans in traces.values():
+            for span in spans:
+                durations[span["name"]].append(span["duration"])
+        self.stdout.write(f"{'spans':>7} {'p50 ms':>10} {'p95 ms':>10} {'max ms':>10}  name")
+        for name, values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+            self.stdout.write(
+                f"{len(values):7d} {percentile(values, 0.5):10.1f} {percentile(values, 0.95):10.1f} "
+                f"{max(values):10.1f}  {name}"
+            )
+
+        recent = sorted(traces.items(), key=lambda item: min(span["start"] for span in item[1]))[-options["limit"]:]
+        self.stdout.write("")
+        self.stdout.write(
+            f"{'trace':<32} {'total ms':>10} " + " ".join(f"{column + ' ms':>10}" for column in BREAKDOWN)
+        )
+        for trace_id, spans in recent:
+            start = min(span["start"] for span in spans)
+            end = max(span["start"] + span["duration"] for span in spans)
+            columns = []
+            for names in BREAKDOWN.values():
+                matching = [span["duration"] for span in spans if span["name"] in names]
+                columns.append(f"{sum(matching):10.1f}" if matching else f"{'-':>10}")
+            self.stdout.write(f"{trace_id:<32} {end - start:10.1f} " + " ".join(columns))
+
+    def print_tree(self, trace_id: str, spans) -> None:
+        start = min(span["start"] for span in spans)
+        children = defaultdict(list)
+        span_ids = {span["spanId"] for span in spans}
+        for span in sorted(spans, key=lambda span: span["start"]):
+            parent = span.get("parentSpanId")
+            children[parent if parent in span_ids else None].append(span)
+
+        self.stdout.write(f"Trace {trace_id}")
+        self.stdout.write(f"{'offset ms':>10} {'duration ms':>12}  span")
+
+        def walk(parent_id, depth):
+            for span in children[parent_id]:
+                error = " ERROR" if span.get("status", {}).get("code") == 2 else ""
+                self.stdout.write(
+                    f"{span['start'] - start:10.1f} {span['duration']:12.1f}  "
+                    f"{'  ' * depth}{span['name']} [{span['service']}]{error}"
+                )
+                walk(span["spanId"], depth + 1)
+
+        walk(None, 0)
@@ -0,0 +1,172 @@
+# memory.py
+"""
+Memory budget for decoding images in the worker processes.
+
+The memory an image needs while it is processed is dominated by its
+decoded pixels, which can be estimated from the image header alone:
+width x height x bytes per pixel, after the JPEG draft reduction that
+process_image applies, times DECODE_MEMORY_FACTOR for the working copies
+made by resize and mode conversion.
+
+Every worker process on a host reserves the estimate of each image from a
+shared budget of WORKER_MEMORY_BUDGET bytes before decoding it, and waits
+while the images already admitted on the host would exceed it. An image
+larger than the whole budget is admitted once nothing else is. If no room
+is made within WORKER_MEMORY_WAIT seconds, or Redis is unavailable, the
+image is not decoded: MemoryBudgetUnavailable is raised and the task
+retries it later. The reservations are kept in Redis, per hostname, and
+expire after MEMORY_RESERVATION_TTL seconds so that a killed process
+cannot leak them.
+"""
+import logging
+import os
+import socket
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Union
+
+from django.conf import settings
+from PIL import Image
+
+from .processing import TARGET_WIDTH, check_pixels, open_image
+from .redis_client import get_redis
+from .tracing import stage
+
+logger = logging.getLogger(__name__)
+
+RESERVATIONS_KEY = "imageupload:memory:{host}"
+DEADLINES_KEY = "imageupload:memory:{host}:deadlines"
+
+# Working copies alive at once while an image is resized and converted.
+DECODE_MEMORY_FACTOR = 2
+MEMORY_RESERVATION_TTL = 600
+# PIL stores single band images with one byte per pixel, except for these
+# modes, and every multi-band image with four.
+WIDE_MODE_BYTES = {"I": 4, "F": 4, "I;16": 2, "I;16B": 2, "I;16L": 2, "I;16N": 2}
+
+# Drops expired reservations, then records the new one if it fits the budget
+# (or nothing else is reserved). Returns the bytes reserved on the host
+# including it, or -1 if it does not fit.
+RESERVE_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[4])
+for _, token in ipairs(expired) do
+  redis.call('HDEL', KEYS[1], token)
+  redis.call('ZREM', KEYS[2], token)
+end
+local used = 0
+for _, value in ipairs(redis.call('HVALS', KEYS[1])) do
+  used = used + tonumber(value)
+end
+local cost = tonumber(ARGV[2])
+if used > 0 and used + cost > tonumber(ARGV[3]) then
+  return -1
+end
+redis.call('HSET', KEYS[1], ARGV[1], cost)
+redis.call('ZADD', KEYS[2], tonumber(ARGV[4]) + tonumber(ARGV[5]), ARGV[1])
+return used + cost
+"""
+
+
+class MemoryBudgetUnavailable(Exception):
+    """
+    The host's memory budget had no room for an image in time, or could not be read.
+    """
+
+
+def estimate_decode_bytes(image_bytes: Union[bytes, memoryview]) -> int:
+    """
+    Estimate the memory needed to process an image from its header.
+
+    Returns:
+        int: The estimate in bytes, or 0 if the header cannot be read; the
+        decoder then reports the error.
+
+    Raises:
+        ValueError: If the image has more than IMAGE_MAX_PIXELS pixels.
+    """
+    try:
+        img = open_image(image_bytes)
+        if img.format == 'JPEG':
+            # Same reduction as process_image; only changes the decoder's scale.
+            img.draft(img.mode, (TARGET_WIDTH, TARGET_WIDTH))
+        width, height = img.size
+        mode, bands = img.mode, len(img.getbands())
+    except Image.DecompressionBombError:
+        raise ValueError("Image has too many pixels")
+    except Exception:
+        return 0
+    # Also checked by decode_image; rejecting here avoids waiting for room first.
+    check_pixels(img)
+    bytes_per_pixel = WIDE_MODE_BYTES.get(mode, 1 if bands == 1 else 4)
+    return width * height * bytes_per_pixel * DECODE_MEMORY_FACTOR
+
+
+@contextmanager
+def memory_reservation(image_bytes: Union[bytes, memoryview]):
+    """
+    Hold a reservation of this host's memory budget while an image is processed.
+
+    Waits, with growing pauses, until the image's estimate fits the budget;
+    the wait is timed as the ``admit`` stage.
+
+    Raises:
+        ValueError: If the image has more than IMAGE_MAX_PIXELS pixels.
+        MemoryBudgetUnavailable: If the image did not fit within
+            WORKER_MEMORY_WAIT seconds, or Redis is unavailable.
+    """
+    cost = estimate_decode_bytes(image_bytes)
+    if not cost:
+        yield
+        return
+
+    host = socket.gethostname()
+    keys = (RESERVATIONS_KEY.format(host=host), DEADLINES_KEY.format(host=host))
+    token = f"{os.getpid()}:{uuid.uuid4().hex}"
+    try:
+        client = get_redis()
+        with stage("admit"):
+            deadline = time.monotonic() + settings.WORKER_MEMORY_WAIT
+            pause = 0.05
+            while True:
+                reserved = client.eval(
+                    RESERVE_SCRIPT, 2, *keys,
+                    token, cost, settings.WORKER_MEMORY_BUDGET, time.time(), MEMORY_RESERVATION_TTL,
+                )
+                if reserved >= 0:
+                    break
+                if time.monotonic() >= deadline:
+                    raise MemoryBudgetUnavailable(
+                        f"No room for a {cost} byte image after {settings.WORKER_MEMORY_WAIT} seconds"
+                    )
+                time.sleep(pause)
+                pause = min(pause * 2, 1.0)
+    except MemoryBudgetUnavailable:
+        raise
+    except Exception as e:
+        raise MemoryBudgetUnavailable(f"Memory budget unavailable: {e}") from e
+
+    try:
+        yield
+    finally:
+        try:
+            with client.pipeline() as pipe:
+                pipe.hdel(keys[0], token)
+                pipe.zrem(keys[1], token)
+                pipe.execute()
+        except Exception as e:
+            logger.warning(f"Could not release memory reservation: {e}")
+
+
+def rss_bytes() -> int:
+    """
+    Return the resident set size of this process, from /proc/self/statm.
+
+    Returns:
+        int: The RSS in bytes, or 0 where /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
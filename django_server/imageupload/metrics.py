@@ -0,0 +1,155 @@
+# metrics.py
+"""
+Prometheus metrics for the upload pipeline.
+
+The web process and the Celery worker processes record into the same metric
+definitions. When ``PROMETHEUS_MULTIPROC_DIR`` is set, prometheus_client keeps
+the samples in files under that directory and ``metrics_view`` aggregates
+every process that shares it; otherwise only the serving process is reported.
+"""
+import os
+import socket
+import time
+
+from celery.signals import before_task_publish, task_prerun, worker_process_shutdown
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+from django.utils.crypto import constant_time_compare
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    values,
+)
+
+
+def process_identifier() -> str:
+    """
+    Identify this process for multiprocess sample files.
+
+    The web server and the workers run in separate containers that share the
+    metrics directory, so bare PIDs could collide; the hostname disambiguates.
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+    values.ValueClass = values.MultiProcessValue(process_identifier)
+
+STAGE_SECONDS = Histogram(
+    "imageupload_stage_seconds",
+    "Time spent in each image pipeline stage.",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+TASK_QUEUE_WAIT_SECONDS = Histogram(
+    "imageupload_task_queue_wait_seconds",
+    "Time between publishing a task and a worker starting it.",
+    ["task"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300),
+)
+BYTES_IN = Counter(
+    "imageupload_bytes_in",
+    "Bytes of uploaded image data decoded by the pipeline.",
+)
+BYTES_OUT = Counter(
+    "imageupload_bytes_out",
+    "Bytes of processed image data produced by the pipeline.",
+)
+CHANNEL_SEND_SECONDS = Histogram(
+    "imageupload_channel_send_seconds",
+    "Latency of channel layer group sends.",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+)
+CHANNEL_SEND_FAILURES = Counter(
+    "imageupload_channel_send_failures",
+    "Channel layer group sends that raised.",
+)
+WEBSOCKET_CONNECTIONS = Gauge(
+    "imageupload_websocket_connections",
+    "Open UploadConsumer WebSocket connections.",
+    multiprocess_mode="livesum",
+)
+TRACE_SPANS_DROPPED = Counter(
+    "imageupload_trace_spans_dropped",
+    "Finished trace spans dropped because the exporter's queue was full.",
+)
+RENDER_REQUESTS = Counter(
+    "imageupload_render_requests",
+    "Rendition requests by result: hit, coalesced onto a concurrent render, miss, or lock_timeout "
+    "(rendered without waiting longer for a concurrent render).",
+    ["result"],
+)
+HTTP_REQUESTS = Counter(
+    "imageupload_http_requests",
+    "HTTP requests by endpoint, method and status code.",
+    ["endpoint", "method", "status"],
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "imageupload_http_request_seconds",
+    "HTTP request latency by endpoint.",
+    ["endpoint"],
+)
+
+
+@before_task_publish.connect
+def stamp_publish_time(headers=None, **kwargs):
+    """Record when a task was published so the worker can measure queue wait."""
+    if headers is not None:
+        headers.setdefault("published_at", time.time())
+
+
+@task_prerun.connect
+def observe_queue_wait(task=None, **kwargs):
+    """Observe how long a task sat in the broker before a worker started it."""
+    published_at = getattr(task.request, "published_at", None)
+    if published_at is not None:
+        TASK_QUEUE_WAIT_SECONDS.labels(task.name).observe(max(0.0, time.time() - published_at))
+
+
+@worker_process_shutdown.connect
+def mark_worker_process_dead(**kwargs):
+    """Drop live gauges of a prefork child that is going away."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(process_identifier())
+
+
+def metrics_view(request: HttpRequest) -> HttpResponse:
+    """
+    Expose all metrics in the Prometheus text exposition format.
+
+    The scaling signals (queue depth, oldest message age, in-flight images
+    and per-image processing time) and the connection pool statistics are
+    read when the view is scraped. Scrapes must send METRICS_TOKEN as a
+    bearer token; without a token configured, metrics are only served in
+    DEBUG.
+
+    Args:
+        request (HttpRequest): The HTTP request object.
+
+    Returns:
+        HttpResponse: The current metric samples, or 401/403 if the scrape is not allowed.
+    """
+    if settings.METRICS_TOKEN:
+        if not constant_time_compare(request.headers.get("Authorization", ""), f"Bearer {settings.METRICS_TOKEN}"):
+            return HttpResponse(status=401, headers={"WWW-Authenticate": "Bearer"})
+    elif not settings.DEBUG:
+        return HttpResponse(status=403)
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    from .pools import ConnectionPoolCollector
+    from .scaling import ScalingSignalsCollector
+
+    scrape_registry = CollectorRegistry(auto_describe=False)
+    scrape_registry.register(ScalingSignalsCollector())
+    scrape_registry.register(ConnectionPoolCollector())
+    content = generate_latest(registry) + generate_latest(scrape_registry)
+    return HttpResponse(content, content_type=CONTENT_TYPE_LATEST)
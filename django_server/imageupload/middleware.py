@@ -0,0 +1,76 @@
+# middleware.py
+import re
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.http import HttpRequest, HttpResponse
+
+from .metrics import HTTP_REQUEST_SECONDS, HTTP_REQUESTS
+from .profiling import aprofiled, profiled, profiling_requested
+
+
+class RequestMetricsMiddleware:
+    """
+    Middleware counting requests per endpoint and status code.
+
+    Requests are labelled with the matched URL route rather than the raw path
+    to keep label cardinality bounded. The middleware supports both sync and
+    async request handling so it does not force async views onto a thread.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request: HttpRequest):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self.observe(request, response, start)
+        return response
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self.observe(request, response, start)
+        return response
+
+    @staticmethod
+    def observe(request: HttpRequest, response: HttpResponse, start: float) -> None:
+        match = getattr(request, "resolver_match", None)
+        endpoint = match.route if match is not None else "unmatched"
+        HTTP_REQUESTS.labels(endpoint, request.method, str(response.status_code)).inc()
+        HTTP_REQUEST_SECONDS.labels(endpoint).observe(time.perf_counter() - start)
+
+
+class RequestProfilingMiddleware:
+    """
+    Middleware profiling requests that carry the ``X-Profile`` header.
+
+    Profiles are grouped under ``requests/`` and labelled with the request path.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request: HttpRequest):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with profiled("requests", self.label(request), profiling_requested(request)):
+            return self.get_response(request)
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        async with aprofiled("requests", self.label(request), profiling_requested(request)):
+            return await self.get_response(request)
+
+    @staticmethod
+    def label(request: HttpRequest) -> str:
+        return f"{request.method}{re.sub(r'[^A-Za-z0-9]+', '_', request.path)}"
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:11
+
+from django.db import migrations, models
+import imageupload.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imageupload', '0003_alter_imageupload_upload_time'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='imageupload',
+            name='image',
+            field=models.ImageField(upload_to=imageupload.storage.sharded_upload_to),
+        ),
+    ]
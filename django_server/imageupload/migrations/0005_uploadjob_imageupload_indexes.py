@@ -0,0 +1,47 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imageupload', '0004_alter_imageupload_image'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('total', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'upload_jobs',
+            },
+        ),
+        migrations.AddField(
+            model_name='imageupload',
+            name='upload_job',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='images', to='imageupload.uploadjob'),
+        ),
+        migrations.AddIndex(
+            model_name='imageupload',
+            index=models.Index(fields=['upload_job', 'status'], name='images_job_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='imageupload',
+            index=models.Index(condition=models.Q(('status__in', ('pending', 'processing'))), fields=['uploaded_at'], name='images_active_uploaded_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='imageupload',
+            index=models.Index(fields=['type', 'uploaded_at'], name='images_type_uploaded_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='imageupload',
+            index=models.Index(fields=['-uploaded_at'], name='images_uploaded_desc_idx'),
+        ),
+    ]
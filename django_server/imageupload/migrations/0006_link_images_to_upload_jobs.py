@@ -0,0 +1,55 @@
+from django.db import migrations
+from django.db.models import Count, OuterRef, Subquery
+import uuid
+
+
+def link_images_to_upload_jobs(apps, schema_editor):
+    """
+    Create an UploadJob for every job id prefix and point its images at it.
+    """
+    ImageUpload = apps.get_model('imageupload', 'ImageUpload')
+    UploadJob = apps.get_model('imageupload', 'UploadJob')
+
+    known_jobs = set(UploadJob.objects.values_list('id', flat=True))
+    batch = []
+    images = (
+        ImageUpload.objects
+        .filter(upload_job__isnull=True, job_id__isnull=False)
+        .only('id', 'job_id')
+        .iterator(chunk_size=1000)
+    )
+    for image in images:
+        try:
+            job_uuid = uuid.UUID(image.job_id[:36])
+        except ValueError:
+            continue
+        if job_uuid not in known_jobs:
+            UploadJob.objects.create(id=job_uuid)
+            known_jobs.add(job_uuid)
+        image.upload_job_id = job_uuid
+        batch.append(image)
+        if len(batch) >= 1000:
+            ImageUpload.objects.bulk_update(batch, ['upload_job'])
+            batch = []
+    if batch:
+        ImageUpload.objects.bulk_update(batch, ['upload_job'])
+
+    image_counts = (
+        ImageUpload.objects
+        .filter(upload_job=OuterRef('pk'))
+        .values('upload_job')
+        .annotate(count=Count('id'))
+        .values('count')
+    )
+    UploadJob.objects.update(total=Subquery(image_counts))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imageupload', '0005_uploadjob_imageupload_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(link_images_to_upload_jobs, migrations.RunPython.noop),
+    ]
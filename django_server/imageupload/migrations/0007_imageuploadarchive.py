@@ -0,0 +1,34 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imageupload', '0006_link_images_to_upload_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageUploadArchive',
+            fields=[
+                ('id', models.UUIDField(editable=False, primary_key=True, serialize=False)),
+                ('image', models.CharField(blank=True, max_length=255)),
+                ('uploaded_at', models.DateTimeField()),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('upload_time', models.CharField(blank=True, max_length=50, null=True)),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('type', models.CharField(default='unknown', max_length=50)),
+                ('name', models.CharField(default='default_image_name.jpg', max_length=255)),
+                ('job_id', models.CharField(blank=True, max_length=256, null=True)),
+                ('upload_job_id', models.UUIDField(blank=True, null=True)),
+                ('status', models.CharField(max_length=64)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'images_archive',
+                'indexes': [models.Index(fields=['uploaded_at'], name='images_archive_uploaded_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imageupload', '0007_imageuploadarchive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageupload',
+            name='format',
+            field=models.CharField(blank=True, max_length=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageupload',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageupload',
+            name='orientation',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageupload',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageuploadarchive',
+            name='format',
+            field=models.CharField(blank=True, max_length=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageuploadarchive',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageuploadarchive',
+            name='orientation',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageuploadarchive',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imageupload', '0008_image_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageupload',
+            name='phash',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageupload',
+            name='phash_band0',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageupload',
+            name='phash_band1',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageupload',
+            name='phash_band2',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageupload',
+            name='phash_band3',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='imageupload',
+            index=models.Index(fields=['phash_band0'], name='images_phash_band0_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='imageupload',
+            index=models.Index(fields=['phash_band1'], name='images_phash_band1_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='imageupload',
+            index=models.Index(fields=['phash_band2'], name='images_phash_band2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='imageupload',
+            index=models.Index(fields=['phash_band3'], name='images_phash_band3_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imageupload', '0009_image_phash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageupload',
+            name='blur_score',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageupload',
+            name='brightness',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageupload',
+            name='dominant_color',
+            field=models.CharField(blank=True, max_length=7, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageupload',
+            name='preview',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
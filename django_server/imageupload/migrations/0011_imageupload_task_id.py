@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imageupload', '0010_image_previews'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageupload',
+            name='task_id',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
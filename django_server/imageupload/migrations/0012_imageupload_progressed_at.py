@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 14:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imageupload', '0011_imageupload_task_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageupload',
+            name='progressed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,5 +1,34 @@
 from django.db import models
+from django.db.models import Q
 import uuid
+from .storage import sharded_upload_to
+
+# Statuses of images that still have work ahead of them.
+ACTIVE_STATUSES = ('pending', 'processing')
+
+
+class UploadJob(models.Model):
+    """
+    Model grouping the images uploaded together in one request.
+
+    Attributes:
+        id (UUIDField): Unique identifier of the job, returned to the client as job_id.
+        created_at (DateTimeField): Timestamp when the upload request was received.
+        total (PositiveIntegerField): Number of images in the job.
+
+    Methods:
+        __str__: Returns the job id as a string representation.
+    """
+    class Meta:
+      db_table = 'upload_jobs'
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    total = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return str(self.id)
+
 
 class ImageUpload(models.Model):
     """
@@ -10,28 +39,71 @@ class ImageUpload(models.Model):
 
     Attributes:
         id (UUIDField): Unique identifier for the image upload.
-        image (ImageField): The uploaded image file.
+        image (ImageField): The processed image file, stored as images/<xx>/<yy>/<id>.<ext>.
         uploaded_at (DateTimeField): Timestamp when the image was uploaded.
         finished_at (DateTimeField): Timestamp when processing was completed (nullable).
+        progressed_at (DateTimeField): Last time a worker reported progress on the image;
+            null while it is still queued (nullable).
         upload_time (CharField): String representation of the upload duration.
         size (PositiveIntegerField): Size of the image file in bytes.
         type (CharField): MIME type of the image file.
         name (CharField): Original filename of the uploaded image.
-        job_id (CharField): Unique identifier for the upload job (nullable).
+        job_id (CharField): Unique identifier of the image within its job, "<job>-<index>" (nullable).
+        upload_job (ForeignKey): The UploadJob the image was uploaded with (nullable).
         status (CharField): Current status of the image processing.
+        task_id (CharField): Id of the Celery task processing the image, shared by the
+            images of a batch task, used to revoke it on cancellation (nullable).
+        width (PositiveIntegerField): Width of the processed, upright image in pixels (nullable).
+        height (PositiveIntegerField): Height of the processed, upright image in pixels (nullable).
+        format (CharField): Image format the processed image was encoded with (nullable).
+        orientation (PositiveSmallIntegerField): EXIF orientation of the upload, applied
+            to the processed image (nullable).
+        phash (BigIntegerField): 64-bit dHash of the processed image, stored signed (nullable).
+        phash_band0..phash_band3 (PositiveIntegerField): The four 16-bit bands of
+            phash, most significant first (nullable).
+        brightness (FloatField): Mean luma of the processed image, 0 to 1 (nullable).
+        dominant_color (CharField): Most common colour as "#rrggbb" (nullable).
+        blur_score (FloatField): Variance of the Laplacian; lower is blurrier (nullable).
+        preview (TextField): Tiny square WebP data URI, used as a placeholder (nullable).
 
     The status field can have the following values:
         - 'pending': Upload initiated but not yet processed.
         - 'processing': Image is currently being processed.
         - 'completed': Image processing has been successfully completed.
-        - 'aborted': Image processing was aborted. (not implemented)
+        - 'aborted': The upload job was cancelled before the image was processed.
         - 'error': An error occurred during processing.
 
+    Indexes:
+        - (upload_job, status) answers batch progress queries from the index alone.
+        - uploaded_at, restricted to ACTIVE_STATUSES, serves stuck-job sweeps
+          while staying as small as the number of in-flight images.
+        - (type, uploaded_at) serves per-type listings by upload date.
+        - uploaded_at (descending) serves the newest-first ListView pages.
+        - Each phash band is indexed on its own. Hashes within Hamming distance
+          3 share at least one band, so near-duplicates are found by looking up
+          the rows equal on any band and comparing their full hashes.
+
     Methods:
         __str__: Returns the name of the image as a string representation.
     """
     class Meta:
       db_table = 'images'
+      indexes = [
+        models.Index(fields=['upload_job', 'status'], name='images_job_status_idx'),
+        models.Index(
+          fields=['uploaded_at'],
+          name='images_active_uploaded_idx',
+          condition=Q(status__in=ACTIVE_STATUSES),
+        ),
+        models.Index(fields=['type', 'uploaded_at'], name='images_type_uploaded_idx'),
+        models.Index(fields=['-uploaded_at'], name='images_uploaded_desc_idx'),
+        models.Index(fields=['phash_band0'], name='images_phash_band0_idx'),
+        models.Index(fields=['phash_band1'], name='images_phash_band1_idx'),
+        models.Index(fields=['phash_band2'], name='images_phash_band2_idx'),
+        models.Index(fields=['phash_band3'], name='images_phash_band3_idx'),
+      ]
+
+    ACTIVE_STATUSES = ACTIVE_STATUSES
 
     STATUS_CHOICES = [
       ('pending', 'Pending'),
@@ -42,9 +114,10 @@ class ImageUpload(models.Model):
     ]
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    image = models.ImageField(upload_to="images/")
+    image = models.ImageField(upload_to=sharded_upload_to)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     finished_at = models.DateTimeField(null=True, blank=True)
+    progressed_at = models.DateTimeField(null=True, blank=True)
     upload_time = models.CharField(max_length=50, null=True, blank=True)  
     size = models.PositiveIntegerField(default=0)  
     type = models.CharField(max_length=50, default="unknown")  
@@ -52,7 +125,80 @@ class ImageUpload(models.Model):
         max_length=255, default="default_image_name.jpg"
     )  
     job_id = models.CharField(max_length=256, unique=True, null=True, blank=True)
+    upload_job = models.ForeignKey(
+        UploadJob,
+        on_delete=models.CASCADE,
+        related_name='images',
+        null=True,
+        blank=True,
+        # Covered by the leading column of images_job_status_idx.
+        db_index=False,
+    )
     status = models.CharField(max_length=64, choices=STATUS_CHOICES, default='processing')
+    task_id = models.CharField(max_length=255, null=True, blank=True)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    format = models.CharField(max_length=10, null=True, blank=True)
+    orientation = models.PositiveSmallIntegerField(null=True, blank=True)
+    phash = models.BigIntegerField(null=True, blank=True)
+    phash_band0 = models.PositiveIntegerField(null=True, blank=True)
+    phash_band1 = models.PositiveIntegerField(null=True, blank=True)
+    phash_band2 = models.PositiveIntegerField(null=True, blank=True)
+    phash_band3 = models.PositiveIntegerField(null=True, blank=True)
+    brightness = models.FloatField(null=True, blank=True)
+    dominant_color = models.CharField(max_length=7, null=True, blank=True)
+    blur_score = models.FloatField(null=True, blank=True)
+    preview = models.TextField(null=True, blank=True)
+
+    def __str__(self):
+        return self.name
+
+
+class ImageUploadArchive(models.Model):
+    """
+    Model holding completed image uploads moved out of the hot images table.
+
+    Rows are copied here by the apply_retention management command once they
+    are older than the completed retention period. The image file is kept in
+    storage; ``image`` holds its path.
+
+    Attributes:
+        id (UUIDField): The id the row had in the images table.
+        image (CharField): Storage path of the processed image.
+        uploaded_at (DateTimeField): Timestamp when the image was uploaded.
+        finished_at (DateTimeField): Timestamp when processing was completed (nullable).
+        upload_time (CharField): String representation of the upload duration.
+        size (PositiveIntegerField): Size of the original file in bytes.
+        type (CharField): MIME type of the image file.
+        name (CharField): Original filename of the uploaded image.
+        job_id (CharField): Identifier of the image within its job (nullable).
+        upload_job_id (UUIDField): Id of the UploadJob the image belonged to (nullable).
+        status (CharField): Status of the image when it was archived.
+        width, height, format, orientation: The processed image's metadata (nullable).
+        archived_at (DateTimeField): Timestamp when the row was archived.
+    """
+    class Meta:
+      db_table = 'images_archive'
+      indexes = [
+        models.Index(fields=['uploaded_at'], name='images_archive_uploaded_idx'),
+      ]
+
+    id = models.UUIDField(primary_key=True, editable=False)
+    image = models.CharField(max_length=255, blank=True)
+    uploaded_at = models.DateTimeField()
+    finished_at = models.DateTimeField(null=True, blank=True)
+    upload_time = models.CharField(max_length=50, null=True, blank=True)
+    size = models.PositiveIntegerField(default=0)
+    type = models.CharField(max_length=50, default="unknown")
+    name = models.CharField(max_length=255, default="default_image_name.jpg")
+    job_id = models.CharField(max_length=256, null=True, blank=True)
+    upload_job_id = models.UUIDField(null=True, blank=True)
+    status = models.CharField(max_length=64)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    format = models.CharField(max_length=10, null=True, blank=True)
+    orientation = models.PositiveSmallIntegerField(null=True, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return self.name
@@ -0,0 +1,53 @@
+# notifications.py
+import logging
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from .events import append_event
+from .metrics import CHANNEL_SEND_FAILURES, CHANNEL_SEND_SECONDS
+from .tracing import event_trace, span
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_GROUP = 'upload_group'
+
+
+def send_upload_notification(**event) -> None:
+    """
+    Broadcast an upload status event to every connected UploadConsumer.
+
+    The event is first appended to its job's replayable event log and
+    broadcast with the assigned ``seq``. Send latency and failures are
+    recorded in the channel layer metrics. Within a trace, both are recorded
+    as a ``notify`` span and the event carries the trace to the consumers.
+
+    Args:
+        **event: The notification fields (name, size, job_id, status, message
+            and optionally image, image_url and upload_time).
+
+    Raises:
+        Exception: If the channel layer send fails.
+    """
+    with span('notify', job_id=event['job_id'], status=event['status']):
+        try:
+            event['seq'] = append_event(event)
+        except Exception as e:
+            logger.warning(f"Could not log upload event for {event['job_id']}: {e}")
+
+        trace = event_trace()
+        if trace is not None:
+            event['trace'] = trace
+        channel_layer = get_channel_layer()
+        start = time.perf_counter()
+        try:
+            async_to_sync(channel_layer.group_send)(
+                UPLOAD_GROUP,
+                {'type': 'send_upload_notification', **event}
+            )
+        except Exception:
+            CHANNEL_SEND_FAILURES.inc()
+            raise
+        finally:
+            CHANNEL_SEND_SECONDS.observe(time.perf_counter() - start)
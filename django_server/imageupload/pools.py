@@ -0,0 +1,119 @@
+# pools.py
+"""
+Connection pool statistics exported on ``/metrics``.
+
+- Redis: the process-wide pools of redis_client and the pools of the Redis
+  caches, as seen by the process serving the scrape.
+- Postgres: with DATABASE_POOL_STATS set, the clients and server connections
+  of PgBouncer's pool for the default database (``SHOW POOLS``) and the
+  pool size it was configured with (``SHOW DATABASES``). PgBouncer pools the
+  connections of the web and worker processes alike.
+"""
+import logging
+from typing import Dict, List
+
+import psycopg2
+from django.conf import settings
+from django.core.cache import caches
+from prometheus_client.core import GaugeMetricFamily
+
+from .redis_client import blocking_pool_stats, pool_stats
+
+logger = logging.getLogger(__name__)
+
+# SHOW POOLS columns exported, and the state label each is exported as.
+PGBOUNCER_CLIENT_STATES = {"cl_active": "active", "cl_waiting": "waiting"}
+PGBOUNCER_SERVER_STATES = {"sv_active": "active", "sv_idle": "idle", "sv_used": "used"}
+
+
+def pgbouncer_rows(command: str) -> List[Dict]:
+    """
+    Run a PgBouncer admin console command against the default database's host.
+
+    Raises:
+        psycopg2.Error: If PgBouncer cannot be reached or rejects the command.
+    """
+    database = settings.DATABASES["default"]
+    connection = psycopg2.connect(
+        host=database["HOST"],
+        port=database["PORT"],
+        user=database["USER"],
+        password=database["PASSWORD"],
+        dbname="pgbouncer",
+        connect_timeout=2,
+    )
+    try:
+        # The admin console does not support transactions.
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute(command)
+            columns = [column.name for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    finally:
+        connection.close()
+
+
+class ConnectionPoolCollector:
+    """
+    Prometheus collector reading the connection pools at scrape time.
+    """
+
+    def collect(self):
+        yield from self.collect_redis()
+        if settings.DATABASE_POOL_STATS:
+            try:
+                yield from self.collect_database()
+            except Exception as e:
+                logger.warning(f"Database pool stats unavailable: {e}")
+
+    def collect_redis(self):
+        connections = GaugeMetricFamily(
+            "imageupload_redis_pool_connections",
+            "Connections of the Redis pools of the serving process.",
+            labels=["pool", "state"],
+        )
+        max_connections = GaugeMetricFamily(
+            "imageupload_redis_pool_max_connections",
+            "Connection limit of the Redis pools of the serving process.",
+            labels=["pool"],
+        )
+        stats = {f"client {address}": counts for address, counts in pool_stats().items()}
+        for alias in settings.CACHES:
+            client = getattr(caches[alias], "_cache", None)
+            for index, pool in getattr(client, "_pools", {}).items():
+                if hasattr(pool, "pool"):
+                    stats[f"cache {alias}/{index}"] = blocking_pool_stats(pool)
+        for name, (in_use, idle, limit) in stats.items():
+            connections.add_metric([name, "in_use"], in_use)
+            connections.add_metric([name, "idle"], idle)
+            max_connections.add_metric([name], limit)
+        yield connections
+        yield max_connections
+
+    def collect_database(self):
+        database = settings.DATABASES["default"]
+        clients = GaugeMetricFamily(
+            "imageupload_db_pool_clients", "Client connections of the PgBouncer pool.", labels=["state"]
+        )
+        servers = GaugeMetricFamily(
+            "imageupload_db_pool_servers", "Server connections of the PgBouncer pool.", labels=["state"]
+        )
+        for row in pgbouncer_rows("SHOW POOLS"):
+            if row["database"] != database["NAME"] or row["user"] != database["USER"]:
+                continue
+            for column, state in PGBOUNCER_CLIENT_STATES.items():
+                clients.add_metric([state], row[column])
+            for column, state in PGBOUNCER_SERVER_STATES.items():
+                servers.add_metric([state], row[column])
+            yield GaugeMetricFamily(
+                "imageupload_db_pool_max_wait_seconds",
+                "Wait of the oldest client queued for a server connection.",
+                value=row["maxwait"] + row.get("maxwait_us", 0) / 1e6,
+            )
+        yield clients
+        yield servers
+        for row in pgbouncer_rows("SHOW DATABASES"):
+            if row["name"] == database["NAME"]:
+                yield GaugeMetricFamily(
+                    "imageupload_db_pool_size", "Server connections PgBouncer keeps per user.", value=row["pool_size"]
+                )
@@ -0,0 +1,110 @@
+# previews.py
+"""
+Tiny previews and simple statistics, computed for many images at once.
+
+The processing tasks collect a THUMBNAIL_SIZE square thumbnail of every
+processed image. batch_statistics stacks a group of them into a single
+NumPy array and computes, for the whole group in a few vectorised
+operations:
+
+- brightness: mean luma, from 0 (black) to 1 (white),
+- dominant_color: the mean colour of the most common of 64 colour bins,
+- blur_score: variance of the Laplacian of the luma; lower is blurrier,
+- preview: a PREVIEW_SIZE square WebP data URI, to be stretched to the
+  image's aspect ratio as a placeholder while the image loads.
+"""
+import base64
+import io
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+
+from .processing import THUMBNAIL_SIZE
+
+PREVIEW_SIZE = 16
+# Thumbnails processed per NumPy array, bounding its memory.
+PREVIEW_GROUP_SIZE = 256
+
+# ImageUpload columns filled by annotate_previews.
+PREVIEW_FIELDS = ['brightness', 'dominant_color', 'blur_score', 'preview']
+
+LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+# Each channel is quantised to 4 levels, giving 64 colour bins.
+COLOR_LEVEL_SHIFT = 6
+COLOR_BINS = 64
+
+
+def batch_statistics(thumbnails: Sequence[Image.Image]) -> List[Dict]:
+    """
+    Compute the preview fields of a group of thumbnails.
+
+    Args:
+        thumbnails (Sequence[Image.Image]): RGB images of THUMBNAIL_SIZE x THUMBNAIL_SIZE.
+
+    Returns:
+        List[Dict]: The PREVIEW_FIELDS values of each thumbnail, in order.
+    """
+    count = len(thumbnails)
+    if not count:
+        return []
+    pixels = np.stack([np.asarray(thumbnail, dtype=np.uint8) for thumbnail in thumbnails])
+    rgb = pixels.astype(np.float32)
+
+    luma = rgb @ LUMA_WEIGHTS
+    brightness = luma.mean(axis=(1, 2)) / 255.0
+
+    laplacian = (
+        4 * luma[:, 1:-1, 1:-1]
+        - luma[:, :-2, 1:-1] - luma[:, 2:, 1:-1]
+        - luma[:, 1:-1, :-2] - luma[:, 1:-1, 2:]
+    )
+    blur_score = laplacian.var(axis=(1, 2))
+
+    levels = (pixels >> COLOR_LEVEL_SHIFT).astype(np.int64)
+    bins = (levels[..., 0] * 16 + levels[..., 1] * 4 + levels[..., 2]).reshape(count, -1)
+    # Offset each image's bins so one bincount counts the whole group.
+    offsets = np.arange(count)[:, None] * COLOR_BINS
+    counts = np.bincount((bins + offsets).ravel(), minlength=count * COLOR_BINS).reshape(count, COLOR_BINS)
+    in_dominant = bins == counts.argmax(axis=1)[:, None]
+    dominant_sums = (rgb.reshape(count, -1, 3) * in_dominant[..., None]).sum(axis=1)
+    dominant = np.rint(dominant_sums / in_dominant.sum(axis=1)[:, None]).astype(np.uint8)
+
+    block = THUMBNAIL_SIZE // PREVIEW_SIZE
+    previews = np.rint(
+        rgb.reshape(count, PREVIEW_SIZE, block, PREVIEW_SIZE, block, 3).mean(axis=(2, 4))
+    ).astype(np.uint8)
+
+    return [
+        {
+            'brightness': round(float(brightness[index]), 4),
+            'dominant_color': '#{:02x}{:02x}{:02x}'.format(*dominant[index]),
+            'blur_score': round(float(blur_score[index]), 2),
+            'preview': encode_preview(previews[index]),
+        }
+        for index in range(count)
+    ]
+
+
+def encode_preview(pixels: np.ndarray) -> str:
+    """
+    Encode a PREVIEW_SIZE square RGB array as a WebP data URI.
+    """
+    buffer = io.BytesIO()
+    Image.fromarray(pixels, "RGB").save(buffer, format="WEBP", quality=50)
+    return f"data:image/webp;base64,{base64.b64encode(buffer.getvalue()).decode('ascii')}"
+
+
+def annotate_previews(thumbnailed: List[Tuple[object, Image.Image]]) -> None:
+    """
+    Set the PREVIEW_FIELDS of ImageUpload instances from their thumbnails.
+
+    Args:
+        thumbnailed (List[Tuple[ImageUpload, Image.Image]]): Instances and their thumbnails.
+    """
+    for start in range(0, len(thumbnailed), PREVIEW_GROUP_SIZE):
+        group = thumbnailed[start:start + PREVIEW_GROUP_SIZE]
+        statistics = batch_statistics([thumbnail for _, thumbnail in group])
+        for (image_instance, _), values in zip(group, statistics):
+            for field, value in values.items():
+                setattr(image_instance, field, value)
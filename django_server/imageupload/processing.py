@@ -0,0 +1,344 @@
+# processing.py
+"""
+Image processing pipeline shared by the upload views and Celery tasks.
+
+The pipeline decodes the uploaded bytes, resizes the image to the target
+width, applies its EXIF orientation, computes a perceptual hash of the
+result and re-encodes it in a format derived from the upload's MIME type.
+Each stage is timed into the ``imageupload_stage_seconds`` histogram and,
+within an upload's trace, recorded as a span.
+"""
+import io
+import mimetypes
+from typing import Dict, NamedTuple, Optional, Tuple, Union
+
+from django.conf import settings
+from PIL import Image
+
+from .metrics import BYTES_IN, BYTES_OUT
+from .tracing import stage
+
+TARGET_WIDTH = 1500
+SUPPORTED_FORMATS = ['JPEG', 'PNG', 'WebP', 'GIF']
+
+# PIL warns above this many pixels and refuses to open twice as many.
+Image.MAX_IMAGE_PIXELS = settings.IMAGE_MAX_PIXELS
+
+EXIF_ORIENTATION = 0x0112
+# Transposition that turns an image stored with the given EXIF orientation upright.
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+# Orientations whose upright image has width and height swapped.
+SWAPPED_ORIENTATIONS = (5, 6, 7, 8)
+
+# Image.info entries holding metadata rather than pixel data.
+METADATA_INFO_KEYS = ('exif', 'icc_profile', 'xmp', 'XML:com.adobe.xmp', 'comment', 'photoshop')
+
+# dHash of HASH_SIZE x HASH_SIZE bits, stored whole and split into
+# PHASH_BANDS bands that are indexed for similarity lookups.
+HASH_SIZE = 8
+PHASH_BANDS = 4
+PHASH_BAND_BITS = HASH_SIZE * HASH_SIZE // PHASH_BANDS
+
+# Side of the square RGB thumbnail handed to the preview statistics.
+THUMBNAIL_SIZE = 64
+
+# ImageUpload columns filled from ProcessedImage.metadata().
+METADATA_FIELDS = [
+    'width', 'height', 'format', 'orientation', 'phash',
+    *(f'phash_band{band}' for band in range(PHASH_BANDS)),
+]
+
+
+class ProcessedImage(NamedTuple):
+    """
+    Result of running an upload through the processing pipeline.
+
+    Attributes:
+        content (bytes): The encoded output image.
+        image_format (str): The PIL format name the image was encoded with.
+        width (int): Width of the upright output image in pixels.
+        height (int): Height of the upright output image in pixels.
+        orientation (int): EXIF orientation of the upload, already applied to the output.
+        phash (Optional[int]): Unsigned 64-bit dHash of the output image.
+        thumbnail (Optional[Image.Image]): THUMBNAIL_SIZE square RGB copy of the
+            output, if requested, for previews.batch_statistics.
+    """
+    content: bytes
+    image_format: str
+    width: int = 0
+    height: int = 0
+    orientation: int = 1
+    phash: Optional[int] = None
+    thumbnail: Optional[Image.Image] = None
+
+    @property
+    def extension(self) -> str:
+        return self.image_format.lower()
+
+    @property
+    def content_type(self) -> str:
+        return f"image/{self.extension}"
+
+    def metadata(self) -> Dict:
+        """
+        Return the values of the ImageUpload METADATA_FIELDS.
+        """
+        metadata = {
+            'width': self.width,
+            'height': self.height,
+            'format': self.image_format,
+            'orientation': self.orientation,
+        }
+        if self.phash is not None:
+            metadata.update(hash_columns(self.phash))
+        return metadata
+
+
+def dhash(img: Image.Image) -> int:
+    """
+    Compute the difference hash of an image.
+
+    The image is reduced to a (HASH_SIZE + 1) x HASH_SIZE grayscale
+    thumbnail and each bit records whether a pixel is brighter than its
+    right neighbour. Re-saved, recompressed or rescaled copies of an image
+    differ in only a few bits.
+
+    Returns:
+        int: The hash as an unsigned HASH_SIZE * HASH_SIZE bit integer.
+    """
+    thumbnail = img.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+    pixels = list(thumbnail.getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            offset = row * (HASH_SIZE + 1) + col
+            value = (value << 1) | (pixels[offset] > pixels[offset + 1])
+    return value
+
+
+def hash_columns(phash: int) -> Dict:
+    """
+    Split an unsigned dHash into the ImageUpload ``phash`` and band columns.
+
+    ``phash`` is stored as a signed 64-bit integer to fit a bigint column;
+    ``phash_band0`` holds the most significant PHASH_BAND_BITS bits.
+    """
+    bits = HASH_SIZE * HASH_SIZE
+    columns = {'phash': phash - (1 << bits) if phash >= 1 << (bits - 1) else phash}
+    mask = (1 << PHASH_BAND_BITS) - 1
+    for band in range(PHASH_BANDS):
+        shift = bits - PHASH_BAND_BITS * (band + 1)
+        columns[f'phash_band{band}'] = (phash >> shift) & mask
+    return columns
+
+
+def resolve_image_format(file_type: str, file_name: str, source_format: str) -> str:
+    """
+    Determine the PIL format to encode an upload with.
+
+    Args:
+        file_type (str): The MIME type reported for the upload.
+        file_name (str): The original filename, used when the MIME type is generic.
+        source_format (str): The format PIL detected when opening the upload.
+
+    Returns:
+        str: One of SUPPORTED_FORMATS.
+    """
+    if file_type == 'application/octet-stream':
+        # If content type is generic, try to guess from the file name
+        guessed_type = mimetypes.guess_type(file_name)[0]
+        if guessed_type:
+            file_type = guessed_type
+        elif source_format:
+            # If we can't guess, use the format from the opened image
+            file_type = f"image/{source_format.lower()}"
+
+    if '/' in file_type:
+        image_format = file_type.split("/")[1].upper()
+    else:
+        # If file_type doesn't contain '/', use the format from the opened image
+        image_format = source_format
+
+    # Handle special cases
+    if image_format == 'JPG':
+        image_format = 'JPEG'
+    elif image_format == 'WEBP':
+        image_format = 'WebP'  # PIL uses 'WebP', not 'WEBP'
+
+    # Fallback to JPEG if format is still not recognized
+    if image_format not in SUPPORTED_FORMATS:
+        image_format = 'JPEG'
+    return image_format
+
+
+class MemoryReader(io.RawIOBase):
+    """
+    Seekable, read-only file over a bytes-like object.
+
+    Unlike ``io.BytesIO``, which copies what it is given, this reads
+    straight from the buffer, so a view into a task message is decoded
+    without first copying the whole image.
+    """
+
+    def __init__(self, data: Union[bytes, memoryview]):
+        self.view = memoryview(data).cast("B")
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        chunk = self.view[self.position:self.position + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        self.position += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self.position = offset
+        return offset
+
+    def tell(self) -> int:
+        return self.position
+
+
+def open_image(image_bytes: Union[bytes, memoryview]) -> Image.Image:
+    """
+    Open, without decoding, the image in ``image_bytes`` without copying it.
+    """
+    return Image.open(MemoryReader(image_bytes))
+
+
+def decode_image(image_bytes: Union[bytes, memoryview],
+                 draft_size: Optional[Tuple[int, int]] = None) -> Image.Image:
+    """
+    Decode raw upload bytes into a fully loaded PIL image.
+
+    Args:
+        image_bytes (Union[bytes, memoryview]): The raw image data.
+        draft_size (Optional[Tuple[int, int]]): If given, JPEGs are decoded at
+            the smallest 1/2, 1/4 or 1/8 scale that is still at least this
+            large, which skips most of the decoding work for large photos.
+
+    Raises:
+        ValueError: If the image has more than IMAGE_MAX_PIXELS pixels to decode.
+        Exception: If the bytes cannot be decoded as an image.
+    """
+    BYTES_IN.inc(len(image_bytes))
+    with stage("decode"):
+        img = open_image(image_bytes)
+        if draft_size and img.format == 'JPEG':
+            img.draft(img.mode, draft_size)
+        check_pixels(img)
+        img.load()
+    return img
+
+
+def check_pixels(img: Image.Image) -> None:
+    """
+    Reject an opened, not yet decoded image with more than IMAGE_MAX_PIXELS pixels.
+
+    Raises:
+        ValueError: If the image (at its draft scale, if any) is too large.
+    """
+    width, height = img.size
+    if width * height > settings.IMAGE_MAX_PIXELS:
+        raise ValueError(f"Image has {width * height} pixels, more than {settings.IMAGE_MAX_PIXELS}")
+
+
+def process_image(image_bytes: bytes, file_name: str, file_type: str,
+                  thumbnail: bool = False) -> ProcessedImage:
+    """
+    Run an upload through the decode, resize and encode stages.
+
+    JPEGs at least twice the target size are decoded at a reduced scale.
+    The image is resized so that, once upright, it is TARGET_WIDTH wide,
+    preserving its aspect ratio. Its EXIF orientation is then applied to
+    the downscaled image, which is much cheaper than rotating the full
+    resolution one. RGBA images are flattened to RGB, the upright image is
+    hashed with dhash for near-duplicate lookups and the result is
+    encoded in the format resolved from the upload's MIME type. With
+    IMAGE_METADATA_POLICY "strip" only the ICC profile is kept; with
+    "keep" the EXIF data is carried over with its orientation reset.
+
+    Args:
+        image_bytes (bytes): The raw image data.
+        file_name (str): The original filename.
+        file_type (str): The MIME type of the upload.
+        thumbnail (bool): Also return a THUMBNAIL_SIZE square thumbnail of the output.
+
+    Returns:
+        ProcessedImage: The encoded output, its format, dimensions, source orientation and hash.
+
+    Raises:
+        Exception: If the image cannot be decoded or encoded.
+    """
+    # Square, so that either side can become the upright width.
+    img = decode_image(image_bytes, draft_size=(TARGET_WIDTH, TARGET_WIDTH))
+    source_format = img.format
+    exif = img.getexif()
+    orientation = exif.get(EXIF_ORIENTATION, 1)
+    if orientation not in ORIENTATION_TRANSPOSE:
+        orientation = 1
+    icc_profile = img.info.get("icc_profile")
+
+    with stage("resize"):
+        width, height = img.size
+        upright_width = height if orientation in SWAPPED_ORIENTATIONS else width
+        if upright_width != TARGET_WIDTH:
+            ratio = TARGET_WIDTH / float(upright_width)
+            if orientation in SWAPPED_ORIENTATIONS:
+                new_size = (int(float(width) * ratio), TARGET_WIDTH)
+            else:
+                new_size = (TARGET_WIDTH, int(float(height) * ratio))
+            img = img.resize(new_size, Image.LANCZOS)
+
+        if orientation != 1:
+            img = img.transpose(ORIENTATION_TRANSPOSE[orientation])
+
+        if img.mode == "RGBA":
+            img = img.convert("RGB")
+
+    with stage("hash"):
+        phash = dhash(img)
+
+    small = None
+    if thumbnail:
+        small = img.convert("RGB").resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.BILINEAR, reducing_gap=2.0)
+
+    image_format = resolve_image_format(file_type, file_name, source_format)
+
+    save_options = {}
+    if icc_profile:
+        save_options["icc_profile"] = icc_profile
+    if settings.IMAGE_METADATA_POLICY == "keep" and exif:
+        exif[EXIF_ORIENTATION] = 1
+        save_options["exif"] = exif.tobytes()
+    # Drop the metadata the decoder attached, which some encoders would
+    # otherwise copy to the output; keys such as transparency are kept.
+    for key in METADATA_INFO_KEYS:
+        img.info.pop(key, None)
+
+    with stage("encode"):
+        img_io = io.BytesIO()
+        img.save(img_io, format=image_format, **save_options)
+        content = img_io.getvalue()
+
+    BYTES_OUT.inc(len(content))
+    return ProcessedImage(content, image_format, img.width, img.height, orientation, phash, small)
@@ -0,0 +1,175 @@
+# profiling.py
+"""
+Opt-in cProfile/tracemalloc capture for upload requests and tasks.
+
+Profiles are written to ``PROFILE_DIR/<kind>/`` as a ``.prof`` file that
+``pstats`` can load and a ``.json`` sidecar holding the tracemalloc peak and
+top allocation sites. Requests are profiled when they carry the
+``X-Profile`` header (only if ``PROFILE_ALLOW_HEADER`` is enabled); tasks are
+profiled when their publisher asked for it or for a random
+``PROFILE_TASK_SAMPLE_RATE`` fraction of runs. The ``aggregate_profiles``
+management command merges the captured data.
+
+cProfile and tracemalloc are process-wide, so a process captures one
+profile at a time: a block asking to be profiled while another is skips
+profiling and just runs.
+"""
+import cProfile
+import json
+import logging
+import os
+import random
+import threading
+import time
+import tracemalloc
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Iterator, NamedTuple, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpRequest
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "HTTP_X_PROFILE"
+
+# Held while a profile is being captured in this process.
+_capture_lock = threading.Lock()
+
+
+class Capture(NamedTuple):
+    """
+    A profile being captured.
+
+    Attributes:
+        profiler (cProfile.Profile): The enabled profiler.
+        started (float): perf_counter() when the capture started.
+        tracemalloc (bool): Whether the capture started tracemalloc and stops it.
+    """
+    profiler: cProfile.Profile
+    started: float
+    tracemalloc: bool
+
+
+def profiling_requested(request: HttpRequest) -> bool:
+    """
+    Return True if the client asked for this request to be profiled.
+
+    Args:
+        request (HttpRequest): The incoming request.
+    """
+    return settings.PROFILE_ALLOW_HEADER and request.META.get(PROFILE_HEADER, "") not in ("", "0")
+
+
+def should_profile_task(task_request) -> bool:
+    """
+    Decide whether the current task run should be profiled.
+
+    Args:
+        task_request: The Celery task request context.
+
+    Returns:
+        bool: True if the publisher set the ``profile`` header or the run was sampled.
+    """
+    if getattr(task_request, "profile", False):
+        return True
+    return random.random() < settings.PROFILE_TASK_SAMPLE_RATE
+
+
+@contextmanager
+def profiled(kind: str, label: str, enabled: bool = True) -> Iterator[None]:
+    """
+    Profile the enclosed block and write the results to PROFILE_DIR.
+
+    cProfile only observes the calling thread. Coroutines use aprofiled instead.
+
+    Args:
+        kind (str): Sub-directory grouping comparable profiles (e.g. the task name).
+        label (str): Identifier included in the file name, such as the ImageUpload id.
+        enabled (bool): If False the block runs without any profiling overhead.
+    """
+    capture = start_capture(kind, label) if enabled else None
+    try:
+        yield
+    finally:
+        if capture is not None:
+            write_profile(kind, label, *finish_capture(capture, kind, label))
+
+
+@asynccontextmanager
+async def aprofiled(kind: str, label: str, enabled: bool = True) -> AsyncIterator[None]:
+    """
+    Profile the enclosed block of a coroutine, like profiled.
+
+    The profile also records any other coroutine scheduled while the block
+    is suspended. Its files are written from a thread, off the event loop.
+    """
+    capture = start_capture(kind, label) if enabled else None
+    try:
+        yield
+    finally:
+        if capture is not None:
+            await sync_to_async(write_profile, thread_sensitive=False)(
+                kind, label, *finish_capture(capture, kind, label)
+            )
+
+
+def start_capture(kind: str, label: str) -> Optional[Capture]:
+    """
+    Start profiling, unless this process is already capturing a profile.
+
+    Returns:
+        Optional[Capture]: The capture to finish, or None if profiling was skipped.
+    """
+    if not _capture_lock.acquire(blocking=False):
+        logger.info(f"Skipped profiling {kind}/{label}: another profile is being captured")
+        return None
+    try:
+        start_tracemalloc = settings.PROFILE_TRACEMALLOC and not tracemalloc.is_tracing()
+        if start_tracemalloc:
+            tracemalloc.start()
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+    except BaseException:
+        _capture_lock.release()
+        raise
+    return Capture(profiler, started, start_tracemalloc)
+
+
+def finish_capture(capture: Capture, kind: str, label: str) -> Tuple[cProfile.Profile, dict]:
+    """
+    Stop a capture and let the next one start.
+
+    Returns:
+        Tuple[cProfile.Profile, dict]: The profiler and the report to write next to it.
+    """
+    try:
+        capture.profiler.disable()
+        elapsed = time.perf_counter() - capture.started
+        report = {"kind": kind, "label": label, "elapsed": elapsed, "pid": os.getpid()}
+        if capture.tracemalloc:
+            report["tracemalloc_peak"] = tracemalloc.get_traced_memory()[1]
+            report["top_allocations"] = [
+                {"site": str(stat.traceback), "size": stat.size, "count": stat.count}
+                for stat in tracemalloc.take_snapshot().statistics("lineno")[:settings.PROFILE_TOP_ALLOCATIONS]
+            ]
+            tracemalloc.stop()
+    finally:
+        _capture_lock.release()
+    return capture.profiler, report
+
+
+def write_profile(kind: str, label: str, profiler: cProfile.Profile, report: dict) -> None:
+    """
+    Write a finished capture to PROFILE_DIR/<kind>/, logging rather than raising on failure.
+    """
+    directory = os.path.join(settings.PROFILE_DIR, kind)
+    base_name = os.path.join(directory, f"{label}-{time.time_ns()}-{os.getpid()}")
+    try:
+        os.makedirs(directory, exist_ok=True)
+        profiler.dump_stats(f"{base_name}.prof")
+        with open(f"{base_name}.json", "w") as report_file:
+            json.dump(report, report_file)
+    except OSError as e:
+        logger.warning(f"Could not write profile {kind}/{label}: {e}")
@@ -0,0 +1,82 @@
+# protocol.py
+"""
+Compact WebSocket notification protocol.
+
+Clients opt in by offering one of the COMPACT_SUBPROTOCOLS in the WebSocket
+handshake. Compact frames carry a list of events, each a small dict with
+short keys and a numeric status code instead of the verbose notification:
+
+    j: job_id      s: status code (see STATUS_CODES)
+    n: name        z: size in bytes        q: event sequence number
+    t: upload_time u: processed image URL
+
+With ``upload.compact.msgpack`` frames are binary msgpack; with
+``upload.compact.json`` they are JSON text. Compact frames never inline the
+processed image: clients fetch it from ``u``, so no consumer has to decode
+or re-encode the data URI the verbose protocol carries, once per client.
+"""
+import json
+from typing import Dict, Iterable, List, Optional, Union
+
+import msgpack
+
+SUBPROTOCOL_MSGPACK = "upload.compact.msgpack"
+SUBPROTOCOL_JSON = "upload.compact.json"
+COMPACT_SUBPROTOCOLS = (SUBPROTOCOL_MSGPACK, SUBPROTOCOL_JSON)
+
+STATUS_CODES = {
+    'pending': 0,
+    'processing': 1,
+    'completed': 2,
+    'aborted': 3,
+    'error': 4,
+}
+TERMINAL_STATUSES = ('completed', 'aborted', 'error')
+
+
+def negotiate_subprotocol(offered: Iterable[str]) -> Optional[str]:
+    """
+    Pick the first compact subprotocol offered by the client.
+
+    Returns:
+        Optional[str]: The accepted subprotocol, or None for the verbose JSON protocol.
+    """
+    for subprotocol in offered:
+        if subprotocol in COMPACT_SUBPROTOCOLS:
+            return subprotocol
+    return None
+
+
+def compact_event(event: Dict) -> Dict:
+    """
+    Convert a send_upload_notification event to its compact form.
+
+    Args:
+        event (dict): The channel layer event; its ``image`` data URI is left out.
+    """
+    data = {
+        'j': event['job_id'],
+        's': STATUS_CODES.get(event['status'], -1),
+        'n': event['name'],
+        'z': event['size'],
+    }
+    if 'seq' in event:
+        data['q'] = event['seq']
+    if event.get('upload_time'):
+        data['t'] = event['upload_time']
+    if event.get('image_url'):
+        data['u'] = event['image_url']
+    return data
+
+
+def encode_frame(events: List[Dict], subprotocol: str) -> Union[bytes, str]:
+    """
+    Encode a batch of events as one frame for the negotiated subprotocol.
+
+    Returns:
+        Union[bytes, str]: Binary data for msgpack, text for compact JSON.
+    """
+    payload = [compact_event(event) for event in events]
+    if subprotocol == SUBPROTOCOL_MSGPACK:
+        return msgpack.packb(payload, use_bin_type=True)
+    return json.dumps(payload, separators=(',', ':'))
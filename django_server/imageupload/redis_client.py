@@ -0,0 +1,74 @@
+# redis_client.py
+"""
+Process-wide Redis connection pools.
+
+Every client handed out here shares one BlockingConnectionPool per Redis URL,
+so the upload event log, the scaling signals and the broker inspection reuse
+the same connections. A pool holds at most REDIS_MAX_CONNECTIONS; a caller
+waits up to REDIS_POOL_TIMEOUT seconds for a free one. redis-py recreates a
+pool's connections in forked children.
+"""
+from typing import Dict, Tuple
+
+import redis
+from django.conf import settings
+
+_pools: Dict[str, redis.BlockingConnectionPool] = {}
+
+
+def get_pool(url: str) -> redis.BlockingConnectionPool:
+    """
+    Return the process-wide connection pool for ``url``, creating it on first use.
+    """
+    pool = _pools.get(url)
+    if pool is None:
+        pool = _pools[url] = redis.BlockingConnectionPool.from_url(
+            url,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+            health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+        )
+    return pool
+
+
+def get_redis() -> redis.Redis:
+    """
+    Return a Redis client backed by the process-wide connection pool.
+
+    Returns:
+        redis.Redis: A client for settings.REDIS_URL.
+    """
+    return redis.Redis(connection_pool=get_pool(settings.REDIS_URL))
+
+
+def get_broker_redis() -> redis.Redis:
+    """
+    Return a Redis client for the Celery broker, to inspect its queues.
+
+    Returns:
+        redis.Redis: A client for settings.CELERY_BROKER_URL.
+    """
+    return redis.Redis(connection_pool=get_pool(settings.CELERY_BROKER_URL))
+
+
+def blocking_pool_stats(pool: redis.BlockingConnectionPool) -> Tuple[int, int, int]:
+    """
+    Count the connections of a blocking pool.
+
+    Returns:
+        Tuple[int, int, int]: Connections in use, idle connections and the pool's limit.
+    """
+    idle = sum(1 for connection in list(pool.pool.queue) if connection is not None)
+    return len(pool._connections) - idle, idle, pool.max_connections
+
+
+def pool_stats() -> Dict[str, Tuple[int, int, int]]:
+    """
+    Return blocking_pool_stats of every pool of this process, by Redis address.
+    """
+    stats = {}
+    for pool in list(_pools.values()):
+        kwargs = pool.connection_kwargs
+        address = f"{kwargs.get('host', 'localhost')}:{kwargs.get('port', 6379)}/{kwargs.get('db', 0)}"
+        stats[address] = blocking_pool_stats(pool)
+    return stats
@@ -0,0 +1,324 @@
+# renditions.py
+"""
+Derivatives of processed images, rendered on request and cached on disk.
+
+A rendition is the stored master of an image resized to a width and
+encoded in a format and quality, all snapped to the RENDER_WIDTHS,
+RENDER_FORMATS and RENDER_QUALITIES whitelists so that each image has a
+bounded number of renditions. Renditions are written under
+RENDER_CACHE_DIR:
+
+- Concurrent requests for the same rendition are collapsed: the renderer
+  holds an exclusive ``flock`` on the rendition's lock file, one of
+  RENDER_LOCK_STRIPES files picked by a hash of the rendition's path, and
+  requests waiting on it find the file already written once they get the
+  lock. Only requests for renditions hashed to the same stripe wait on
+  it, and the number of lock files stays fixed. A request that does not
+  get the lock within RENDER_LOCK_TIMEOUT seconds renders the rendition
+  itself. The lock works across threads, processes and containers sharing
+  the directory.
+- The cache is kept under RENDER_CACHE_MAX_BYTES. Hits refresh a file's
+  mtime; a sweep deleting the least recently used files is run after a
+  rendition is written, at most every RENDER_CACHE_SWEEP_INTERVAL seconds.
+  Renditions are returned open, so a file swept while it is being sent is
+  still sent whole.
+"""
+import fcntl
+import hashlib
+import io
+import os
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, NamedTuple, Optional, Sequence
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from PIL import Image
+
+from .metrics import RENDER_REQUESTS
+from .processing import decode_image
+from .tracing import stage
+
+# Formats encoded with a quality setting; the others are lossless.
+LOSSY_FORMATS = ("JPEG", "WebP")
+
+# The sweep deletes files until the cache is back under this share of the budget.
+SWEEP_LOW_WATERMARK = 0.9
+
+_last_sweep = 0.0
+
+
+class RenderSpec(NamedTuple):
+    """
+    A whitelisted rendition of an image.
+
+    Attributes:
+        width (int): Width in pixels, one of RENDER_WIDTHS.
+        image_format (str): The PIL format name, one of RENDER_FORMATS.
+        quality (int): Encoder quality, one of RENDER_QUALITIES; 0 for lossless formats.
+    """
+    width: int
+    image_format: str
+    quality: int
+
+    @property
+    def content_type(self) -> str:
+        return f"image/{self.image_format.lower()}"
+
+    @property
+    def extension(self) -> str:
+        return self.image_format.lower()
+
+
+class Rendition(NamedTuple):
+    """
+    A rendition file in the cache.
+
+    Attributes:
+        file (BinaryIO): The cached file, open for reading; the caller closes it.
+        spec (RenderSpec): What the file holds.
+        cached (bool): Whether the file was already cached, rather than rendered for this request.
+    """
+    file: BinaryIO
+    spec: RenderSpec
+    cached: bool
+
+
+def snap(value: int, allowed: Sequence[int]) -> int:
+    """
+    Return the smallest allowed value not below ``value``, or the largest one.
+    """
+    candidates = sorted(allowed)
+    for candidate in candidates:
+        if candidate >= value:
+            return candidate
+    return candidates[-1]
+
+
+def parse_spec(params: Dict) -> RenderSpec:
+    """
+    Build a RenderSpec from the ``w``, ``fmt`` and ``q`` query parameters.
+
+    Missing parameters take the largest width, the first format and
+    RENDER_DEFAULT_QUALITY; the others are snapped to the whitelists.
+
+    Raises:
+        ValueError: If a parameter is not a number or the format is unknown.
+    """
+    try:
+        width = int(params.get("w") or max(settings.RENDER_WIDTHS))
+        quality = int(params.get("q") or settings.RENDER_DEFAULT_QUALITY)
+    except ValueError:
+        raise ValueError("w and q must be integers")
+    fmt = (params.get("fmt") or next(iter(settings.RENDER_FORMATS))).lower()
+    if fmt not in settings.RENDER_FORMATS:
+        raise ValueError(f"fmt must be one of {', '.join(settings.RENDER_FORMATS)}")
+    image_format = settings.RENDER_FORMATS[fmt]
+    quality = snap(quality, settings.RENDER_QUALITIES) if image_format in LOSSY_FORMATS else 0
+    return RenderSpec(snap(width, settings.RENDER_WIDTHS), image_format, quality)
+
+
+def cache_path(image_upload, spec: RenderSpec) -> str:
+    """
+    Return the cache path of a rendition of an ImageUpload.
+
+    The name includes a digest of the master's name and processing time, so
+    renditions of a reprocessed image are not served from the old master.
+    """
+    key = image_upload.id.hex
+    finished_at = image_upload.finished_at.timestamp() if image_upload.finished_at else ""
+    master = f"{image_upload.image.name}:{finished_at}"
+    version = hashlib.sha1(master.encode()).hexdigest()[:8]
+    name = f"{key}-{version}-w{spec.width}-q{spec.quality}.{spec.extension}"
+    return os.path.join(settings.RENDER_CACHE_DIR, key[:2], key[2:4], name)
+
+
+@contextmanager
+def cache_lock(name: str, timeout: float = 0):
+    """
+    Hold an exclusive lock on the lock file ``name`` of the cache.
+
+    Args:
+        name (str): The lock file's name, without extension.
+        timeout (float): Seconds to keep retrying a held lock; 0 tries once.
+
+    Yields:
+        bool: Whether the lock was acquired.
+    """
+    lock_dir = os.path.join(settings.RENDER_CACHE_DIR, "locks")
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, f"{name}.lock"), "a") as lock_file:
+        deadline = time.monotonic() + timeout
+        pause = 0.01
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    yield False
+                    return
+                time.sleep(pause)
+                pause = min(pause * 2, 0.2)
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def rendition_lock(path: str):
+    """
+    Hold the lock of the rendition at a cache path for up to RENDER_LOCK_TIMEOUT seconds.
+
+    The lock is the stripe of the path relative to RENDER_CACHE_DIR, so it
+    is the same in every container whatever the directory is mounted as.
+    """
+    key = os.path.relpath(path, settings.RENDER_CACHE_DIR)
+    stripe = zlib.crc32(key.encode()) % settings.RENDER_LOCK_STRIPES
+    return cache_lock(f"stripe-{stripe}", timeout=settings.RENDER_LOCK_TIMEOUT)
+
+
+def render(image_bytes: bytes, spec: RenderSpec) -> bytes:
+    """
+    Resize and encode a master image according to ``spec``.
+
+    Masters narrower than the requested width are not upscaled.
+    """
+    img = decode_image(image_bytes, draft_size=(spec.width, spec.width))
+    with stage("render"):
+        if img.width > spec.width:
+            height = max(1, round(img.height * spec.width / img.width))
+            img = img.resize((spec.width, height), Image.LANCZOS, reducing_gap=3.0)
+        if spec.image_format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        save_options = {"quality": spec.quality} if spec.quality else {"optimize": True}
+        if img.info.get("icc_profile"):
+            save_options["icc_profile"] = img.info["icc_profile"]
+        output = io.BytesIO()
+        img.save(output, format=spec.image_format, **save_options)
+    return output.getvalue()
+
+
+def get_rendition(image_upload, spec: RenderSpec) -> Rendition:
+    """
+    Return the cached rendition of an ImageUpload, rendering it on a miss.
+
+    Blocks on file I/O, the rendition's lock and rendering; async callers
+    run it in a thread of their own.
+
+    Raises:
+        Exception: If the master cannot be read or rendered.
+    """
+    path = cache_path(image_upload, spec)
+    cached = open_cached(path)
+    if cached is not None:
+        RENDER_REQUESTS.labels("hit").inc()
+        return Rendition(cached, spec, True)
+
+    with rendition_lock(path) as locked:
+        # Another request may have rendered it while this one waited.
+        cached = open_cached(path)
+        if cached is not None:
+            RENDER_REQUESTS.labels("coalesced").inc()
+            return Rendition(cached, spec, True)
+        with default_storage.open(image_upload.image.name, "rb") as master:
+            content = render(master.read(), spec)
+        write_atomic(path, content)
+        rendered = open(path, "rb")
+    RENDER_REQUESTS.labels("miss" if locked else "lock_timeout").inc()
+    maybe_sweep()
+    return Rendition(rendered, spec, False)
+
+
+def open_cached(path: str) -> Optional[BinaryIO]:
+    """
+    Open a cached file and mark it as recently used.
+
+    Returns:
+        Optional[BinaryIO]: The open file, or None if it is not cached.
+    """
+    try:
+        cached = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    try:
+        os.utime(cached.fileno())
+    except OSError:
+        pass
+    return cached
+
+
+def write_atomic(path: str, content: bytes) -> None:
+    """
+    Write ``content`` to ``path`` so that readers never see a partial file.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def maybe_sweep() -> None:
+    """
+    Run sweep_cache if this process has not run it for RENDER_CACHE_SWEEP_INTERVAL seconds.
+    """
+    global _last_sweep
+    now = time.monotonic()
+    if now - _last_sweep < settings.RENDER_CACHE_SWEEP_INTERVAL:
+        return
+    _last_sweep = now
+    sweep_cache()
+
+
+def sweep_cache(max_bytes: Optional[int] = None) -> int:
+    """
+    Delete the least recently used renditions until the cache fits its budget.
+
+    Once the cache exceeds ``max_bytes`` (RENDER_CACHE_MAX_BYTES by
+    default), files are deleted oldest mtime first until it is below
+    SWEEP_LOW_WATERMARK of the budget. Only one process sweeps at a time;
+    others skip the sweep.
+
+    Returns:
+        int: Bytes deleted.
+    """
+    max_bytes = settings.RENDER_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    with cache_lock("sweep") as acquired:
+        if not acquired:
+            return 0
+        entries = []
+        total = 0
+        for directory, subdirectories, files in os.walk(settings.RENDER_CACHE_DIR):
+            if directory == settings.RENDER_CACHE_DIR and "locks" in subdirectories:
+                subdirectories.remove("locks")
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        if total <= max_bytes:
+            return 0
+
+        deleted = 0
+        target = max_bytes * SWEEP_LOW_WATERMARK
+        for _, size, path in sorted(entries):
+            if total - deleted <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            deleted += size
+        return deleted
@@ -0,0 +1,250 @@
+# scaling.py
+"""
+Scaling signals for the image workers and a Celery autoscaler driven by them.
+
+The signals are read from the broker and the images table:
+
+- queue depth and the age of the oldest message of each SCALING_QUEUES queue,
+- the number and total size of images that are pending or processing,
+- the average time a worker spends per image, over the last
+  SCALING_SAMPLE_SIZE images processed by the image tasks,
+- the number of live workers, each running LatencyAutoscaler, which
+  heartbeat in Redis and count as gone after SCALING_WORKER_TTL seconds.
+
+They are exported on ``/metrics`` and used by LatencyAutoscaler, which sizes
+each worker's pool to its share of what drains the backlog within
+SCALING_TARGET_LATENCY seconds. Enable it with ``celery worker
+--autoscale=<max>,<min>``; ``CELERY_WORKER_AUTOSCALER`` points Celery at it.
+"""
+import json
+import logging
+import math
+import os
+import socket
+import time
+from typing import Dict, NamedTuple, Optional
+
+from celery.signals import task_postrun, task_prerun
+from celery.worker.autoscale import Autoscaler
+from django.conf import settings
+from django.db.models import Count, Sum
+from prometheus_client.core import GaugeMetricFamily
+
+from .models import ACTIVE_STATUSES, ImageUpload
+from .redis_client import get_broker_redis, get_redis
+
+logger = logging.getLogger(__name__)
+
+DURATIONS_KEY = "imageupload:scaling:image_seconds"
+# Sorted set of worker names scored by their last heartbeat.
+WORKERS_KEY = "imageupload:scaling:workers"
+
+# Tasks whose per-image duration is sampled; they call count_processed_image.
+IMAGE_TASKS = ("imageupload.tasks.process_and_save_image", "imageupload.tasks.process_image_batch")
+
+_task_started: Dict[str, float] = {}
+_task_images: Dict[str, int] = {}
+
+
+class ScalingSignals(NamedTuple):
+    """
+    Snapshot of the load on the image workers.
+
+    Attributes:
+        queue_depth (dict): Messages waiting per queue.
+        oldest_age (dict): Seconds the oldest waiting message of each queue has been queued.
+        in_flight_images (int): Images pending or processing.
+        in_flight_bytes (int): Uploaded bytes of the images pending or processing.
+        image_seconds (Optional[float]): Average worker time per image, None before any sample.
+        live_workers (int): Workers that sent a heartbeat within SCALING_WORKER_TTL seconds.
+    """
+    queue_depth: Dict[str, int]
+    oldest_age: Dict[str, float]
+    in_flight_images: int
+    in_flight_bytes: int
+    image_seconds: Optional[float]
+    live_workers: int
+
+
+def read_signals() -> ScalingSignals:
+    """
+    Read the current scaling signals from the broker, Redis and the database.
+
+    Raises:
+        Exception: If the broker, Redis or the database cannot be reached.
+    """
+    broker = get_broker_redis()
+    now = time.time()
+    queue_depth = {}
+    oldest_age = {}
+    for queue in settings.SCALING_QUEUES:
+        queue_depth[queue] = broker.llen(queue)
+        # Kombu pushes on the left and consumes from the right.
+        oldest = broker.lindex(queue, -1)
+        published_at = json.loads(oldest).get("headers", {}).get("published_at") if oldest else None
+        oldest_age[queue] = max(0.0, now - published_at) if published_at else 0.0
+
+    active = ImageUpload.objects.filter(status__in=ACTIVE_STATUSES).aggregate(
+        images=Count('id'), bytes=Sum('size')
+    )
+    client = get_redis()
+    samples = [float(sample) for sample in client.lrange(DURATIONS_KEY, 0, -1)]
+    return ScalingSignals(
+        queue_depth=queue_depth,
+        oldest_age=oldest_age,
+        in_flight_images=active['images'],
+        in_flight_bytes=active['bytes'] or 0,
+        image_seconds=sum(samples) / len(samples) if samples else None,
+        live_workers=client.zcount(WORKERS_KEY, now - settings.SCALING_WORKER_TTL, "+inf"),
+    )
+
+
+def record_heartbeat(worker_name: str) -> None:
+    """
+    Mark a worker as live, and forget the workers gone for SCALING_WORKER_TTL seconds.
+
+    Raises:
+        Exception: If Redis cannot be reached.
+    """
+    now = time.time()
+    with get_redis().pipeline() as pipe:
+        pipe.zadd(WORKERS_KEY, {worker_name: now})
+        pipe.zremrangebyscore(WORKERS_KEY, "-inf", now - settings.SCALING_WORKER_TTL)
+        pipe.execute()
+
+
+def desired_concurrency(signals: ScalingSignals, min_concurrency: int, max_concurrency: int) -> Optional[int]:
+    """
+    Compute one worker's pool size so all of them drain the backlog within SCALING_TARGET_LATENCY.
+
+    With ``n`` processes, ``in_flight_images`` images of ``image_seconds``
+    each take ``in_flight_images * image_seconds / n`` seconds to finish.
+    When the oldest queued message is already older than the target, the
+    estimate is scaled up by how far behind the queue is. The backlog is
+    shared by every live worker, so each provides its share of the processes.
+
+    Returns:
+        Optional[int]: The pool size between the bounds, or None without a
+        processing time sample to base it on.
+    """
+    if signals.image_seconds is None:
+        return None
+    target = settings.SCALING_TARGET_LATENCY
+    needed = signals.in_flight_images * signals.image_seconds / target
+    lag = max(signals.oldest_age.values(), default=0.0)
+    if lag > target:
+        needed *= lag / target
+    needed /= max(1, signals.live_workers)
+    return max(min_concurrency, min(max_concurrency, math.ceil(needed)))
+
+
+class LatencyAutoscaler(Autoscaler):
+    """
+    Celery autoscaler sizing the pool from the scaling signals.
+
+    Celery's default autoscaler grows the pool to the number of prefetched
+    tasks; this one grows it to desired_concurrency and falls back to the
+    default when the signals are unavailable. Signals are refreshed at most
+    every SCALING_REFRESH_INTERVAL seconds, since the pool size is checked
+    on every received task; each refresh also sends this worker's heartbeat.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._desired = None
+        self._refreshed_at = 0.0
+        hostname = getattr(self.worker, "hostname", None) or socket.gethostname()
+        self._worker_name = f"{hostname}:{os.getpid()}"
+
+    @property
+    def qty(self):
+        now = time.monotonic()
+        if now - self._refreshed_at >= settings.SCALING_REFRESH_INTERVAL:
+            self._refreshed_at = now
+            try:
+                record_heartbeat(self._worker_name)
+                self._desired = desired_concurrency(read_signals(), self.min_concurrency, self.max_concurrency)
+            except Exception as e:
+                logger.warning(f"Scaling signals unavailable: {e}")
+                self._desired = None
+        if self._desired is None:
+            return super().qty
+        return self._desired
+
+
+class ScalingSignalsCollector:
+    """
+    Prometheus collector reading the scaling signals at scrape time.
+    """
+
+    def collect(self):
+        try:
+            signals = read_signals()
+        except Exception as e:
+            logger.warning(f"Scaling signals unavailable: {e}")
+            return
+
+        queue_depth = GaugeMetricFamily(
+            "imageupload_queue_depth", "Messages waiting in the broker queue.", labels=["queue"]
+        )
+        oldest_age = GaugeMetricFamily(
+            "imageupload_queue_oldest_message_age_seconds",
+            "Seconds the oldest waiting message has been queued.",
+            labels=["queue"],
+        )
+        for queue, depth in signals.queue_depth.items():
+            queue_depth.add_metric([queue], depth)
+            oldest_age.add_metric([queue], signals.oldest_age[queue])
+        yield queue_depth
+        yield oldest_age
+        yield GaugeMetricFamily(
+            "imageupload_in_flight_images", "Images pending or processing.", value=signals.in_flight_images
+        )
+        yield GaugeMetricFamily(
+            "imageupload_in_flight_bytes",
+            "Uploaded bytes of the images pending or processing.",
+            value=signals.in_flight_bytes,
+        )
+        yield GaugeMetricFamily(
+            "imageupload_live_workers", "Autoscaled workers sharing the backlog.", value=signals.live_workers
+        )
+        if signals.image_seconds is not None:
+            yield GaugeMetricFamily(
+                "imageupload_image_processing_seconds_avg",
+                "Average worker time per image over recent image tasks.",
+                value=signals.image_seconds,
+            )
+
+
+@task_prerun.connect
+def start_image_timer(task_id=None, task=None, **kwargs):
+    """Remember when an image task started."""
+    if task.name in IMAGE_TASKS:
+        _task_started[task_id] = time.monotonic()
+
+
+def count_processed_image(task_id: str) -> None:
+    """
+    Count an image the running image task has decoded and processed.
+
+    Images a task skips, because they were cancelled or handed to another
+    task, are not counted, so they do not dilute its per-image duration.
+    """
+    if task_id in _task_started:
+        _task_images[task_id] = _task_images.get(task_id, 0) + 1
+
+
+@task_postrun.connect
+def record_image_seconds(task_id=None, task=None, state=None, **kwargs):
+    """Record the per-image duration of a successful image task."""
+    started = _task_started.pop(task_id, None)
+    images = _task_images.pop(task_id, 0)
+    if started is None or state != "SUCCESS" or not images:
+        return
+    try:
+        with get_redis().pipeline() as pipe:
+            pipe.lpush(DURATIONS_KEY, (time.monotonic() - started) / images)
+            pipe.ltrim(DURATIONS_KEY, 0, settings.SCALING_SAMPLE_SIZE - 1)
+            pipe.execute()
+    except Exception as e:
+        logger.warning(f"Could not record image duration: {e}")
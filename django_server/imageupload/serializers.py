@@ -8,12 +8,13 @@ class ImageUploadSerializer(serializers.ModelSerializer):
 
     This serializer is responsible for converting ImageUpload model instances
     to JSON representations and vice versa. It includes all fields from the
-    ImageUpload model.
+    ImageUpload model except the perceptual hash bands, which only serve
+    the similarity index.
 
     Attributes:
         model (Model): The Django model class being serialized.
-        fields (str): Specifies which model fields to include in the serialized output.
+        exclude (list): Model fields left out of the serialized output.
     """
     class Meta:
         model = ImageUpload
-        fields = "__all__" 
+        exclude = ["phash_band0", "phash_band1", "phash_band2", "phash_band3"] 
@@ -0,0 +1,87 @@
+# similarity.py
+"""
+Near-duplicate lookups over the perceptual hashes of processed images.
+
+Every processed image stores its 64-bit dHash split into PHASH_BANDS
+indexed 16-bit bands (banded LSH). If two hashes differ in at most
+PHASH_BANDS - 1 bits, at least one band is identical in both, so the
+candidates for a query are the rows matching any of its bands: a handful
+of index lookups, however many images are stored. The database then
+computes each candidate's exact Hamming distance, filters on it and returns
+the closest SIMILAR_MAX_RESULTS matches, so no match is lost to an
+arbitrary cut of the candidates.
+"""
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import BigIntegerField, F, Func, IntegerField, Q, Value
+from django.db.models.functions import Cast
+
+from .models import ImageUpload
+from .processing import HASH_SIZE, PHASH_BANDS, hash_columns
+
+# Largest distance the band lookup is guaranteed to find every match for.
+MAX_DISTANCE = PHASH_BANDS - 1
+
+HASH_BITS = HASH_SIZE * HASH_SIZE
+HASH_MASK = (1 << HASH_BITS) - 1
+
+
+class HammingDistance(Func):
+    """
+    Number of bits in which a signed 64-bit hash column differs from ``phash``.
+
+    PostgreSQL (14+) counts the bits of the XOR with bit_count(); other
+    databases sum the bits that differ, one shift per bit.
+    """
+    output_field = IntegerField()
+
+    def __init__(self, column: str, phash: int):
+        self.phash = phash & HASH_MASK
+        super().__init__(F(column), Cast(Value(hash_columns(self.phash)['phash']), BigIntegerField()))
+
+    def as_sql(self, compiler, connection, **extra_context):
+        column, params = compiler.compile(self.source_expressions[0])
+        terms = []
+        for bit in range(HASH_BITS):
+            column_bit = f"(({column} >> {bit}) & 1)"
+            terms.append(f"(1 - {column_bit})" if self.phash >> bit & 1 else column_bit)
+        return f"({' + '.join(terms)})", params * HASH_BITS
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return super().as_sql(
+            compiler, connection, template="bit_count((%(expressions)s)::bit(64))", arg_joiner=" # ",
+            **extra_context
+        )
+
+
+def find_similar(phash: int, max_distance: int = MAX_DISTANCE,
+                 exclude_id: Optional[str] = None) -> Tuple[List[Tuple[ImageUpload, int]], bool]:
+    """
+    Find the images whose hash is within ``max_distance`` bits of ``phash``.
+
+    Args:
+        phash (int): The hash to search for.
+        max_distance (int): The largest Hamming distance to return, at most MAX_DISTANCE.
+        exclude_id (Optional[str]): An image to leave out, usually the one searched for.
+
+    Returns:
+        Tuple[List[Tuple[ImageUpload, int]], bool]: At most SIMILAR_MAX_RESULTS
+        matching images and their distances, closest first, and whether
+        further matches were left out.
+    """
+    bands = hash_columns(phash & HASH_MASK)
+    query = Q()
+    for band in range(PHASH_BANDS):
+        query |= Q(**{f'phash_band{band}': bands[f'phash_band{band}']})
+
+    candidates = ImageUpload.objects.filter(query)
+    if exclude_id is not None:
+        candidates = candidates.exclude(id=exclude_id)
+    limit = settings.SIMILAR_MAX_RESULTS
+    matches = list(
+        candidates.annotate(distance=HammingDistance('phash', phash))
+        .filter(distance__lte=max_distance)
+        .order_by('distance', 'id')[:limit + 1]
+    )
+    return [(image_upload, image_upload.distance) for image_upload in matches[:limit]], len(matches) > limit
@@ -0,0 +1,149 @@
+# storage.py
+"""
+Write-behind storage for processed images.
+
+Batch tasks hand encoded images to a bounded thread pool that writes them
+to the default storage (local ``MEDIA_ROOT`` or an S3-compatible bucket,
+see ``STORAGES`` in settings) while they move on to the next image.
+Storage backends release the GIL during file and network I/O, so writes
+overlap with the CPU-bound decode/resize/encode of the following image.
+Single-image paths, which have nothing to overlap with, use write_image.
+"""
+import contextvars
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, Storage, default_storage
+
+from .tracing import stage
+
+
+def sharded_upload_to(instance, filename: str) -> str:
+    """
+    Build the storage path of an ImageUpload's image.
+
+    The name is derived from the row's UUID, which makes it collision-free
+    and deterministic: ``images/3f/a2/3fa2...c9.jpeg``. Only the extension of
+    ``filename`` is kept. Two levels of 256 directories keep every directory
+    small as the library grows.
+
+    Args:
+        instance (ImageUpload): The row the image belongs to.
+        filename (str): The file name proposed by the caller.
+
+    Returns:
+        str: The path relative to the storage root.
+    """
+    key = instance.id.hex
+    extension = os.path.splitext(filename)[1].lower()
+    return os.path.join("images", key[:2], key[2:4], f"{key}{extension}")
+
+
+class ShardedFileSystemStorage(FileSystemStorage):
+    """
+    FileSystemStorage for deterministic, collision-free file names.
+
+    Django's default storage probes the filesystem for a free name before
+    each write and appends random suffixes on conflict. Names produced by
+    sharded_upload_to are unique per row, so this storage skips the probe
+    and writes through a temporary file that atomically replaces any
+    previous version, which makes task retries idempotent.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        return name
+
+    def _save(self, name, content):
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                for chunk in content.chunks():
+                    tmp_file.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(tmp_path, self.file_permissions_mode)
+            os.replace(tmp_path, full_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return name
+
+
+class MediaWriter:
+    """
+    Bounded pool of background writers for a storage backend.
+
+    Attributes:
+        storage (Storage): The storage the files are written to.
+    """
+
+    def __init__(self, storage: Storage, max_workers: int, max_pending: int):
+        self.storage = storage
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="media-writer")
+        # Callers block once max_pending writes are in flight, bounding the
+        # memory held by encoded images waiting to be written.
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def save(self, name: str, content: bytes) -> Future:
+        """
+        Queue ``content`` to be written under ``name``.
+
+        Args:
+            name (str): The requested storage path.
+            content (bytes): The encoded file.
+
+        Returns:
+            Future: Resolves to the name the storage actually used.
+        """
+        self._slots.acquire()
+        try:
+            # Run in the caller's context so the write is traced as part of its image.
+            future = self._executor.submit(contextvars.copy_context().run, self._write, name, content)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _write(self, name: str, content: bytes) -> str:
+        return write_image(name, content, self.storage)
+
+
+def write_image(name: str, content: bytes, storage: Storage = default_storage) -> str:
+    """
+    Write an encoded image now, timed as the ``storage`` stage.
+
+    Returns:
+        str: The name the storage actually used.
+    """
+    with stage("storage"):
+        return storage.save(name, ContentFile(content))
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_media_writer() -> MediaWriter:
+    """
+    Return the process-wide MediaWriter for the default storage.
+
+    Created on first use so each forked worker process starts its own threads.
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = MediaWriter(
+                default_storage,
+                max_workers=settings.MEDIA_WRITE_WORKERS,
+                max_pending=settings.MEDIA_WRITE_MAX_PENDING,
+            )
+    return _writer
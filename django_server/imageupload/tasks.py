@@ -1,19 +1,28 @@
 from celery import shared_task
-from PIL import Image
-import io
-from django.core.files.uploadedfile import InMemoryUploadedFile
-from .models import ImageUpload
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 import base64
+import logging
+import uuid
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.core.files.storage import default_storage
 from django.utils import timezone
-import mimetypes
-from django.core.files.base import ContentFile
+from .cache import invalidate_list_cache
+from .envelope import SERIALIZER
+from .jobs import is_cancelled
 from .models import ImageUpload
+from .notifications import send_upload_notification
+from .profiling import profiled, should_profile_task
+from .scaling import count_processed_image
+from .storage import get_media_writer, write_image
+from .tracing import current_span, span
 
+logger = logging.getLogger(__name__)
 
-@shared_task
-def process_and_save_image(image_bytes, file_name, file_size, file_type, image_instance_id):
+
+@shared_task(bind=True, serializer=SERIALIZER, max_retries=settings.WORKER_MEMORY_RETRIES)
+def process_and_save_image(self, payload):
     """
     Process and save an uploaded image asynchronously.
 
@@ -24,12 +33,20 @@ def process_and_save_image(image_bytes, file_name, file_size, file_type, image_i
     4. Saves the processed image and updates the ImageUpload instance.
     5. Sends a notification that processing is complete.
 
+    The run is profiled into PROFILE_DIR when the publisher set the ``profile``
+    task header or the run is sampled by PROFILE_TASK_SAMPLE_RATE.
+
+    Images of a cancelled job are skipped, and an image whose job is
+    cancelled while it is being processed is not written. The image is only
+    marked completed (or errored) if it is still pending or processing, so a
+    cancellation or sweep landing meanwhile is never overwritten.
+
+    An image the host's memory budget has no room for is retried after
+    WORKER_MEMORY_RETRY_DELAY seconds, and errored once its retries run out.
+
     Args:
-        image_bytes (bytes): The raw image data.
-        file_name (str): The original filename
-        file_size (int): The size of the original file in bytes.
-        file_type (str): The MIME type of the image.
-        image_instance_id (UUID): The ID of the corresponding ImageUpload instance.
+        payload (ImagePayload): The image and its ImageUpload id, name, size and MIME type,
+            sent in the binary upload envelope.
 
     Raises:
         Exception: If the ImageUpload instance doesn't exist or if image processing fails.
@@ -37,121 +54,98 @@ def process_and_save_image(image_bytes, file_name, file_size, file_type, image_i
     Note:
         This function is decorated with @shared_task, allowing it to be executed by Celery workers.
     """
+    # Imported here so the web process, which only enqueues, never loads PIL and NumPy.
+    from .memory import MemoryBudgetUnavailable, memory_reservation
+    from .previews import PREVIEW_FIELDS, annotate_previews
+    from .processing import process_image
+
+    image_bytes, file_name, file_size, file_type = payload.content, payload.name, payload.size, payload.mime
+    image_instance_id = payload.id
 
     try:
         image_instance = ImageUpload.objects.get(id=image_instance_id)
     except ImageUpload.DoesNotExist:
         raise Exception("Image instance does not exist")
-
-    channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(
-        'upload_group',
-        {   
-            'name': file_name,
-            'size': file_size,
-            'type': 'send_upload_notification',
-            'job_id': str(image_instance.job_id),
-            'status': 'processing',
-            'message': f'Image {file_name} processing.'
-        }
-    )
-    
-    try:
-        img_io = io.BytesIO(image_bytes)
-        img = Image.open(img_io)
-    except Exception as e:
-        image_instance.status = 'error'
-        image_instance.save()
-        async_to_sync(channel_layer.group_send)(
-        'upload_group',
-          {   
-            'name': file_name,
-            'size': file_size,
-            'type': 'send_upload_notification',
-            'job_id': str(image_instance.job_id),
-            'status': 'error',
-            'message': f'Image {file_name} error.'
-          }
+    # Marks the start of processing; images cancelled or swept meanwhile are skipped.
+    if not record_progress([image_instance_id]):
+        return
+    task_span = current_span()
+    if task_span is not None:
+        task_span.set_attribute("job_id", str(image_instance.job_id))
+
+    profile = should_profile_task(self.request)
+    with profiled("process_and_save_image", str(image_instance_id), profile):
+        send_upload_notification(
+            name=file_name,
+            size=file_size,
+            job_id=str(image_instance.job_id),
+            status='processing',
+            message=f'Image {file_name} processing.'
         )
-        raise Exception("Failed to open file")
-
-    width, height = img.size
-    if width != 1500:
-        ratio = 1500 / float(width)
-        new_height = int((float(height) * float(ratio)))
-        img = img.resize((1500, new_height), Image.LANCZOS)
-
-    if img.mode == "RGBA":
-        img = img.convert("RGB")
-    if file_type == 'application/octet-stream':
-        # If content type is generic, try to guess from the file name
-        guessed_type = mimetypes.guess_type(file_name)[0]
-        if guessed_type:
-            file_type = guessed_type
-        else:
-            # If we can't guess, use the format from the opened image
-            file_type = f"image/{img.format.lower()}"
-
-    if '/' in file_type:
-        image_format = file_type.split("/")[1].upper()
-    else:
-        # If file_type doesn't contain '/', use the format from the opened image
-        image_format = img.format
-
-    # Handle special cases
-    if image_format == 'JPG':
-        image_format = 'JPEG'
-    elif image_format == 'WEBP':
-        image_format = 'WebP'  # PIL uses 'WebP', not 'WEBP'
-
-    # Fallback to JPEG if format is still not recognized
-    if image_format not in ['JPEG', 'PNG', 'WebP', 'GIF']:
-        image_format = 'JPEG'
-
-
-    img_io = io.BytesIO()
-    img.save(img_io, format=image_format)
-    img_io.seek(0)
-
-    img_file = InMemoryUploadedFile(
-        img_io,
-        None,
-        f"resized.{image_format.lower()}",
-        f"image/{image_format.lower()}",
-        img_io.getbuffer().nbytes,
-        None,
-    )
-    
-    image_instance.finished_at = timezone.now()
-    
-    upload_time = image_instance.finished_at - image_instance.uploaded_at
-    upload_time_seconds = f"{upload_time.total_seconds():.1f} seconds"
 
-    image_instance.upload_time = upload_time_seconds
+        try:
+            with memory_reservation(image_bytes):
+                processed = process_image(image_bytes, file_name, file_type, thumbnail=True)
+            count_processed_image(self.request.id)
+        except Exception as e:
+            if isinstance(e, MemoryBudgetUnavailable) and self.request.retries < self.max_retries:
+                raise self.retry(exc=e, countdown=settings.WORKER_MEMORY_RETRY_DELAY)
+            errored = ImageUpload.objects.filter(
+                id=image_instance.id, status__in=ImageUpload.ACTIVE_STATUSES
+            ).update(status='error', finished_at=timezone.now())
+            if errored:
+                invalidate_list_cache()
+                send_upload_notification(
+                    name=file_name,
+                    size=file_size,
+                    job_id=str(image_instance.job_id),
+                    status='error',
+                    message=f'Image {file_name} error.'
+                )
+            raise Exception("Failed to open file")
+
+        if image_instance.upload_job_id and is_cancelled(str(image_instance.upload_job_id)):
+            return
+
+        image_instance.finished_at = timezone.now()
+
+        upload_time = image_instance.finished_at - image_instance.uploaded_at
+        upload_time_seconds = f"{upload_time.total_seconds():.1f} seconds"
+
+        image_instance.upload_time = upload_time_seconds
+
+        stored_name = write_image(
+            image_instance.image.field.generate_filename(image_instance, f"resized.{processed.extension}"),
+            processed.content
+        )
+        img_base64 = base64.b64encode(processed.content).decode('utf-8')
+        img_data_uri = f"data:{processed.content_type};base64,{img_base64}"
+
+        annotate_previews([(image_instance, processed.thumbnail)])
+        completed = complete_image(image_instance, stored_name, {
+            'finished_at': image_instance.finished_at,
+            'upload_time': upload_time_seconds,
+            **processed.metadata(),
+            **{field: getattr(image_instance, field) for field in PREVIEW_FIELDS},
+        })
+        if not completed:
+            return
+        invalidate_list_cache()
+
+        send_upload_notification(
+            name=file_name,
+            size=file_size,
+            image=img_data_uri,
+            image_url=image_instance.image.url,
+            job_id=str(image_instance.job_id),
+            status='completed',
+            message=f'Image {file_name} uploaded successfully.',
+            upload_time=upload_time_seconds
+        )
 
-    image_instance.image = img_file
-    image_instance.status = 'completed'
-    image_instance.save()
-    
-    img_base64 = base64.b64encode(img_io.getvalue()).decode('utf-8')
-    img_data_uri = f"data:image/{image_format.lower()};base64,{img_base64}"
-    async_to_sync(channel_layer.group_send)(
-        'upload_group',
-        {
-            'name': file_name,
-            'size': file_size,
-            'image': img_data_uri, 
-            'type': 'send_upload_notification',
-            'job_id': str(image_instance.job_id),
-            'status': 'completed',
-            'message': f'Image {file_name} uploaded successfully.',
-            'upload_time': upload_time_seconds
-        }
-    )
-  
 
-@shared_task
-def process_image_batch(image_data_list):
+@shared_task(bind=True, serializer=SERIALIZER, max_retries=settings.WORKER_MEMORY_RETRIES)
+def process_image_batch(self, payloads):
     """
     Process a batch of images asynchronously.
 
@@ -159,109 +153,329 @@ def process_image_batch(image_data_list):
     saves the processed images, and sends notifications about the upload status.
 
     Args:
-        image_data_list (List[Tuple]): A list of tuples, each containing:
-            - image_bytes (bytes): The raw image data.
-            - file_name (str): The original filename of the image.
-            - file_size (int): The size of the image file in bytes.
-            - file_type (str): The MIME type of the image.
-            - image_instance_id (int): The ID of the corresponding ImageUpload instance.
+        payloads (List[ImagePayload]): The images of the batch, each with its ImageUpload
+            id, name, size and MIME type, sent in the binary upload envelope.
 
     The function performs the following steps for each image:
     1. Retrieves the ImageUpload instance from the database.
     2. Opens and processes the image (resizing to 1500px width if necessary, converting to RGB).
     3. Determines and standardizes the image format.
-    4. Saves the processed image.
-    5. Updates the ImageUpload instance with the processed image and status.
+    4. Hands the processed image to the background writer pool.
+    5. Once its write has finished, updates the ImageUpload instance with the
+       processed image and status.
     6. Sends a notification about the upload status via WebSocket.
 
+    Storage writes overlap with processing of the following images. The
+    previews and statistics of all images are computed together, from their
+    thumbnails, before the final bulk update.
+
+    The job's cancellation flag is checked before each image. Once the job
+    is cancelled the batch stops and deletes the files still being written.
+    Each image is marked completed as soon as its file is written, and
+    only if it is still pending or processing: images cancelled or swept
+    meanwhile keep their status and their files are deleted.
+
+    The progress of the images not processed yet is refreshed every
+    UPLOAD_HEARTBEAT_INTERVAL seconds, so that sweep_stuck_uploads does not
+    mistake them for stuck while the batch works through the earlier ones.
+
+    Each image is decoded only once memory_reservation admits it into the
+    host's memory budget. If the budget has no room for an image, the task
+    is retried after WORKER_MEMORY_RETRY_DELAY seconds with the images not
+    processed yet; once its retries run out, such images are skipped like
+    any image that fails. When the process's resident memory exceeds
+    CELERY_WORKER_MAX_MEMORY_PER_CHILD, the remaining images are handed to
+    a new task, so that Celery replaces this process once the task returns.
+
     Note:
     - This function is designed to be run as a Celery task.
     - It uses Django's ORM, PIL for image processing, and channels for WebSocket communication.
     """
-    channel_layer = get_channel_layer()
+    from .memory import MemoryBudgetUnavailable, memory_reservation, rss_bytes
+    from .previews import PREVIEW_FIELDS, annotate_previews
+    from .processing import process_image
+
     processed_images = []
-    
-    for image_data in image_data_list:
-        image_bytes, file_name, file_size, file_type, image_instance_id = image_data
+    pending_writes = []
+    thumbnailed = []
+    writer = get_media_writer()
+    profile = should_profile_task(self.request)
+    upload_job_id = None
+    cancelled = False
+    rss_limit = settings.CELERY_WORKER_MAX_MEMORY_PER_CHILD * 1024
+    last_heartbeat = None
+    retry_payloads, memory_error = None, None
+
+    for index, payload in enumerate(payloads):
+        image_bytes, file_name, file_type = payload.content, payload.name, payload.mime
+        image_instance_id = payload.id
+
+        if upload_job_id and is_cancelled(upload_job_id):
+            cancelled = True
+            break
+        if index and rss_bytes() > rss_limit:
+            hand_off_batch(payloads[index:], profile)
+            break
+        if last_heartbeat is None or time.monotonic() - last_heartbeat >= settings.UPLOAD_HEARTBEAT_INTERVAL:
+            record_progress([remaining.id for remaining in payloads[index:]])
+            last_heartbeat = time.monotonic()
 
         try:
             image_instance = ImageUpload.objects.get(id=image_instance_id)
-            
-            # Open the image
-            img = Image.open(io.BytesIO(image_bytes))
-            
-            # Resize if necessary
-            if img.width != 1500:
-                ratio = 1500 / float(img.width)
-                new_height = int((float(img.height) * float(ratio)))
-                img = img.resize((1500, new_height), Image.LANCZOS)
-
-            # Convert to RGB if necessary
-            if img.mode == "RGBA":
-                img = img.convert("RGB")
-
-            # Determine image format
-            if file_type == 'application/octet-stream':
-                guessed_type = mimetypes.guess_type(file_name)[0]
-                if guessed_type:
-                    file_type = guessed_type
-                else:
-                    file_type = f"image/{img.format.lower()}"
-
-            if '/' in file_type:
-                image_format = file_type.split("/")[1].upper()
-            else:
-                image_format = img.format
-
-            # Handle special cases
-            if image_format == 'JPG':
-                image_format = 'JPEG'
-            elif image_format == 'WEBP':
-                image_format = 'WebP'
-
-            # Fallback to JPEG if format is still not recognized
-            if image_format not in ['JPEG', 'PNG', 'WebP', 'GIF']:
-                image_format = 'JPEG'
-
-            # Save processed image
-            img_io = io.BytesIO()
-            img.save(img_io, format=image_format)
-            img_io.seek(0)
-
-            # Prepare data for bulk update
-            image_instance.finished_at = timezone.now()
-            upload_time = image_instance.finished_at - image_instance.uploaded_at
-            image_instance.upload_time = f"{upload_time.total_seconds():.1f} seconds"
-            image_instance.image.save(f"resized_{file_name}", ContentFile(img_io.getvalue()), save=False)
-            image_instance.status = 'completed'
-
-            processed_images.append(image_instance)
-
-            # Prepare WebSocket notification
-            img_base64 = base64.b64encode(img_io.getvalue()).decode('utf-8')
-            img_data_uri = f"data:image/{image_format.lower()};base64,{img_base64}"
-            
-            async_to_sync(channel_layer.group_send)(
-                'upload_group',
-                {
-                    'name': file_name,
-                    'size': file_size,
-                    'type': 'send_upload_notification',
-                    'image': img_data_uri,
-                    'job_id': str(image_instance.job_id),
-                    'status': 'completed',
-                    'message': f'Image {file_name} uploaded successfully.',
-                    'upload_time': image_instance.upload_time
-                }
-            )
-
+            if image_instance.status == 'aborted':
+                cancelled = True
+                break
+            if image_instance.status not in ImageUpload.ACTIVE_STATUSES:
+                # Swept as stuck before the batch reached it.
+                continue
+            if image_instance.upload_job_id:
+                upload_job_id = str(image_instance.upload_job_id)
+
+            with span("image", job_id=str(image_instance.job_id)), \
+                    profiled("process_image_batch", str(image_instance_id), profile):
+                # Open, resize and re-encode the image
+                with memory_reservation(image_bytes):
+                    processed = process_image(image_bytes, file_name, file_type, thumbnail=True)
+                count_processed_image(self.request.id)
+                thumbnailed.append((image_instance, processed.thumbnail))
+
+                # Prepare data for bulk update
+                image_instance.finished_at = timezone.now()
+                upload_time = image_instance.finished_at - image_instance.uploaded_at
+                image_instance.upload_time = f"{upload_time.total_seconds():.1f} seconds"
+
+                # Hand the file to the writer pool and carry on with the next image
+                write = writer.save(
+                    image_instance.image.field.generate_filename(image_instance, f"resized.{processed.extension}"),
+                    processed.content
+                )
+            pending_writes.append((image_instance, processed, write))
+
+        except MemoryBudgetUnavailable as e:
+            if self.request.retries < self.max_retries:
+                retry_payloads, memory_error = payloads[index:], e
+                break
+            logger.warning(f"Error processing image {file_name}: {e}")
         except Exception as e:
-            print(f"Error processing image {file_name}: {str(e)}")
-            # Handle the error appropriately
+            logger.warning(f"Error processing image {file_name}: {e}")
 
-    # Bulk update all processed images
-    ImageUpload.objects.bulk_update(processed_images, ['image', 'finished_at', 'upload_time', 'status'])
+        processed_images += complete_stored_images(pending_writes, wait=False)
 
+    if cancelled:
+        discard_stored_images(pending_writes)
+    else:
+        processed_images += complete_stored_images(pending_writes, wait=True)
+
+    # Previews are computed together for the completed images; completed
+    # rows are never changed by a cancellation or sweep.
+    completed_ids = {image_instance.id for image_instance in processed_images}
+    annotate_previews([entry for entry in thumbnailed if entry[0].id in completed_ids])
+    ImageUpload.objects.bulk_update(processed_images, PREVIEW_FIELDS)
+    invalidate_list_cache()
+
+    if retry_payloads:
+        raise self.retry(
+            args=(list(retry_payloads),), exc=memory_error, countdown=settings.WORKER_MEMORY_RETRY_DELAY
+        )
     return len(processed_images)
- 
-    
\ No newline at end of file
+
+
+def complete_stored_images(pending_writes, wait):
+    """
+    Finish the images of a batch whose background writes have completed.
+
+    Each finished image still active is marked completed and its
+    notification is sent; entries still being written are left in
+    ``pending_writes``.
+
+    Args:
+        pending_writes (List[Tuple]): (ImageUpload, ProcessedImage, Future) entries.
+        wait (bool): Block until every pending write has finished.
+
+    Returns:
+        List[ImageUpload]: The instances ready for the bulk update.
+    """
+    completed = []
+    still_pending = []
+    for image_instance, processed, write in pending_writes:
+        if not wait and not write.done():
+            still_pending.append((image_instance, processed, write))
+            continue
+        try:
+            name = write.result()
+        except Exception as e:
+            logger.warning(f"Error storing image {image_instance.name}: {e}")
+            continue
+        fields = {
+            'finished_at': image_instance.finished_at,
+            'upload_time': image_instance.upload_time,
+            **processed.metadata(),
+        }
+        if not complete_image(image_instance, name, fields):
+            continue
+        completed.append(image_instance)
+
+        # Prepare WebSocket notification
+        img_base64 = base64.b64encode(processed.content).decode('utf-8')
+        img_data_uri = f"data:{processed.content_type};base64,{img_base64}"
+
+        send_upload_notification(
+            name=image_instance.name,
+            size=image_instance.size,
+            image=img_data_uri,
+            image_url=image_instance.image.url,
+            job_id=str(image_instance.job_id),
+            status='completed',
+            message=f'Image {image_instance.name} uploaded successfully.',
+            upload_time=image_instance.upload_time
+        )
+    pending_writes[:] = still_pending
+    if completed:
+        invalidate_list_cache()
+    return completed
+
+
+def record_progress(image_ids) -> int:
+    """
+    Record that a worker is making progress on the given images.
+
+    Args:
+        image_ids (List): Ids of the images; only active ones are updated.
+
+    Returns:
+        int: The number of images still pending or processing.
+    """
+    return ImageUpload.objects.filter(
+        id__in=image_ids, status__in=ImageUpload.ACTIVE_STATUSES
+    ).update(progressed_at=timezone.now())
+
+
+def complete_image(image_instance, name: str, fields) -> bool:
+    """
+    Mark an image completed with its stored file, if it is still active.
+
+    The update only applies while the row is pending or processing, so an
+    image cancelled or swept while it was processed keeps that status; the
+    file written for it is then deleted.
+
+    Args:
+        image_instance (ImageUpload): The image, updated in place on success.
+        name (str): The storage name of the processed file.
+        fields (dict): The other columns to set, e.g. finished_at and the metadata.
+
+    Returns:
+        bool: Whether the image was marked completed.
+    """
+    updated = ImageUpload.objects.filter(
+        id=image_instance.id, status__in=ImageUpload.ACTIVE_STATUSES
+    ).update(image=name, status='completed', **fields)
+    if not updated:
+        delete_stored_files([name])
+        return False
+    image_instance.image.name = name
+    image_instance.status = 'completed'
+    for field, value in fields.items():
+        setattr(image_instance, field, value)
+    return True
+
+
+def hand_off_batch(payloads, profile: bool) -> None:
+    """
+    Enqueue the remaining images of a batch as a new batch task.
+
+    The images' rows are pointed at the new task, so cancelling the job
+    revokes it.
+
+    Args:
+        payloads (List[ImagePayload]): The images not processed yet.
+        profile (bool): Whether the new task should be profiled too.
+    """
+    task_id = str(uuid.uuid4())
+    ImageUpload.objects.filter(
+        id__in=[payload.id for payload in payloads], status__in=ImageUpload.ACTIVE_STATUSES
+    ).update(task_id=task_id)
+    process_image_batch.apply_async(
+        (list(payloads),), headers={"profile": True} if profile else {}, task_id=task_id
+    )
+
+
+def discard_stored_images(pending_writes):
+    """
+    Delete the files still being written by a cancelled batch.
+
+    Images already marked completed keep their files.
+
+    Args:
+        pending_writes (List[Tuple]): (ImageUpload, ProcessedImage, Future) entries
+            still being written; their writes are waited for.
+    """
+    names = []
+    for _, _, write in pending_writes:
+        try:
+            names.append(write.result())
+        except Exception:
+            # A failed write left no file behind.
+            continue
+    delete_stored_files(names)
+    pending_writes.clear()
+
+
+def delete_stored_files(names):
+    """
+    Delete processed files that no row refers to, logging failures.
+    """
+    for name in names:
+        try:
+            default_storage.delete(name)
+        except Exception as e:
+            logger.warning(f"Could not delete {name}: {e}")
+
+
+@shared_task
+def sweep_stuck_uploads():
+    """
+    Mark images that have been pending or processing for too long as errored.
+
+    An image is stuck when its worker has recorded no progress on it for
+    UPLOAD_STUCK_AFTER seconds, typically because the worker died, or when
+    it is still queued UPLOAD_QUEUED_STUCK_AFTER seconds after upload.
+    Images merely queued behind a long batch keep being refreshed by it.
+    Stuck images are moved to 'error' and their clients are notified. At
+    most UPLOAD_SWEEP_BATCH images are swept per run; the lookup is served
+    by the partial index on active images.
+
+    Returns:
+        int: The number of images marked as errored.
+    """
+    now = timezone.now()
+    is_stuck = Q(status__in=ImageUpload.ACTIVE_STATUSES) & (
+        Q(progressed_at__lt=now - timedelta(seconds=settings.UPLOAD_STUCK_AFTER))
+        | Q(progressed_at__isnull=True, uploaded_at__lt=now - timedelta(seconds=settings.UPLOAD_QUEUED_STUCK_AFTER))
+    )
+    stuck_ids = list(
+        ImageUpload.objects
+        .filter(is_stuck)
+        .order_by('uploaded_at')
+        .values_list('id', flat=True)[:settings.UPLOAD_SWEEP_BATCH]
+    )
+    if not stuck_ids:
+        return 0
+
+    # Re-checked in the update, so an image that made progress meanwhile is kept.
+    swept = ImageUpload.objects.filter(is_stuck, id__in=stuck_ids).update(status='error', finished_at=now)
+    if not swept:
+        return 0
+    invalidate_list_cache()
+
+    swept_rows = ImageUpload.objects.filter(
+        id__in=stuck_ids, status='error', finished_at=now
+    ).values('name', 'size', 'job_id')
+    for row in swept_rows:
+        send_upload_notification(
+            name=row['name'],
+            size=row['size'],
+            job_id=str(row['job_id']),
+            status='error',
+            message=f"Image {row['name']} timed out."
+        )
+    return swept
@@ -1,3 +1,606 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import msgpack
+from django.core.files.storage import default_storage
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+
+from . import envelope, jobs, memory, tasks, tracing
+from .cache import ListPageCache
+from .envelope import ImagePayload
+from .management.commands.trace_summary import read_spans
+from .models import ImageUpload, UploadJob
+from .processing import MemoryReader, decode_image, hash_columns
+from .profiling import aprofiled, profiled
+from .protocol import SUBPROTOCOL_JSON, SUBPROTOCOL_MSGPACK, encode_frame
+from .renditions import RenderSpec, cache_lock, parse_spec, rendition_lock
+from .scaling import ScalingSignals, desired_concurrency
+from .similarity import find_similar
+
+
+class NotificationLog(list):
+    def append_event(self, **event):
+        self.append(event)
+
+
+def image_bytes(size=(64, 48), image_format='PNG', color=(200, 30, 30)) -> bytes:
+    output = io.BytesIO()
+    Image.new('RGB', size, color).save(output, image_format)
+    return output.getvalue()
+
+
+@contextmanager
+def no_reservation(image_bytes):
+    yield
+
+
+class UploadTaskTestCase(TestCase):
+    """
+    Runs the image tasks eagerly against a temporary MEDIA_ROOT, without Redis
+    or the channel layer: notifications are captured in ``self.notifications``.
+    """
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.notifications = NotificationLog()
+        self.cancelled = False
+        patches = [
+            mock.patch.object(tasks, 'send_upload_notification', side_effect=self.notifications.append_event),
+            mock.patch.object(tasks, 'is_cancelled', side_effect=lambda job_id: self.cancelled),
+            mock.patch.object(tasks, 'invalidate_list_cache'),
+            mock.patch('imageupload.memory.memory_reservation', no_reservation),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def create_images(self, count):
+        upload_job = UploadJob.objects.create(total=count)
+        images = [
+            ImageUpload.objects.create(
+                name=f'image{index}.png', size=0, type='image/png', status='processing',
+                job_id=f'{upload_job.id}-{index}', upload_job=upload_job, task_id='task',
+            )
+            for index in range(count)
+        ]
+        data = image_bytes()
+        payloads = [ImagePayload.build(image.id, image.name, len(data), 'image/png', data) for image in images]
+        return images, payloads
+
+    def statuses(self, images):
+        return [ImageUpload.objects.get(id=image.id).status for image in images]
+
+    def stored_files(self):
+        shards = default_storage.listdir('images')[0] if default_storage.exists('images') else []
+        files = []
+        for shard in shards:
+            for sub_shard in default_storage.listdir(f'images/{shard}')[0]:
+                files += default_storage.listdir(f'images/{shard}/{sub_shard}')[1]
+        return files
+
+
+class CancelRaceTests(UploadTaskTestCase):
+
+    def abort_during_write(self, images):
+        """Abort ``images`` just before their files are written or handed to the media writer."""
+        writer = tasks.get_media_writer()
+
+        def aborting(write):
+            def save(name, content):
+                ImageUpload.objects.filter(id__in=[image.id for image in images]).update(status='aborted')
+                return write(name, content)
+            return save
+
+        for patch in (mock.patch.object(writer, 'save', side_effect=aborting(writer.save)),
+                      mock.patch.object(tasks, 'write_image', side_effect=aborting(tasks.write_image))):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_cancel_during_write_is_not_overwritten(self):
+        images, payloads = self.create_images(1)
+        self.abort_during_write(images)
+
+        tasks.process_and_save_image.apply(args=(payloads[0],))
+
+        self.assertEqual(self.statuses(images), ['aborted'])
+        self.assertEqual(self.stored_files(), [])
+        self.assertNotIn('completed', [event['status'] for event in self.notifications])
+
+    def test_batch_cancel_keeps_completed_images(self):
+        images, payloads = self.create_images(3)
+        original = tasks.complete_stored_images
+
+        def complete_and_cancel(pending_writes, wait):
+            # The first image is completed, then the job is cancelled.
+            completed = original(pending_writes, True)
+            ImageUpload.objects.filter(
+                id__in=[image.id for image in images], status__in=ImageUpload.ACTIVE_STATUSES
+            ).update(status='aborted')
+            return completed
+
+        with mock.patch.object(tasks, 'complete_stored_images', side_effect=complete_and_cancel):
+            result = tasks.process_image_batch.apply(args=(payloads,)).result
+
+        self.assertEqual(result, 1)
+        self.assertEqual(self.statuses(images), ['completed', 'aborted', 'aborted'])
+        self.assertEqual(len(self.stored_files()), 1)
+        completed = ImageUpload.objects.get(id=images[0].id)
+        self.assertTrue(default_storage.exists(completed.image.name))
+        self.assertIsNotNone(completed.preview)
+        self.assertEqual([event['status'] for event in self.notifications], ['completed'])
+
+    def test_batch_write_after_cancel_is_deleted(self):
+        images, payloads = self.create_images(2)
+        self.abort_during_write(images)
+
+        result = tasks.process_image_batch.apply(args=(payloads,)).result
+
+        self.assertEqual(result, 0)
+        self.assertEqual(self.statuses(images), ['aborted', 'aborted'])
+        self.assertEqual(self.stored_files(), [])
+        self.assertEqual(self.notifications, [])
+
+    def test_cancel_skips_images_finished_after_the_snapshot(self):
+        images, _ = self.create_images(2)
+        ImageUpload.objects.filter(id=images[1].id).update(task_id='other')
+        now = timezone.now
+
+        def complete_first_image():
+            # Runs between the snapshot of the active images and the update.
+            ImageUpload.objects.filter(id=images[0].id).update(status='completed')
+            return now()
+
+        with mock.patch.object(jobs, 'get_redis'), \
+                mock.patch.object(jobs, 'send_upload_notification', side_effect=self.notifications.append_event), \
+                mock.patch.object(jobs, 'current_app') as app, \
+                mock.patch.object(jobs.timezone, 'now', side_effect=complete_first_image):
+            result = jobs.cancel_job(str(images[0].upload_job_id))
+
+        self.assertEqual(result['aborted'], 1)
+        self.assertEqual(self.statuses(images), ['completed', 'aborted'])
+        self.assertEqual([event['name'] for event in self.notifications], ['image1.png'])
+        app.control.revoke.assert_called_once_with(['other'])
+
+
+class SweepStuckUploadsTests(UploadTaskTestCase):
+
+    def age(self, image, **fields):
+        ImageUpload.objects.filter(id=image.id).update(**fields)
+
+    def test_queued_images_are_not_swept(self):
+        images, _ = self.create_images(2)
+        now = timezone.now()
+        # Queued behind a long batch: uploaded long ago, not started yet.
+        self.age(images[0], uploaded_at=now - timedelta(hours=2))
+        # Started, and still refreshed by its batch.
+        self.age(images[1], uploaded_at=now - timedelta(hours=2), progressed_at=now - timedelta(minutes=1))
+
+        self.assertEqual(tasks.sweep_stuck_uploads(), 0)
+        self.assertEqual(self.statuses(images), ['processing', 'processing'])
+
+    def test_images_without_progress_are_swept(self):
+        images, _ = self.create_images(2)
+        now = timezone.now()
+        self.age(images[0], progressed_at=now - timedelta(hours=1))
+        self.age(images[1], uploaded_at=now - timedelta(days=2))
+
+        self.assertEqual(tasks.sweep_stuck_uploads(), 2)
+        self.assertEqual(self.statuses(images), ['error', 'error'])
+        self.assertEqual([event['status'] for event in self.notifications], ['error', 'error'])
+
+    def test_swept_image_is_not_completed_by_its_batch(self):
+        images, payloads = self.create_images(2)
+        original = tasks.record_progress
+
+        def sweep_second(image_ids):
+            # The sweep runs while the batch starts.
+            updated = original(image_ids)
+            ImageUpload.objects.filter(id=images[1].id).update(status='error')
+            return updated
+
+        with mock.patch.object(tasks, 'record_progress', side_effect=sweep_second):
+            result = tasks.process_image_batch.apply(args=(payloads,)).result
+
+        self.assertEqual(result, 1)
+        self.assertEqual(self.statuses(images), ['completed', 'error'])
+        self.assertEqual(len(self.stored_files()), 1)
+
+    def test_batch_records_progress_of_remaining_images(self):
+        images, payloads = self.create_images(3)
+        with override_settings(UPLOAD_HEARTBEAT_INTERVAL=0), \
+                mock.patch.object(tasks, 'record_progress', wraps=tasks.record_progress) as record_progress:
+            tasks.process_image_batch.apply(args=(payloads,))
+
+        self.assertEqual(
+            [len(call.args[0]) for call in record_progress.call_args_list], [3, 2, 1]
+        )
+
+
+class SpanExporterTests(TestCase):
+
+    def setUp(self):
+        trace_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, trace_dir, ignore_errors=True)
+        settings_override = override_settings(TRACE_DIR=trace_dir, TRACE_FILE_MAX_BYTES=2000, TRACE_MAX_BYTES=5000)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.trace_dir = trace_dir
+
+    def spans(self, count):
+        context = tracing.SpanContext(tracing.new_span_id() * 2, tracing.new_span_id())
+        spans = [
+            tracing.Span('stage', context, None, tracing.SPAN_KIND_INTERNAL, {'image_id': index}, start_ns=0)
+            for index in range(count)
+        ]
+        for finished in spans:
+            finished.end_ns = 1000
+        return spans
+
+    def test_files_are_rotated_and_bounded(self):
+        exporter = tracing.SpanExporter()
+        for _ in range(30):
+            exporter.write(self.spans(5))
+
+        paths = [os.path.join(self.trace_dir, name) for name in os.listdir(self.trace_dir)]
+        self.assertGreater(exporter.rotations, 2)
+        self.assertLess(len(paths), exporter.rotations)
+        self.assertLessEqual(sum(os.path.getsize(path) for path in paths), 5000 + 2000)
+
+    def test_full_queue_drops_spans(self):
+        with override_settings(TRACE_QUEUE_SIZE=3), mock.patch.object(tracing.SpanExporter, 'run'):
+            exporter = tracing.SpanExporter()
+        exporter.submit(self.spans(5))
+        exporter.flush()
+
+        read = list(read_spans(os.path.join(self.trace_dir, '*.jsonl')))
+        self.assertEqual([span['attributes']['image_id'] for span in read], ['0', '1', '2'])
+
+
+class FindSimilarTests(TestCase):
+    # Bits in distinct bands, so any three of them leave one band unchanged.
+    BITS = (1 << 63, 1 << 40, 1 << 20, 1 << 3)
+    PHASH = 0xF0F0_1234_ABCD_8001
+
+    def create_image(self, phash):
+        return ImageUpload.objects.create(name='image.png', size=0, type='image/png', **hash_columns(phash))
+
+    def test_matches_within_threshold_closest_first(self):
+        flipped = [self.PHASH]
+        for bit in self.BITS:
+            flipped.append(flipped[-1] ^ bit)
+        original, *images = [self.create_image(phash) for phash in flipped]
+
+        matches, truncated = find_similar(self.PHASH, 2, exclude_id=original.id)
+        self.assertEqual([(match.id, distance) for match, distance in matches], [(images[0].id, 1), (images[1].id, 2)])
+        self.assertFalse(truncated)
+
+        matches, _ = find_similar(self.PHASH)
+        self.assertEqual([distance for _, distance in matches], [0, 1, 2, 3])
+
+    def test_truncation_keeps_the_closest_matches(self):
+        far = [self.create_image(self.PHASH ^ self.BITS[0] ^ self.BITS[1]) for _ in range(3)]
+        near = self.create_image(self.PHASH ^ self.BITS[2])
+
+        with override_settings(SIMILAR_MAX_RESULTS=2):
+            matches, truncated = find_similar(self.PHASH)
+
+        self.assertTrue(truncated)
+        self.assertEqual(matches[0], (near, 1))
+        self.assertIn(matches[1][0], far)
+
+
+class MemoryBudgetTests(UploadTaskTestCase):
+
+    def refuse_reservations(self, *refused):
+        """Make the memory budget refuse the reservations with these call numbers, counted from 1."""
+        calls = []
+
+        @contextmanager
+        def reservation(data):
+            calls.append(data)
+            if len(calls) in refused:
+                raise memory.MemoryBudgetUnavailable('No room')
+            yield
+
+        patch = mock.patch('imageupload.memory.memory_reservation', reservation)
+        patch.start()
+        self.addCleanup(patch.stop)
+        return calls
+
+    def test_image_without_room_is_retried(self):
+        images, payloads = self.create_images(1)
+        calls = self.refuse_reservations(1)
+
+        tasks.process_and_save_image.apply(args=(payloads[0],))
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.statuses(images), ['completed'])
+
+    def test_image_is_errored_once_retries_run_out(self):
+        images, payloads = self.create_images(1)
+        calls = self.refuse_reservations(*range(1, 10))
+
+        with mock.patch.object(tasks.process_and_save_image, 'max_retries', 1):
+            result = tasks.process_and_save_image.apply(args=(payloads[0],))
+
+        self.assertTrue(result.failed())
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.statuses(images), ['error'])
+
+    def test_batch_retries_its_remaining_images(self):
+        images, payloads = self.create_images(3)
+        calls = self.refuse_reservations(2)
+
+        tasks.process_image_batch.apply(args=(payloads,))
+
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(self.statuses(images), ['completed'] * 3)
+        self.assertEqual(len(self.stored_files()), 3)
+
+    def test_only_processed_images_are_counted(self):
+        _, payloads = self.create_images(3)
+        self.cancelled = True
+
+        with mock.patch.object(tasks, 'count_processed_image') as count_processed_image:
+            tasks.process_image_batch.apply(args=(payloads,))
+
+        self.assertEqual(count_processed_image.call_count, 1)
+
+
+class MemoryReservationTests(TestCase):
+
+    def test_unavailable_redis_does_not_admit(self):
+        with mock.patch.object(memory, 'get_redis', side_effect=ConnectionError('down')), \
+                self.assertRaises(memory.MemoryBudgetUnavailable):
+            with memory.memory_reservation(image_bytes()):
+                self.fail('Admitted without a reservation')
+
+    def test_decode_rejects_images_over_the_pixel_cap(self):
+        with override_settings(IMAGE_MAX_PIXELS=64 * 47), self.assertRaises(ValueError):
+            decode_image(image_bytes(size=(64, 48)))
+
+
+class CompactProtocolTests(TestCase):
+    EVENT = {
+        'type': 'send_upload_notification', 'name': 'image.png', 'size': 10, 'job_id': 'job-0',
+        'status': 'completed', 'message': 'Image image.png uploaded successfully.', 'seq': 3,
+        'upload_time': '1.0 seconds', 'image': 'data:image/png;base64,AAAA', 'image_url': '/media/image.png',
+    }
+
+    def test_frames_carry_the_image_url_only(self):
+        expected = [{'j': 'job-0', 's': 2, 'n': 'image.png', 'z': 10, 'q': 3, 't': '1.0 seconds', 'u': '/media/image.png'}]
+
+        self.assertEqual(msgpack.unpackb(encode_frame([self.EVENT], SUBPROTOCOL_MSGPACK), raw=False), expected)
+        self.assertEqual(json.loads(encode_frame([self.EVENT], SUBPROTOCOL_JSON)), expected)
+
+
+class EnvelopeTests(TestCase):
+
+    def test_round_trip(self):
+        first, second = image_bytes(), image_bytes(size=(8, 8))
+        body = [
+            [[ImagePayload.build('a', 'a.png', len(first), 'image/png', first),
+              ImagePayload.build('b', 'b.png', len(second), 'image/png', second)]],
+            {'profile': True, 'extra': b'raw'},
+            {'callbacks': None},
+        ]
+
+        args, kwargs, embed = envelope.loads(envelope.dumps(body))
+
+        payloads = args[0]
+        self.assertEqual([payload.id for payload in payloads], ['a', 'b'])
+        self.assertEqual([bytes(payload.content) for payload in payloads], [first, second])
+        self.assertEqual(payloads, body[0][0])
+        self.assertEqual((kwargs['profile'], bytes(kwargs['extra'])), (True, b'raw'))
+        self.assertEqual(embed, {'callbacks': None})
+
+    def test_corrupted_image_is_rejected(self):
+        data = image_bytes()
+        message = bytearray(envelope.dumps([[ImagePayload.build('a', 'a.png', len(data), 'image/png', data)], {}, {}]))
+        message[-1] ^= 0xFF
+
+        with self.assertRaises(ValueError):
+            envelope.loads(bytes(message))
+
+    def test_decoded_image_is_read_in_place(self):
+        data = image_bytes(image_format='JPEG')
+        message = envelope.dumps([[ImagePayload.build('a', 'a.jpg', len(data), 'image/jpeg', data)], {}, {}])
+        (payload,), _, _ = envelope.loads(message)
+
+        with mock.patch('imageupload.processing.MemoryReader', wraps=MemoryReader) as reader:
+            img = decode_image(payload.content)
+
+        self.assertEqual(img.size, (64, 48))
+        self.assertIs(reader.call_args.args[0], payload.content)
+
+
+class RenditionTests(TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        settings_override = override_settings(RENDER_CACHE_DIR=cache_dir, RENDER_LOCK_TIMEOUT=0.05)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.cache_dir = cache_dir
+
+    def test_spec_is_snapped_to_the_whitelists(self):
+        self.assertEqual(parse_spec({'w': '300', 'fmt': 'jpg', 'q': '80'}), RenderSpec(320, 'JPEG', 90))
+        self.assertEqual(parse_spec({'w': '5000', 'q': '10'}), RenderSpec(1500, 'WebP', 50))
+        self.assertEqual(parse_spec({'w': '1', 'fmt': 'PNG', 'q': '90'}), RenderSpec(64, 'PNG', 0))
+        self.assertEqual(parse_spec({}), RenderSpec(1500, 'WebP', 75))
+        for params in ({'fmt': 'gif'}, {'w': 'abc'}):
+            with self.assertRaises(ValueError):
+                parse_spec(params)
+
+    def test_renditions_in_other_stripes_are_not_locked(self):
+        # The two paths hash to different stripes.
+        first, second = (os.path.join(self.cache_dir, name) for name in ('a-w64-q75.webp', 'b-w64-q75.webp'))
+        with rendition_lock(first) as locked:
+            self.assertTrue(locked)
+            with rendition_lock(second) as other:
+                self.assertTrue(other)
+
+    @override_settings(RENDER_LOCK_STRIPES=4)
+    def test_lock_files_are_bounded(self):
+        for index in range(50):
+            with rendition_lock(os.path.join(self.cache_dir, 'ab', 'cd', f'{index}-w64-q75.webp')):
+                pass
+        self.assertLessEqual(len(os.listdir(os.path.join(self.cache_dir, 'locks'))), 4)
+
+    def test_lock_wait_times_out(self):
+        # flock locks belong to the open file, so a second open contends like another process.
+        with cache_lock('held'), cache_lock('held', timeout=0.05) as acquired:
+            self.assertFalse(acquired)
+
+
+class MetricsViewTests(TestCase):
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_token_is_required(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+
+    @override_settings(METRICS_TOKEN='', DEBUG=False)
+    def test_not_served_without_token_outside_debug(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+
+class ProfilingTests(TestCase):
+
+    def setUp(self):
+        profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, profile_dir, ignore_errors=True)
+        settings_override = override_settings(PROFILE_DIR=profile_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.profile_dir = profile_dir
+
+    def profiles(self, kind):
+        directory = os.path.join(self.profile_dir, kind)
+        return sorted(name for name in os.listdir(directory) if name.endswith('.prof'))
+
+    def test_nested_profile_is_skipped(self):
+        with profiled('outer', 'a'), profiled('inner', 'b'):
+            sum(range(1000))
+
+        self.assertEqual(len(self.profiles('outer')), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.profile_dir, 'inner')))
+
+    def test_concurrent_coroutines_capture_one_profile(self):
+        async def request(label):
+            async with aprofiled('requests', label):
+                await asyncio.sleep(0.01)
+
+        async def requests():
+            await asyncio.gather(*(request(str(index)) for index in range(3)))
+
+        asyncio.run(requests())
+
+        self.assertEqual(len(self.profiles('requests')), 1)
+        with profiled('requests', 'after'):
+            pass
+        self.assertEqual(len(self.profiles('requests')), 2)
+
+
+@override_settings(SCALING_TARGET_LATENCY=10.0)
+class DesiredConcurrencyTests(TestCase):
+
+    def signals(self, live_workers, oldest_age=0.0):
+        return ScalingSignals(
+            queue_depth={'celery': 40}, oldest_age={'celery': oldest_age}, in_flight_images=40,
+            in_flight_bytes=0, image_seconds=2.0, live_workers=live_workers,
+        )
+
+    def test_backlog_is_split_across_live_workers(self):
+        self.assertEqual(desired_concurrency(self.signals(1), 1, 16), 8)
+        self.assertEqual(desired_concurrency(self.signals(4), 1, 16), 2)
+        # No heartbeat yet: this worker takes the whole backlog.
+        self.assertEqual(desired_concurrency(self.signals(0), 1, 16), 8)
+
+    def test_lagging_queue_scales_up_within_bounds(self):
+        self.assertEqual(desired_concurrency(self.signals(2, oldest_age=20.0), 1, 16), 8)
+        self.assertEqual(desired_concurrency(self.signals(1, oldest_age=40.0), 1, 16), 16)
+
+
+class UploadImageViewTests(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_upload_is_annotated_with_previews(self):
+        upload = io.BytesIO(image_bytes(color=(10, 200, 10)))
+        upload.name = 'green.png'
+
+        response = self.client.post('/api/upload', {'image': upload})
+
+        self.assertEqual(response.status_code, 200)
+        image_upload = ImageUpload.objects.get(name='green.png')
+        self.assertEqual(image_upload.status, 'completed')
+        self.assertIsNotNone(image_upload.preview)
+        self.assertIsNotNone(image_upload.brightness)
+        self.assertTrue(image_upload.dominant_color)
+
+    @override_settings(DATA_UPLOAD_MAX_NUMBER_FILES=2)
+    def test_streaming_upload_keeps_the_images_read_before_an_error(self):
+        uploads = []
+        for index in range(3):
+            upload = io.BytesIO(image_bytes())
+            upload.name = f'{index}.png'
+            uploads.append(upload)
+
+        with mock.patch('imageupload.upload_handlers.process_and_save_image') as task:
+            response = self.client.post('/api/stream/batch/upload', {'images': uploads})
+
+        self.assertEqual(response.status_code, 207)
+        self.assertIn('error', response.json())
+        upload_job = UploadJob.objects.get(id=response.json()['job_id'])
+        self.assertEqual(upload_job.total, 2)
+        self.assertEqual(task.apply_async.call_count, 2)
+
+
+class ListPageCacheTests(TestCase):
+
+    def test_bounded_by_bytes(self):
+        cache = ListPageCache(max_bytes=100, max_entry_bytes=60)
+        cache.set('a', b'a' * 40)
+        cache.set('b', b'b' * 40)
+        cache.get('a')
+        cache.set('c', b'c' * 40)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual([cache.get('a'), cache.get('c')], [b'a' * 40, b'c' * 40])
+
+    def test_large_pages_are_not_cached(self):
+        cache = ListPageCache(max_bytes=100, max_entry_bytes=60)
+        cache.set('page', b'p' * 40)
+        cache.set('all', b'x' * 80)
+
+        self.assertIsNone(cache.get('all'))
+        self.assertEqual(cache.get('page'), b'p' * 40)
+
+    def test_replacing_an_entry_frees_its_size(self):
+        cache = ListPageCache(max_bytes=100, max_entry_bytes=100)
+        for _ in range(5):
+            cache.set('a', b'a' * 50)
+        cache.set('b', b'b' * 50)
+
+        self.assertEqual([cache.get('a'), cache.get('b')], [b'a' * 50, b'b' * 50])
@@ -0,0 +1,482 @@
+# tracing.py
+"""
+End-to-end tracing of uploads, from the view to the WebSocket clients.
+
+An upload request starts a trace, sampled at TRACE_SAMPLE_RATE, and every
+hop it causes records spans into it:
+
+- ``upload.request``: the upload view, which mints the trace id.
+- ``publish <task>``: sending a task to the broker. The task carries the
+  trace in its ``traceparent`` header.
+- ``broker.wait``: from the task's publication to the start of its run.
+- ``task <name>``: the task run, with a span per image of a batch and per
+  pipeline stage (``admit``, ``decode``, ``resize``, ``storage``...; see stage).
+- ``notify``: appending a notification to the event log and sending it to
+  the channel layer. The event carries its ``trace`` on to the consumers.
+- ``websocket.deliver``: from the notification's send until a consumer
+  wrote it to its client, once per connected client.
+
+Code running outside a trace, such as the bulk import, records no spans.
+Finished spans are handed to a background SpanExporter once their
+process-local root span ends, and written as lines of OTLP/JSON
+(ExportTraceServiceRequest) to bounded, rotated
+``TRACE_DIR/spans-<service>-<pid>*.jsonl`` files. A collector's OTLP JSON
+file receiver can ingest these files; the ``trace_summary`` command reads
+them directly.
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+import queue
+import random
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from celery.signals import (
+    after_task_publish, before_task_publish, task_postrun, task_prerun, worker_process_shutdown
+)
+from django.conf import settings
+
+from .metrics import STAGE_SECONDS, TRACE_SPANS_DROPPED
+
+logger = logging.getLogger(__name__)
+
+TRACEPARENT_HEADER = "traceparent"
+
+# OTLP span kinds and status codes.
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_PRODUCER = 4
+SPAN_KIND_CONSUMER = 5
+STATUS_ERROR = 2
+
+
+class SpanContext(NamedTuple):
+    """
+    The identity of a span, as propagated between processes.
+
+    Attributes:
+        trace_id (str): 32 hex digits shared by every span of the trace.
+        span_id (str): 16 hex digits identifying the span.
+    """
+    trace_id: str
+    span_id: str
+
+    @property
+    def traceparent(self) -> str:
+        """The W3C ``traceparent`` value of the span, always sampled."""
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    @classmethod
+    def parse(cls, traceparent) -> Optional["SpanContext"]:
+        """
+        Parse a W3C ``traceparent`` value.
+
+        Returns:
+            Optional[SpanContext]: The context, or None if the value is missing or malformed.
+        """
+        parts = traceparent.split("-") if isinstance(traceparent, str) else []
+        if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+            return None
+        return cls(parts[1], parts[2])
+
+
+class SpanBuffer:
+    """
+    The finished spans of a process-local root span, exported when it ends.
+
+    Spans that finish after their local root, such as background storage
+    writes, are exported on their own.
+    """
+
+    def __init__(self):
+        self.spans: List["Span"] = []
+        self.exported = False
+
+    def add(self, span: "Span") -> None:
+        if self.exported:
+            export([span])
+        else:
+            self.spans.append(span)
+
+    def flush(self) -> None:
+        self.exported = True
+        spans, self.spans = self.spans, []
+        export(spans)
+
+
+class Span:
+    """
+    A span being recorded.
+
+    Attributes:
+        name (str): The operation recorded.
+        context (SpanContext): The span's own context.
+        parent_id (Optional[str]): The span id of its parent, if any.
+        attributes (dict): Attributes exported with the span.
+    """
+
+    def __init__(self, name: str, context: SpanContext, parent_id: Optional[str], kind: int,
+                 attributes: Dict, buffer: Optional[SpanBuffer] = None, start_ns: Optional[int] = None):
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.kind = kind
+        self.attributes = attributes
+        self.start_ns = start_ns if start_ns is not None else time.time_ns()
+        self.end_ns = None
+        self.error = None
+        self.is_local_root = buffer is None
+        self.buffer = SpanBuffer() if buffer is None else buffer
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def finish(self, end_ns: Optional[int] = None) -> None:
+        self.end_ns = end_ns if end_ns is not None else time.time_ns()
+        self.buffer.add(self)
+        if self.is_local_root:
+            self.buffer.flush()
+
+    def to_otlp(self) -> Dict:
+        data = {
+            "traceId": self.context.trace_id,
+            "spanId": self.context.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [
+                {"key": key, "value": otlp_value(value)}
+                for key, value in self.attributes.items() if value is not None
+            ],
+        }
+        if self.parent_id:
+            data["parentSpanId"] = self.parent_id
+        if self.error is not None:
+            data["status"] = {"code": STATUS_ERROR, "message": self.error}
+        return data
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("imageupload_span", default=None)
+# Spans of the tasks being published and run by this process, by task id.
+_publishing: Dict[str, Span] = {}
+_running: Dict[str, Tuple[Span, Token]] = {}
+
+
+def otlp_value(value) -> Dict:
+    """
+    Encode an attribute value as an OTLP/JSON AnyValue.
+    """
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        # 64-bit integers are strings in OTLP/JSON.
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def new_span_id() -> str:
+    return os.urandom(8).hex()
+
+
+def current_span() -> Optional[Span]:
+    """
+    Return the span being recorded in this context, if any.
+    """
+    return _current_span.get()
+
+
+@contextmanager
+def span(name: str, parent: Optional[SpanContext] = None, kind: int = SPAN_KIND_INTERNAL,
+         start_ns: Optional[int] = None, **attributes) -> Iterator[Optional[Span]]:
+    """
+    Record the enclosed block as a span.
+
+    The span is a child of ``parent``, a context received from another
+    process, or otherwise of the current span. Without either, nothing is
+    recorded. An exception leaving the block marks the span as failed.
+
+    Args:
+        name (str): The operation recorded.
+        parent (Optional[SpanContext]): The remote parent span.
+        kind (int): The OTLP span kind.
+        start_ns (Optional[int]): Start time in ns since the epoch, if it started before the block.
+        **attributes: Attributes exported with the span; None values are left out.
+
+    Yields:
+        Optional[Span]: The span, or None when it is not recorded.
+    """
+    local_parent = _current_span.get()
+    if parent is None and local_parent is None or not settings.TRACE_ENABLED:
+        yield None
+        return
+
+    if parent is not None:
+        recorded = Span(name, SpanContext(parent.trace_id, new_span_id()), parent.span_id, kind,
+                        attributes, start_ns=start_ns)
+    else:
+        recorded = Span(name, SpanContext(local_parent.context.trace_id, new_span_id()),
+                        local_parent.context.span_id, kind, attributes, local_parent.buffer, start_ns)
+    token = _current_span.set(recorded)
+    try:
+        yield recorded
+    except BaseException as e:
+        recorded.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        recorded.finish()
+
+
+@contextmanager
+def start_trace(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """
+    Start a new trace, sampled at TRACE_SAMPLE_RATE, with the enclosed block as its root span.
+
+    Yields:
+        Optional[Span]: The root span, or None if the trace is not sampled.
+    """
+    if not settings.TRACE_ENABLED or random.random() >= settings.TRACE_SAMPLE_RATE:
+        yield None
+        return
+    root = SpanContext(os.urandom(16).hex(), "")
+    with span(name, parent=root, kind=SPAN_KIND_SERVER, **attributes) as recorded:
+        yield recorded
+
+
+def record_span(name: str, parent: SpanContext, start_ns: int, end_ns: Optional[int] = None,
+                kind: int = SPAN_KIND_INTERNAL, **attributes) -> None:
+    """
+    Record a span measured from timestamps rather than around a block, such as a wait.
+    """
+    if settings.TRACE_ENABLED:
+        Span(name, SpanContext(parent.trace_id, new_span_id()), parent.span_id, kind,
+             attributes, start_ns=start_ns).finish(end_ns)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """
+    Time a pipeline stage in STAGE_SECONDS, and as a span within a trace.
+    """
+    with span(name), STAGE_SECONDS.labels(name).time():
+        yield
+
+
+@before_task_publish.connect
+def start_publish_span(headers=None, sender=None, **kwargs):
+    """Record the publication of a task within a trace and propagate the trace in its headers."""
+    parent = _current_span.get()
+    if headers is None or parent is None or not settings.TRACE_ENABLED:
+        return
+    published = Span(f"publish {str(sender).rsplit('.', 1)[-1]}", SpanContext(parent.context.trace_id, new_span_id()),
+                     parent.context.span_id, SPAN_KIND_PRODUCER, {"celery.task_id": headers.get("id")},
+                     parent.buffer)
+    headers[TRACEPARENT_HEADER] = published.context.traceparent
+    _publishing[headers.get("id")] = published
+
+
+@after_task_publish.connect
+def finish_publish_span(headers=None, **kwargs):
+    published = _publishing.pop((headers or {}).get("id"), None)
+    if published is not None:
+        published.finish()
+
+
+@task_prerun.connect
+def start_task_span(task_id=None, task=None, **kwargs):
+    """
+    Record a task run as a span of the trace its publisher propagated, if any.
+
+    The time the task spent in the broker, from its ``published_at`` header
+    to now, is recorded first as a ``broker.wait`` span.
+    """
+    parent = SpanContext.parse(getattr(task.request, TRACEPARENT_HEADER, None))
+    if parent is None or not settings.TRACE_ENABLED:
+        return
+    published_at = getattr(task.request, "published_at", None)
+    if published_at is not None:
+        record_span("broker.wait", parent, int(published_at * 1e9), kind=SPAN_KIND_CONSUMER,
+                    **{"celery.task_id": task_id})
+    recorded = Span(f"task {task.name.rsplit('.', 1)[-1]}", SpanContext(parent.trace_id, new_span_id()),
+                    parent.span_id, SPAN_KIND_CONSUMER, {"celery.task_id": task_id})
+    _running[task_id] = (recorded, _current_span.set(recorded))
+
+
+@task_postrun.connect
+def finish_task_span(task_id=None, state=None, retval=None, **kwargs):
+    running = _running.pop(task_id, None)
+    if running is None:
+        return
+    recorded, token = running
+    try:
+        _current_span.reset(token)
+    except ValueError:
+        _current_span.set(None)
+    if state != "SUCCESS":
+        recorded.error = f"{state}: {retval}"
+    recorded.finish()
+
+
+def event_trace() -> Optional[Dict]:
+    """
+    Return the ``trace`` carried by a notification sent from the current span.
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return None
+    return {TRACEPARENT_HEADER: parent.context.traceparent, "sent_ns": time.time_ns()}
+
+
+def record_delivery(event: Dict, **attributes) -> None:
+    """
+    Record the delivery of a notification to a WebSocket client, if it carries a trace.
+    """
+    trace = event.get("trace") or {}
+    parent = SpanContext.parse(trace.get(TRACEPARENT_HEADER))
+    if parent is not None:
+        record_span("websocket.deliver", parent, trace["sent_ns"], job_id=event.get("job_id"),
+                    status=event.get("status"), **attributes)
+
+
+class SpanExporter:
+    """
+    Background writer of this process's finished spans.
+
+    export() only queues spans; a daemon thread writes them, gathering up to
+    TRACE_FLUSH_INTERVAL seconds of spans into each OTLP/JSON line, so no
+    request, task or consumer waits on file I/O. Spans are dropped, and
+    counted in TRACE_SPANS_DROPPED, while TRACE_QUEUE_SIZE are waiting. The
+    process's file is rotated once it reaches TRACE_FILE_MAX_BYTES, and the
+    oldest files of TRACE_DIR are then deleted until it holds at most
+    TRACE_MAX_BYTES.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.queue = queue.Queue(maxsize=settings.TRACE_QUEUE_SIZE)
+        self.write_lock = threading.Lock()
+        self.path = os.path.join(settings.TRACE_DIR, f"spans-{settings.TRACE_SERVICE_NAME}-{self.pid}.jsonl")
+        self.rotations = 0
+        self.pending: List[Span] = []
+        threading.Thread(target=self.run, name="trace-exporter", daemon=True).start()
+
+    def submit(self, spans: List[Span]) -> None:
+        for finished in spans:
+            try:
+                self.queue.put_nowait(finished)
+            except queue.Full:
+                TRACE_SPANS_DROPPED.inc()
+
+    def run(self) -> None:
+        while True:
+            self.pending.append(self.queue.get())
+            deadline = time.monotonic() + settings.TRACE_FLUSH_INTERVAL
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    self.pending.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.write_pending()
+
+    def flush(self) -> None:
+        """
+        Write the queued spans now, e.g. before the process exits.
+        """
+        while True:
+            try:
+                self.pending.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        self.write_pending()
+
+    def write_pending(self) -> None:
+        with self.write_lock:
+            spans, self.pending = self.pending, []
+            if spans:
+                self.write(spans)
+
+    def write(self, spans: List[Span]) -> None:
+        request = {"resourceSpans": [{
+            "resource": {"attributes": [
+                {"key": "service.name", "value": otlp_value(settings.TRACE_SERVICE_NAME)},
+                {"key": "host.name", "value": otlp_value(socket.gethostname())},
+                {"key": "process.pid", "value": otlp_value(self.pid)},
+            ]},
+            "scopeSpans": [{"scope": {"name": "imageupload"}, "spans": [span.to_otlp() for span in spans]}],
+        }]}
+        line = (json.dumps(request, separators=(",", ":")) + "\n").encode()
+        try:
+            os.makedirs(settings.TRACE_DIR, exist_ok=True)
+            with open(self.path, "ab") as trace_file:
+                trace_file.write(line)
+                size = trace_file.tell()
+            if size >= settings.TRACE_FILE_MAX_BYTES:
+                self.rotate()
+        except OSError as e:
+            logger.warning(f"Could not export {len(spans)} spans: {e}")
+
+    def rotate(self) -> None:
+        self.rotations += 1
+        os.replace(self.path, f"{self.path[:-len('.jsonl')]}-{self.rotations}.jsonl")
+        files = []
+        for path in glob.glob(os.path.join(settings.TRACE_DIR, "*.jsonl")):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= settings.TRACE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+_exporter: Optional[SpanExporter] = None
+_exporter_lock = threading.Lock()
+
+
+def get_exporter() -> SpanExporter:
+    """
+    Return this process's SpanExporter, starting it in each forked process.
+    """
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None or _exporter.pid != os.getpid():
+            _exporter = SpanExporter()
+    return _exporter
+
+
+def export(spans: List[Span]) -> None:
+    """
+    Queue finished spans to be written to this process's trace file.
+    """
+    if spans:
+        get_exporter().submit(spans)
+
+
+@worker_process_shutdown.connect
+def flush_spans(**kwargs):
+    """Write the spans still queued by a prefork child that is going away."""
+    if _exporter is not None and _exporter.pid == os.getpid():
+        _exporter.flush()
+
+
+atexit.register(flush_spans)
@@ -0,0 +1,110 @@
+# upload_handlers.py
+"""
+Upload handler that turns each multipart image part into a queued task.
+
+Django's default handlers keep every uploaded file (in memory or in a
+temporary file) until the whole request has been parsed. The streaming
+handler below instead hands each ``images`` part to the upload pipeline as
+soon as the part is complete: the part's bytes are buffered, its
+ImageUpload row is created and a ``process_and_save_image`` task is
+enqueued, after which the buffer is released. Rows are inserted
+STREAMING_UPLOAD_COMMIT_EVERY at a time, so memory is bounded by that many
+parts rather than by the size of the batch.
+"""
+import io
+import mimetypes
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler
+from django.db import transaction
+
+from .cache import invalidate_list_cache
+from .envelope import ImagePayload
+from .models import ImageUpload, UploadJob
+from .tasks import process_and_save_image
+
+
+class StreamingImageUploadHandler(FileUploadHandler):
+    """
+    Enqueue every image part of a multipart request as it is parsed.
+
+    Parts are never added to ``request.FILES``. Non-image parts are skipped
+    and their names collected in ``rejected``.
+
+    Attributes:
+        upload_job (UploadJob): The job the images are created in.
+        field_name (str): The form field holding the images.
+        task_headers (dict): Headers the tasks are published with.
+        count (int): Number of images enqueued so far.
+        rejected (List[str]): Names of the parts that were not images.
+    """
+
+    def __init__(self, upload_job: UploadJob, field_name: str = "images",
+                 task_headers: Optional[Dict] = None, request=None):
+        super().__init__(request)
+        self.upload_job = upload_job
+        self.field_name = field_name
+        self.task_headers = task_headers or {}
+        self.count = 0
+        self.rejected: List[str] = []
+        self.buffer: Optional[io.BytesIO] = None
+        self.pending: List[Tuple[ImageUpload, bytes]] = []
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        self.buffer = io.BytesIO() if field_name == self.field_name else None
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.buffer is not None:
+            self.buffer.write(raw_data)
+        # Returning None keeps the chunk from reaching any other handler.
+        return None
+
+    def file_complete(self, file_size):
+        if self.buffer is None:
+            return None
+        image_bytes = self.buffer.getvalue()
+        self.buffer = None
+
+        file_type = self.content_type
+        if not file_type or file_type == 'application/octet-stream':
+            file_type = mimetypes.guess_type(self.file_name)[0] or ''
+        if not file_type.startswith("image/"):
+            self.rejected.append(self.file_name)
+            return None
+
+        image_instance = ImageUpload(
+            size=file_size,
+            type=file_type,
+            name=self.file_name,
+            job_id=f"{self.upload_job.id}-{self.count}",
+            upload_job=self.upload_job,
+            status='processing',
+            task_id=str(uuid.uuid4())
+        )
+        self.count += 1
+        self.pending.append((image_instance, image_bytes))
+        if len(self.pending) >= settings.STREAMING_UPLOAD_COMMIT_EVERY:
+            self.flush()
+        return None
+
+    def upload_complete(self):
+        self.flush()
+
+    def flush(self) -> None:
+        """
+        Insert the pending rows and enqueue one task per image.
+        """
+        if not self.pending:
+            return
+        with transaction.atomic():
+            ImageUpload.objects.bulk_create([image_instance for image_instance, _ in self.pending])
+        invalidate_list_cache()
+        for image_instance, image_bytes in self.pending:
+            payload = ImagePayload.build(
+                image_instance.id, image_instance.name, image_instance.size, image_instance.type, image_bytes
+            )
+            process_and_save_image.apply_async((payload,), headers=self.task_headers, task_id=image_instance.task_id)
+        self.pending = []
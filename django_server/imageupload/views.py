@@ -1,21 +1,29 @@
 
 from datetime import datetime
-from .decorators import validate_image_in_request, validate_image_file_type, validate_images_in_request
-from .models import ImageUpload
+from .cache import current_generation, invalidate_list_cache, list_page_cache
+from .decorators import (
+    trace_upload_request, validate_image_in_request, validate_image_file_type, validate_images_in_request
+)
+from .envelope import ImagePayload
+from .jobs import cancel_job, job_status
+from .models import ImageUpload, UploadJob
+from .profiling import profiling_requested
 from .serializers import ImageUploadSerializer
+from .storage import write_image
 from .tasks import process_and_save_image, process_image_batch
+from .upload_handlers import StreamingImageUploadHandler
 from adrf.views import APIView as AsyncAPIView
 from asgiref.sync import sync_to_async
 from channels.db import database_sync_to_async
-from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
 from django.utils import timezone
-from PIL import Image
 from rest_framework import status
+from rest_framework.renderers import JSONRenderer
 from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from django.db import transaction
-import io
 import logging
 import traceback
 import uuid
@@ -28,24 +36,190 @@ class ListView(APIView):
         """
         Handle GET requests to list all image uploads.
 
+        The optional ``page`` and ``page_size`` query parameters restrict the
+        response to one page of the newest uploads. Rendered pages are served
+        from the list page cache until an upload is created or changes status.
+
         Args:
             request (Request): The HTTP request object.
 
         Returns:
             Response: A JSON response containing the list of image uploads.
         """
-        image_uploads = ImageUpload.objects.all().order_by("-uploaded_at")
-        serializer = ImageUploadSerializer(image_uploads, many=True)
-        data = serializer.data
-        response = Response(data, status=status.HTTP_200_OK)
-        response["Content-Type"] = "application/json"
-        return response
+        try:
+            page = int(request.query_params.get("page", 1))
+            page_size = request.query_params.get("page_size")
+            page_size = int(page_size) if page_size is not None else None
+        except ValueError:
+            return Response(
+                {"error": "page and page_size must be integers"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        if page < 1 or (page_size is not None and not 1 <= page_size <= settings.LIST_MAX_PAGE_SIZE):
+            return Response({"error": "Invalid page"}, status=status.HTTP_400_BAD_REQUEST)
+
+        generation = current_generation()
+        cache_key = (generation, page, page_size)
+        content = list_page_cache.get(cache_key) if generation is not None else None
+
+        if content is None:
+            image_uploads = ImageUpload.objects.all().order_by("-uploaded_at")
+            if page_size is not None:
+                offset = (page - 1) * page_size
+                image_uploads = image_uploads[offset:offset + page_size]
+            serializer = ImageUploadSerializer(image_uploads, many=True)
+            content = JSONRenderer().render(serializer.data)
+            if generation is not None:
+                list_page_cache.set(cache_key, content)
+
+        return HttpResponse(content, status=status.HTTP_200_OK, content_type="application/json")
       
 
+class JobStatusView(APIView):
+    """
+    API View returning the processing state of one upload job.
+    """
+    def get(self, request: Request, job_id: str) -> Response:
+        """
+        Handle GET requests for a job's status.
+
+        Reconnecting WebSocket clients use the returned ``seq`` to resume the
+        job's notifications instead of reloading the full list.
+
+        Args:
+            request (Request): The HTTP request object.
+            job_id (str): The job id returned when the upload was initiated.
+
+        Returns:
+            Response: The number of images per status and the newest event sequence number.
+        """
+        job = job_status(job_id)
+        if not job["total"]:
+            return Response({"error": "Job not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(job, status=status.HTTP_200_OK)
+
+
+class CancelJobView(APIView):
+    """
+    API View cancelling the unfinished images of one upload job.
+    """
+    def post(self, request: Request, job_id: str) -> Response:
+        """
+        Handle POST requests to cancel a job.
+
+        The job's pending and processing images are marked 'aborted', the
+        tasks holding them are revoked and running tasks stop before their
+        next image. Images already completed are kept.
+
+        Args:
+            request (Request): The HTTP request object.
+            job_id (str): The job id returned when the upload was initiated.
+
+        Returns:
+            Response: The number of images aborted and tasks revoked.
+        """
+        result = cancel_job(job_id)
+        if result is None:
+            return Response({"error": "Job not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(result, status=status.HTTP_200_OK)
+
+
+class SimilarImagesView(APIView):
+    """
+    API View listing the near-duplicates of an uploaded image.
+    """
+    def get(self, request: Request, image_id) -> Response:
+        """
+        Handle GET requests for the images similar to one image.
+
+        The optional ``distance`` query parameter (0-3, default 3) is the
+        largest Hamming distance between perceptual hashes to include.
+
+        Args:
+            request (Request): The HTTP request object.
+            image_id (UUID): The id of the image to compare against.
+
+        Returns:
+            Response: The matching images with their distances, closest first,
+            and whether more matches than SIMILAR_MAX_RESULTS were left out.
+        """
+        from .similarity import MAX_DISTANCE, find_similar
+
+        try:
+            max_distance = int(request.query_params.get("distance", MAX_DISTANCE))
+        except ValueError:
+            return Response({"error": "distance must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+        if not 0 <= max_distance <= MAX_DISTANCE:
+            return Response(
+                {"error": f"distance must be between 0 and {MAX_DISTANCE}"}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        image_upload = ImageUpload.objects.filter(id=image_id).only("id", "phash").first()
+        if image_upload is None or image_upload.phash is None:
+            return Response({"error": "Image not found or not processed"}, status=status.HTTP_404_NOT_FOUND)
+
+        matches, truncated = find_similar(image_upload.phash, max_distance, exclude_id=image_upload.id)
+        results = ImageUploadSerializer([match for match, _ in matches], many=True).data
+        for result, (_, distance) in zip(results, matches):
+            result["distance"] = distance
+        return Response(
+            {"id": str(image_upload.id), "results": results, "truncated": truncated}, status=status.HTTP_200_OK
+        )
+
+
+class RenderImageView(AsyncAPIView):
+    """
+    API View serving resized and re-encoded renditions of a processed image.
+    """
+    async def get(self, request: Request, image_id):
+        """
+        Handle GET requests for a rendition of an image.
+
+        The ``w``, ``fmt`` and ``q`` query parameters are snapped to
+        RENDER_WIDTHS, RENDER_FORMATS and RENDER_QUALITIES. Renditions are
+        rendered from the stored master on first request and served from
+        the disk cache afterwards; the ``X-Render-Cache`` header tells which.
+        Renditions are looked up and rendered in a thread of their own, so
+        a render, or a wait for a concurrent one, never holds up the thread
+        shared by the synchronous views.
+
+        Args:
+            request (Request): The HTTP request object.
+            image_id (UUID): The id of the image to render.
+
+        Returns:
+            FileResponse: The rendition, or a JSON error response.
+        """
+        from .renditions import get_rendition, parse_spec
+
+        try:
+            spec = parse_spec(request.query_params)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        image_upload = await ImageUpload.objects.filter(id=image_id, status='completed').only(
+            "id", "image", "finished_at"
+        ).afirst()
+        if image_upload is None or not image_upload.image:
+            return Response({"error": "Image not found or not processed"}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            rendition = await sync_to_async(get_rendition, thread_sensitive=False)(image_upload, spec)
+        except Exception as e:
+            logging.error(f'Error RenderImageView: {e}\n{traceback.format_exc()}')
+            return Response({"error": "Could not render image"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        response = FileResponse(rendition.file, content_type=spec.content_type)
+        response["Cache-Control"] = "public, max-age=86400"
+        response["X-Render-Cache"] = "hit" if rendition.cached else "miss"
+        response["X-Render-Spec"] = f"w={spec.width}; fmt={spec.extension}; q={spec.quality}"
+        return response
+
+
 class UploadImageView(APIView):
     """
     API View to handle image upload.
     """
+    @trace_upload_request
     @validate_image_in_request
     @validate_image_file_type
     def post(self, request: Request) -> Response:
@@ -67,43 +241,32 @@ class UploadImageView(APIView):
         file_type = uploaded_image.content_type
         file_name = uploaded_image.name
 
+        # PIL and NumPy are only loaded by the first synchronous upload, not at startup.
+        from .previews import annotate_previews
+        from .processing import process_image
+
         try:
-            img = Image.open(uploaded_image)
+            processed = process_image(uploaded_image.read(), file_name, file_type, thumbnail=True)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
-   
-        width, height = img.size
-        if width != 1500:
-            ratio = 1500 / float(width)
-            new_height = int((float(height) * float(ratio)))
-            img = img.resize((1500, new_height), Image.LANCZOS)  # Updated to use LANCZOS
-
-        if img.mode == "RGBA":
-            img = img.convert("RGB")
-
-        image_format = file_type.split("/")[1].upper()
-        img_io = io.BytesIO()
-        img.save(img_io, format=image_format)
-        img_io.seek(0)
-
-        img_file = InMemoryUploadedFile(
-            img_io,
-            None,
-            f"resized.{image_format.lower()}",
-            f"image/{image_format.lower()}",
-            img_io.getbuffer().nbytes,
-            None,
-        )
-        job_id = str(uuid.uuid4())
+
+        upload_job = UploadJob.objects.create(total=1)
 
         # Initialize image instance
         image_instance = ImageUpload(
-            image=img_file, 
             size=file_size, 
             type=file_type, 
             name=file_name, 
-            job_id=job_id,
-            status="completed" 
+            job_id=str(upload_job.id),
+            upload_job=upload_job,
+            status="completed",
+            **processed.metadata()
+        )
+        annotate_previews([(image_instance, processed.thumbnail)])
+
+        image_instance.image.name = write_image(
+            image_instance.image.field.generate_filename(image_instance, f"resized.{processed.extension}"),
+            processed.content
         )
 
         # Set finished_at to current time
@@ -118,6 +281,7 @@ class UploadImageView(APIView):
 
         # Update and save instance with upload_time
         image_instance.save()
+        invalidate_list_cache()
 
         return Response({"message": "Image uploaded successfully"}, status=status.HTTP_200_OK)
       
@@ -126,6 +290,7 @@ class AsyncUploadImageView(AsyncAPIView):
     """
     API View to handle asynchronous image upload.
     """
+    @trace_upload_request
     @validate_images_in_request
     async def post(self, request: Request) -> Response:
       """
@@ -143,7 +308,9 @@ class AsyncUploadImageView(AsyncAPIView):
       """
       try:
           images = request.FILES.getlist("images")
-          job_id = str(uuid.uuid4())
+          upload_job = await database_sync_to_async(UploadJob.objects.create)(total=len(images))
+          job_id = str(upload_job.id)
+          task_headers = {"profile": True} if profiling_requested(request) else {}
           for index, uploaded_image in enumerate(images):
               file_size = uploaded_image.size
               file_type = uploaded_image.content_type
@@ -157,21 +324,29 @@ class AsyncUploadImageView(AsyncAPIView):
                   type=file_type,
                   name=file_name,
                   job_id=f"{job_id}-{index}",
-                  status='processing'
+                  upload_job=upload_job,
+                  status='processing',
+                  task_id=str(uuid.uuid4())
               )
               await database_sync_to_async(image_instance.save)()
-              process_and_save_image.delay(image_bytes, file_name, file_size, file_type, image_instance.id)
+              await sync_to_async(invalidate_list_cache)()
+              process_and_save_image.apply_async(
+                  (ImagePayload.build(image_instance.id, file_name, file_size, file_type, image_bytes),),
+                  headers=task_headers,
+                  task_id=image_instance.task_id
+              )
 
       except Exception as e:
           logging.error(f'Error AsyncUploadImageView: {e}\n{traceback.format_exc()}')
           return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
       return Response(
-          {"message": "Images upload initiated"}, status=status.HTTP_200_OK
+          {"message": "Images upload initiated", "job_id": job_id}, status=status.HTTP_200_OK
       )
       
       
 class BatchAsyncUploadImageView(AsyncAPIView):
+    @trace_upload_request
     @validate_images_in_request
     async def post(self, request: Request) -> Response:
         """
@@ -179,7 +354,8 @@ class BatchAsyncUploadImageView(AsyncAPIView):
 
         This view processes multiple images in a single batch, improving efficiency for large uploads.
         It creates ImageUpload instances for each image, saves them to the database in bulk,
-        and then triggers a single background task to process all images in the batch.
+        and then triggers a background task per chunk of at most BATCH_TASK_MAX_BYTES of images,
+        so that no worker holds the whole batch in memory while it is processed.
 
         Attributes:
             None
@@ -192,23 +368,35 @@ class BatchAsyncUploadImageView(AsyncAPIView):
             image_data_list = []
             image_instances = []
 
+            # Payloads per task id, in upload order.
+            chunks = {}
+
+            upload_job = UploadJob(total=len(images))
+            job_id = str(upload_job.id)
+
             @sync_to_async
             def create_image_instances():
                 with transaction.atomic():
-                    job_id = str(uuid.uuid4())
+                    upload_job.save()
+                    task_id, chunk_bytes = None, 0
                     for index, uploaded_image in enumerate(images):
                         file_size = uploaded_image.size
                         file_type = uploaded_image.content_type
                         file_name = uploaded_image.name
 
                         image_bytes = uploaded_image.read()
+                        if task_id is None or (chunk_bytes and chunk_bytes + file_size > settings.BATCH_TASK_MAX_BYTES):
+                            task_id, chunk_bytes = str(uuid.uuid4()), 0
+                        chunk_bytes += file_size
                         
                         image_instance = ImageUpload(
                             size=file_size,
                             type=file_type,
                             name=file_name,
                             job_id=f"{job_id}-{index}",
-                            status='processing'
+                            upload_job=upload_job,
+                            status='processing',
+                            task_id=task_id
                         )
                         image_instances.append(image_instance)
                         image_data_list.append((image_bytes, file_name, file_size, file_type))
@@ -216,21 +404,96 @@ class BatchAsyncUploadImageView(AsyncAPIView):
                     # Bulk create all image instances
                     created_instances = ImageUpload.objects.bulk_create(image_instances)
                     
-                    # Update image_data_list with created instance IDs
+                    # Turn image_data_list into task payloads carrying the created instance IDs
                     for i, instance in enumerate(created_instances):
-                        image_data_list[i] += (instance.id,)
+                        image_bytes, file_name, file_size, file_type = image_data_list[i]
+                        image_data_list[i] = ImagePayload.build(
+                            instance.id, file_name, file_size, file_type, image_bytes
+                        )
+                        chunks.setdefault(instance.task_id, []).append(image_data_list[i])
 
             # Call the async wrapper function
             await create_image_instances()
+            await sync_to_async(invalidate_list_cache)()
 
-            # Trigger the batch processing task
-            process_image_batch.delay(image_data_list)
+            # Trigger a batch processing task per chunk
+            task_headers = {"profile": True} if profiling_requested(request) else {}
+            for task_id, payloads in chunks.items():
+                process_image_batch.apply_async((payloads,), headers=task_headers, task_id=task_id)
 
             return Response(
-                {"message": f"Batch upload of {len(images)} images initiated"},
+                {"message": f"Batch upload of {len(images)} images initiated", "job_id": job_id},
                 status=status.HTTP_202_ACCEPTED
             )
 
         except Exception as e:
             logging.error(f'Error BatchAsyncUploadImageView: {e}\n{traceback.format_exc()}')
-            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+
+class StreamingBatchUploadImageView(APIView):
+    """
+    API View to handle batch image upload without buffering the whole batch.
+    """
+    @trace_upload_request
+    def post(self, request: Request) -> Response:
+        """
+        Handle POST requests to upload a batch of images part by part.
+
+        The multipart body is parsed by StreamingImageUploadHandler, which
+        creates each image's row and enqueues its processing task as soon
+        as the part has been read, so only a few parts are held in memory
+        at a time and the first images are processed while later parts are
+        still being parsed.
+
+        Args:
+            request (Request): The HTTP request object containing the image files.
+
+        If the body cannot be parsed after some images were enqueued, for
+        example because it holds more than DATA_UPLOAD_MAX_NUMBER_FILES
+        files, those images are still processed: the response is a 207 with
+        the job id, the number of images enqueued and the error.
+
+        Returns:
+            Response: A JSON response with the job id and the number of images enqueued.
+        """
+        upload_job = UploadJob.objects.create(total=0)
+        task_headers = {"profile": True} if profiling_requested(request) else {}
+        handler = StreamingImageUploadHandler(upload_job, task_headers=task_headers, request=request)
+        request.upload_handlers = [handler]
+
+        try:
+            request.data
+        except Exception as e:
+            logging.error(f'Error StreamingBatchUploadImageView: {e}\n{traceback.format_exc()}')
+            # The parts read before the error are complete; enqueue them too.
+            handler.flush()
+            if not handler.count:
+                upload_job.delete()
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            upload_job.total = handler.count
+            upload_job.save(update_fields=["total"])
+            return Response(
+                {
+                    "message": f"Batch upload of {handler.count} images initiated, the rest of the request failed",
+                    "job_id": str(upload_job.id),
+                    "rejected": handler.rejected,
+                    "error": str(e),
+                },
+                status=status.HTTP_207_MULTI_STATUS
+            )
+
+        if not handler.count:
+            upload_job.delete()
+            return Response({"error": "No images provided"}, status=status.HTTP_400_BAD_REQUEST)
+
+        upload_job.total = handler.count
+        upload_job.save(update_fields=["total"])
+        return Response(
+            {
+                "message": f"Batch upload of {handler.count} images initiated",
+                "job_id": str(upload_job.id),
+                "rejected": handler.rejected,
+            },
+            status=status.HTTP_202_ACCEPTED
+        )
\ No newline at end of file